@@ -0,0 +1,196 @@
+######################################################################
+#   File: ArtifactStore.py
+#
+#   Description:
+#       Stores the files the tests write to Outputs and Errors by their
+#       contents: each distinct file is kept once, as a read-only blob
+#       named by its digest, and the files in Outputs and Errors are
+#       hard links to the blobs (copies where links are not possible).
+#       When many submissions print the same (correct) output, it is
+#       written to the store only once. Every run writes a manifest
+#       giving the digest of each file of each test. The store is a
+#       private directory of the user, on the file system of the test
+#       cases where possible (so that the files can be linked).
+#
+#   Included classes:
+#       - ArtifactStore() the blobs and the manifests of the runs. Blobs
+#       no manifest refers to any more are removed once there are more
+#       than MANIFEST_LIMIT manifests.
+#
+######################################################################
+
+import glob
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+import ResultCache
+from ResultCache import file_digest, private_dir
+
+
+class ArtifactStore:
+    #  A file with digest <hex> is stored as <root>/blobs/<hex[:2]>/<hex>, and
+    #  the manifest of a run as <root>/manifests/<time>-<pid>-<n>.json. The
+    #  root is the cache directory STORE_NAME (see ResultCache.cache_dir()),
+    #  or LOCAL_STORE_NAME next to the test cases when that is on another
+    #  file system.
+    STORE_NAME = "artifacts"
+    LOCAL_STORE_NAME = ".testcenter-artifacts"
+    #  The newest MANIFEST_KEPT manifests are kept when there are more than
+    #  MANIFEST_LIMIT of them; blobs newer than BLOB_GRACE seconds are kept
+    #  regardless (a run may be storing them, and not have written its manifest).
+    MANIFEST_KEPT = 50
+    MANIFEST_LIMIT = 100
+    BLOB_GRACE = 3600
+
+    def __init__(self, root=None, near=None):
+        '''root is the directory of the store (see above for the default,
+           where near is the directory of the test cases). Without a
+           directory that can be trusted, the store keeps nothing.
+        '''
+        self.root = root or ArtifactStore.__default_root(near)
+        self.manifests = 0 # manifests written so far
+
+    def put(self, path, dest):
+        '''Moves the file path into the store, and places it at dest (which
+           may be path itself). Returns the digest of its contents (in hex),
+           or None if it could not be stored (the file is then moved to dest).
+        '''
+        try:
+            if self.root is None:
+                raise FileNotFoundError("no artifact store")
+            digest = file_digest(path).hex()
+            blob = self.blob_path(digest)
+            if ArtifactStore.__is_blob(blob):
+                os.utime(blob) # stored already: keep it from being collected
+                os.remove(path)
+            else:
+                ArtifactStore.__add_blob(path, blob)
+        except OSError: # the store is unavailable: keep the file where it belongs
+            if os.path.abspath(path) != os.path.abspath(dest):
+                shutil.move(path, dest)
+            return None
+        self.link(digest, dest)
+        return digest
+
+    def link(self, digest, dest):
+        '''Places the blob of digest at dest (replacing any file there).
+           Raises OSError if there is no such blob (or it cannot be trusted).
+        '''
+        if self.root is None:
+            raise FileNotFoundError("no artifact store")
+        blob = self.blob_path(digest)
+        if not ArtifactStore.__is_blob(blob):
+            raise FileNotFoundError("no stored file %s" % digest)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            os.link(blob, dest)
+        except OSError: # on another file system, or without hard links
+            shutil.copyfile(blob, dest)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, "blobs", digest[:2], digest)
+
+    def write_manifest(self, manifest):
+        '''Stores manifest (a dictionary of JSON values, see
+           TestSuite.run_tests) as the manifest of a run, and removes the
+           oldest manifests and the blobs no manifest refers to once there
+           are too many. Returns the path of the manifest (None if it could
+           not be written).
+        '''
+        if self.root is None:
+            return None
+        manifest_dir = os.path.join(self.root, "manifests")
+        self.manifests += 1
+        path = os.path.join(manifest_dir, "%s-%d-%d.json"
+                            % (time.strftime("%Y%m%d-%H%M%S"), os.getpid(), self.manifests))
+        try:
+            os.makedirs(manifest_dir, exist_ok=True)
+            (fd, tmp_path) = tempfile.mkstemp(dir=manifest_dir, suffix=".tmp")
+            with os.fdopen(fd, 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+            os.replace(tmp_path, path)
+            if len(os.listdir(manifest_dir)) > ArtifactStore.MANIFEST_LIMIT:
+                self.collect_garbage()
+        except OSError:
+            return None
+        return path
+
+    def collect_garbage(self):
+        '''Removes all but the newest MANIFEST_KEPT manifests, and the blobs
+           none of those refers to (except recent ones).
+        '''
+        if self.root is None:
+            return
+        manifest_paths = sorted(glob.glob(os.path.join(self.root, "manifests", "*.json"))
+                                , key=os.path.getmtime)
+        for path in manifest_paths[:-ArtifactStore.MANIFEST_KEPT]:
+            try:
+                os.remove(path)
+            except OSError: # removed by a concurrent run
+                pass
+        referenced = set()
+        for path in manifest_paths[-ArtifactStore.MANIFEST_KEPT:]:
+            try:
+                with open(path) as manifest_file:
+                    tests = json.load(manifest_file)["tests"]
+            except (OSError, ValueError, KeyError): # removed by a concurrent run
+                continue
+            for files in tests.values():
+                referenced.update(files.values())
+        too_new = time.time() - ArtifactStore.BLOB_GRACE
+        for blob in glob.glob(os.path.join(self.root, "blobs", "*", "*")):
+            try:
+                if os.path.basename(blob) not in referenced and os.path.getmtime(blob) < too_new:
+                    os.remove(blob)
+            except OSError:
+                pass
+
+    @staticmethod
+    def __default_root(near):
+        '''The private directory of the store (None if there is none).'''
+        try:
+            root = ResultCache.cache_dir(ArtifactStore.STORE_NAME)
+        except OSError:
+            root = None
+        if near is None:
+            return root
+        near = os.path.dirname(os.path.abspath(near))
+        try:
+            if root is not None and os.stat(root).st_dev == os.stat(near).st_dev:
+                return root
+            return private_dir(os.path.join(near, ArtifactStore.LOCAL_STORE_NAME))
+        except OSError:
+            return root
+
+    @staticmethod
+    def __is_blob(blob):
+        '''Whether blob is stored (a read-only file of the user).'''
+        try:
+            info = os.lstat(blob)
+        except FileNotFoundError:
+            return False
+        return stat.S_ISREG(info.st_mode) and not info.st_mode & 0o222 \
+            and (not hasattr(os, "getuid") or info.st_uid == os.getuid())
+
+    @staticmethod
+    def __add_blob(path, blob):
+        '''Moves path to blob, read-only.'''
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.chmod(path, 0o444)
+        try:
+            os.replace(path, blob)
+        except OSError: # on another file system: copy, then rename
+            (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(blob), suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file, open(path, 'rb') as file:
+                    shutil.copyfileobj(file, tmp_file)
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, blob)
+            except OSError:
+                os.remove(tmp_path)
+                raise
+            os.remove(path)
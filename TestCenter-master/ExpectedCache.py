@@ -0,0 +1,129 @@
+######################################################################
+#   File: ExpectedCache.py
+#
+#   Description:
+#       Keeps the normalized forms of the expected outputs (see
+#       diffs.expected_forms()), so that comparing an output only has
+#       to normalize the output itself. The expected files almost never
+#       change, so their forms are computed once and stored on disk.
+#
+#   Included classes:
+#       - ExpectedCache() stores, for every expected text file, its
+#       lines and their whitespace-stripped and visible-space forms,
+#       under the digest of its contents: copies of a test suite (e.g.
+#       the one a batch worker unpacks) share the records. Within a
+#       run, the digest of a file is computed again only when its size
+#       or modification time changed; only the forms of the files used
+#       last are kept in memory (they are read from disk again).
+#
+######################################################################
+
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+import diffs
+from ResultCache import file_digest, cache_dir
+
+
+class ExpectedCache:
+    #  The forms of an expected file are stored as JSON in
+    #  <cache>/CACHE_NAME/<digest>.json (see ResultCache.cache_dir()).
+    CACHE_NAME = "expected"
+    VERSION = 2
+
+    #  Number of expected files whose forms are kept in memory
+    FORMS_LIMIT = 16
+
+    def __init__(self):
+        self.digests = {}          # path -> (size, mtime, digest) of the files used so far
+        self.recent_forms = OrderedDict() # digest -> forms of the files used last (the last at the end)
+        self.lock = threading.Lock()
+
+    def prepare(self, test_cases):
+        '''Stores the forms of the expected text files of all the test
+           cases (test_cases[scriptname][testname]) that are not stored yet.
+        '''
+        for script_tests in test_cases.values():
+            for test_case in script_tests.values():
+                for exp_path in test_case.exp_paths:
+                    if test_case.tolerance() is None and test_case.is_text_exp(exp_path):
+                        digest = self.__digest(exp_path)
+                        if digest is not None and not ExpectedCache.__stored(digest):
+                            ExpectedCache.__save(digest, diffs.expected_forms(diffs.read_file(exp_path, True)))
+
+    def forms(self, exp_path):
+        '''Returns diffs.expected_forms() of the expected text file exp_path,
+           or None if the file is too large to be kept (see diffs.LARGE_FILE).
+        '''
+        digest = self.__digest(exp_path)
+        if digest is None:
+            return None
+        with self.lock:
+            forms = self.recent_forms.get(digest)
+            if forms is not None:
+                self.recent_forms.move_to_end(digest)
+                return forms
+        forms = ExpectedCache.__load(digest)
+        if forms is None:
+            forms = diffs.expected_forms(diffs.read_file(exp_path, True))
+            ExpectedCache.__save(digest, forms)
+        with self.lock:
+            self.recent_forms[digest] = forms
+            while len(self.recent_forms) > ExpectedCache.FORMS_LIMIT:
+                self.recent_forms.popitem(last=False)
+        return forms
+
+    def __digest(self, exp_path):
+        '''The digest (hex) of the expected file exp_path, computed again only
+           when its size or modification time changed (None if the file is
+           missing or too large to be kept).
+        '''
+        try:
+            stat = os.stat(exp_path)
+        except OSError:
+            return None
+        if stat.st_size >= diffs.LARGE_FILE:
+            return None
+        with self.lock:
+            known = self.digests.get(exp_path)
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+            return known[2]
+        digest = file_digest(exp_path).hex()
+        with self.lock:
+            self.digests[exp_path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    @staticmethod
+    def __load(digest):
+        '''The forms stored under digest (None if there are none).'''
+        try:
+            with open(ExpectedCache.__record_path(digest)) as record_file:
+                record = json.load(record_file)
+            if record["version"] == ExpectedCache.VERSION and len(record["forms"]) == 3:
+                return tuple(record["forms"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    @staticmethod
+    def __stored(digest):
+        try:
+            return os.path.exists(ExpectedCache.__record_path(digest))
+        except OSError: # the cache cannot be used: nothing to store either
+            return True
+
+    @staticmethod
+    def __save(digest, forms):
+        try:
+            (fd, tmp_path) = tempfile.mkstemp(dir=cache_dir(ExpectedCache.CACHE_NAME), suffix=".tmp")
+            with os.fdopen(fd, 'w') as record_file:
+                json.dump({"version": ExpectedCache.VERSION, "forms": forms}, record_file)
+            os.replace(tmp_path, ExpectedCache.__record_path(digest))
+        except OSError: # the cache is only an optimization
+            pass
+
+    @staticmethod
+    def __record_path(digest):
+        return os.path.join(cache_dir(ExpectedCache.CACHE_NAME), digest + ".json")
@@ -0,0 +1,279 @@
+######################################################################
+#   File: GradingQueue.py
+#
+#   Description:
+#       Distributes batch grading (see batchgrade.py) over workers
+#       connected through TCP sockets, on the same machine or others.
+#       The coordinator sends every worker that connects the test
+#       suite once, then one submission at a time, and collects the
+#       row of the results table of each submission. A submission
+#       being graded by a worker that disconnects is given to another.
+#
+#       Protocol: every message is a line of JSON (the header),
+#       followed by header["size"] bytes of payload (a file or a tar
+#       archive). A worker sends "hello" (with the token of the
+#       coordinator); the coordinator answers "suite" (options, and the
+#       test-case directory with the scripts of the source directory),
+#       then "submission" messages, each answered by a "result", and
+#       finally "done".
+#
+#   Included functions:
+#       - parse_address(), send_message(), receive_message(),
+#         pack_directory(), unpack_archive(), run_worker()
+#
+#   Included classes:
+#       - Coordinator() serves the submissions to the workers.
+#
+######################################################################
+
+import glob
+import hmac
+import json
+import os
+import queue
+import shutil
+import socket
+import tarfile
+import tempfile
+import threading
+import time
+
+# bytes read from a socket at a time
+BLOCK_SIZE = 1024 * 1024
+# seconds a worker keeps trying to connect to a coordinator that is not up yet
+CONNECT_TIMEOUT = 30
+
+
+def parse_address(text):
+    '''Parses "host:port" (or just "port", for all interfaces).'''
+    (host, _, port) = text.rpartition(":")
+    return (host, int(port))
+
+
+def send_message(sock, header, payload_path=None):
+    '''Sends header (a dictionary) followed by the contents of payload_path.'''
+    header = dict(header, size=os.path.getsize(payload_path) if payload_path else 0)
+    sock.sendall(json.dumps(header).encode() + b"\n")
+    if payload_path:
+        with open(payload_path, 'rb') as payload:
+            sock.sendfile(payload)
+
+
+def receive_message(reader, payload_dir=None):
+    '''Reads a message from reader (sock.makefile('rb')). Returns its header,
+       and the path of a new file in payload_dir holding its payload (None if
+       it has none). Raises EOFError if the connection was closed.
+    '''
+    line = reader.readline()
+    if not line:
+        raise EOFError("connection closed")
+    header = json.loads(line)
+    payload_path = None
+    if header["size"]:
+        (fd, payload_path) = tempfile.mkstemp(dir=payload_dir, suffix=".payload")
+        with os.fdopen(fd, 'wb') as payload:
+            remaining = header["size"]
+            while remaining:
+                block = reader.read(min(remaining, BLOCK_SIZE))
+                if not block:
+                    raise EOFError("connection closed")
+                payload.write(block)
+                remaining -= len(block)
+    return (header, payload_path)
+
+
+def pack_directory(archive_path, members, exclude_dirs=()):
+    '''Writes the tar archive archive_path holding members, a list of
+       (path, name in the archive). The contents (but not the directories
+       themselves) of directories named in exclude_dirs are left out.
+    '''
+    def leave_out(info):
+        parent = os.path.basename(os.path.dirname(info.name))
+        return None if parent in exclude_dirs else info
+    with tarfile.open(archive_path, "w") as archive:
+        for (path, name) in members:
+            archive.add(path, arcname=name, filter=leave_out)
+
+
+def unpack_archive(archive_path, dest):
+    '''Extracts the tar archive archive_path into dest (refusing absolute
+       paths and links out of dest, where tarfile can check them).
+    '''
+    with tarfile.open(archive_path) as archive:
+        if hasattr(tarfile, "data_filter"):
+            archive.extractall(dest, filter="data")
+        else:
+            archive.extractall(dest)
+
+
+class Coordinator:
+    def __init__(self, address, token, options, test_directory, srcdir, submissions):
+        '''Serves submissions (paths of files or directories) on address
+           (host, port) to the workers presenting token. options (a
+           dictionary of JSON values) are sent to the workers with the test
+           suite: test_directory, and the shell scripts and .build
+           directory of srcdir.
+        '''
+        self.token = token
+        self.options = options
+        self.test_directory = os.path.abspath(test_directory)
+        self.submissions = submissions
+        self.work_dir = tempfile.mkdtemp(prefix="coordinator-")
+        self.suite_path = os.path.join(self.work_dir, "suite.tar")
+        members = [(test_directory, "test-cases")] \
+                + [(path, os.path.join("src", os.path.basename(path)))
+                   for path in glob.glob(os.path.join(srcdir, "*.sh"))
+                              + glob.glob(os.path.join(srcdir, ".build"))]
+        pack_directory(self.suite_path, members, exclude_dirs=("Outputs", "Errors"))
+        self.pending = queue.Queue()
+        for index in range(len(submissions)):
+            self.pending.put(index)
+        if not submissions:
+            self.pending.put(None)
+        self.results = queue.Queue()
+        self.remaining = len(submissions) # submissions not graded yet
+        self.lock = threading.Lock()
+        self.threads = [] # the threads talking to workers
+        self.server = socket.create_server(address)
+        self.address = self.server.getsockname()[:2]
+
+    def run(self):
+        '''Grades the submissions on the workers that connect, and yields
+           (submission, row) for each of them, in the order of submissions.
+        '''
+        threading.Thread(target=self.__accept, daemon=True).start()
+        rows = {}
+        try:
+            for next_index in range(len(self.submissions)):
+                while next_index not in rows:
+                    (index, row) = self.results.get()
+                    rows[index] = row
+                yield (self.submissions[next_index], rows.pop(next_index))
+        finally:
+            self.server.close()
+            for thread in self.threads: # let them tell their workers they are done
+                thread.join(timeout=5)
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def __accept(self):
+        while True:
+            try:
+                (conn, peer) = self.server.accept()
+            except OSError: # closed by run()
+                return
+            thread = threading.Thread(target=self.__serve, args=(conn, peer), daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def __serve(self, conn, peer):
+        '''Talks to one worker until there is nothing left to grade.'''
+        index = None
+        with conn, conn.makefile('rb') as reader:
+            try:
+                (hello, _) = receive_message(reader, self.work_dir)
+                if hello.get("type") != "hello" \
+                        or not hmac.compare_digest(str(hello.get("token")), self.token):
+                    print("Refused worker %s:%s (wrong token)" % peer[:2])
+                    return
+                print("Worker %s connected from %s:%s" % ((hello.get("name"),) + peer[:2]))
+                send_message(conn, {"type": "suite", "options": self.options
+                                   , "test_directory": self.test_directory}, self.suite_path)
+                while True:
+                    index = self.__next_submission()
+                    if index is None:
+                        send_message(conn, {"type": "done"})
+                        return
+                    self.__send_submission(conn, index)
+                    (result, _) = receive_message(reader, self.work_dir)
+                    self.__finish(index, result["row"])
+                    index = None
+            except (OSError, EOFError, ValueError, KeyError) as err:
+                print("Lost worker %s:%s (%s)" % (peer[:2] + (err,)))
+            finally:
+                if index is not None: # give it to another worker
+                    self.pending.put(index)
+
+    def __next_submission(self):
+        '''The index of a submission to grade, or None once all are graded.
+           Waits while the last submissions are graded by other workers, which
+           may still disconnect.
+        '''
+        index = self.pending.get()
+        if index is None: # all graded: wake up the next thread waiting
+            self.pending.put(None)
+        return index
+
+    def __send_submission(self, conn, index):
+        submission = self.submissions[index]
+        name = os.path.basename(os.path.normpath(submission))
+        # the path names the submission between runs (the worker gets a new copy)
+        header = {"type": "submission", "id": index, "name": name
+                 , "path": os.path.abspath(submission)}
+        if os.path.isdir(submission):
+            archive_path = os.path.join(self.work_dir, "submission-%d.tar" % index)
+            pack_directory(archive_path, [(submission, name)])
+            try:
+                send_message(conn, dict(header, kind="dir"), archive_path)
+            finally:
+                os.remove(archive_path)
+        else:
+            send_message(conn, dict(header, kind="file"), submission)
+
+    def __finish(self, index, row):
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.pending.put(None)
+        self.results.put((index, row))
+
+
+def run_worker(address, token, setup, grade, name=None):
+    '''Connects to the coordinator at address (host, port) and grades the
+       submissions it sends until it is done: setup(test_directory, srcdir,
+       options, name) is called with the test suite received (and name, its
+       path on the coordinator), then grade(path,
+       submission_name) for each submission (the path of its copy, and its
+       path on the coordinator), which returns its row of the results table.
+    '''
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while True:
+        try:
+            conn = socket.create_connection(address)
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+    work_dir = tempfile.mkdtemp(prefix="worker-")
+    try:
+        with conn, conn.makefile('rb') as reader:
+            send_message(conn, {"type": "hello", "token": token
+                               , "name": name or "%s/%d" % (socket.gethostname(), os.getpid())})
+            (suite, suite_path) = receive_message(reader, work_dir)
+            suite_dir = os.path.join(work_dir, "suite")
+            unpack_archive(suite_path, suite_dir)
+            os.remove(suite_path)
+            srcdir = os.path.join(suite_dir, "src")
+            os.makedirs(srcdir, exist_ok=True)
+            setup(os.path.join(suite_dir, "test-cases"), srcdir, suite["options"]
+                 , suite.get("test_directory"))
+            while True:
+                (message, payload_path) = receive_message(reader, work_dir)
+                if message["type"] == "done":
+                    return
+                submission_dir = tempfile.mkdtemp(prefix="submission-", dir=work_dir)
+                try:
+                    submission = os.path.join(submission_dir, message["name"])
+                    if message["kind"] == "dir":
+                        unpack_archive(payload_path, submission_dir)
+                        os.remove(payload_path)
+                    elif payload_path is None: # an empty file
+                        open(submission, 'wb').close()
+                    else:
+                        os.replace(payload_path, submission)
+                    row = grade(submission, message.get("path", message["name"]))
+                finally:
+                    shutil.rmtree(submission_dir, ignore_errors=True)
+                send_message(conn, {"type": "result", "id": message["id"], "row": row})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,147 @@
+######################################################################
+#   File: Reporters.py
+#
+#   Description:
+#       Machine-readable reports of test runs. A reporter is given each
+#       test as soon as its result is printed (see TestSuite.run_tests),
+#       and writes it to its file straight away, so that a run that
+#       crashed or was stopped still leaves the results of the tests
+#       that finished.
+#
+#   Included functions:
+#       - test_record()
+#
+#   Included classes:
+#       - Reporter() base class: report() each test, then close().
+#       - JsonLinesReporter() writes one JSON object per test.
+#       - JUnitReporter() writes a JUnit XML file, which is valid XML
+#       after every test.
+#
+######################################################################
+
+import json
+import re
+from xml.sax.saxutils import escape, quoteattr
+
+# number of characters of an error message or diff kept in a report
+TEXT_LIMIT = 64 * 1024
+# number of lines of a diff kept in a record, and characters kept per line
+DIFF_LINES = 10
+DIFF_LINE_LIMIT = 1000
+
+
+def truncate(text, limit=TEXT_LIMIT):
+    if len(text) > limit:
+        return text[:limit] + "\n... (truncated)\n"
+    return text
+
+
+def test_record(script_name, test_case):
+    '''The result of a test as a dictionary of JSON values: its result,
+       the resources used, the start of each diff and the paths of the
+       files involved.
+    '''
+    record = {
+        "script": script_name,
+        "test": test_case.name,
+        "result": test_case.get_result_str(),
+        "code": test_case.result,
+        "wall_time": test_case.wall_time,
+        "user_time": test_case.user_time,
+        "sys_time": test_case.sys_time,
+        "max_rss": test_case.max_rss,
+    }
+    if test_case.is_err():
+        (exitstatus, errdata, err_file, stdout_file) = test_case.result_details
+        record.update(exit_status=exitstatus, message=truncate(test_case.err_msg())
+                     , err_file=err_file, stdout_file=stdout_file)
+    elif test_case.is_fail():
+        details = test_case.result_details
+        record["diffs"] = []
+        for (output_file, (softtest_diffs, hardtest_diffs, actual_path, exp_path)) \
+                in sorted(details.match_result.items()):
+            diff = softtest_diffs or hardtest_diffs
+            record["diffs"].append({
+                "file": output_file,
+                "kind": "fail" if softtest_diffs else "presentation",
+                "lines": ["binary files differ\n"] if isinstance(diff, bytes)
+                         else [truncate(line, DIFF_LINE_LIMIT) for line in diff[:DIFF_LINES]],
+                "output": actual_path,
+                "expected": exp_path,
+            })
+        record["extra_outputs"] = sorted(details.extra_outputs())
+        record["missing_outputs"] = sorted(details.missing_outputs())
+    return record
+
+
+class Reporter:
+    '''Base class of the reporters: writes to path, one test at a time.'''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def report(self, script_name, test_case):
+        raise NotImplementedError
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesReporter(Reporter):
+    '''Writes the test_record() of each test as a line of JSON.'''
+    def report(self, script_name, test_case):
+        self.file.write(json.dumps(test_record(script_name, test_case)) + "\n")
+        self.file.flush()
+
+
+class JUnitReporter(Reporter):
+    '''Writes the tests as a JUnit XML file: a testsuite per script, a
+       testcase per test, with a failure (fail and presentation error) or an
+       error (runtime error and exceeded limits) element. The closing tags
+       are rewritten after every test, so that the file is always valid XML.
+    '''
+    # characters that are not allowed in XML 1.0
+    INVALID_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+    def __init__(self, path):
+        Reporter.__init__(self, path)
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n<testsuites>\n')
+        self.script_name = None
+        self.end = self.file.tell()
+        self.__write_closing()
+
+    def report(self, script_name, test_case):
+        self.file.seek(self.end)
+        self.file.truncate()
+        if script_name != self.script_name:
+            if self.script_name is not None:
+                self.file.write('  </testsuite>\n')
+            self.file.write('  <testsuite name=%s>\n' % quoteattr(script_name))
+            self.script_name = script_name
+        self.file.write(self.__testcase(script_name, test_case))
+        self.end = self.file.tell()
+        self.__write_closing()
+
+    def __write_closing(self):
+        if self.script_name is not None:
+            self.file.write('  </testsuite>\n')
+        self.file.write('</testsuites>\n')
+        self.file.flush()
+
+    def __testcase(self, script_name, test_case):
+        attributes = 'classname=%s name=%s' % (quoteattr(script_name), quoteattr(test_case.name))
+        if test_case.wall_time is not None:
+            attributes += ' time="%.3f"' % test_case.wall_time
+        if test_case.is_pass():
+            return '    <testcase %s/>\n' % attributes
+        result = test_case.get_result_str()
+        if test_case.is_err():
+            element = "error"
+            text = test_case.err_msg()
+        else:
+            element = "failure"
+            text = test_case.result_details.to_string()
+        text = JUnitReporter.INVALID_XML.sub("?", truncate(text))
+        return '    <testcase %s>\n      <%s message=%s type=%s>%s</%s>\n    </testcase>\n' \
+            % (attributes, element, quoteattr(result), quoteattr(result), escape(text), element)
+
@@ -0,0 +1,223 @@
+######################################################################
+#   File: ResultCache.py
+#
+#   Description:
+#       Keeps the result of the last run of every test, so that running
+#       the tests again only runs the tests whose submission, inputs,
+#       resources, expected outputs or configuration changed.
+#
+#   Included functions:
+#       - file_digest(), private_dir(), cache_dir(), result_to_json(),
+#         result_from_json()
+#
+#   Included classes:
+#       - ResultCache() stores the result, the resources used and the
+#       digests of the files written to Outputs and Errors (which are
+#       kept in an ArtifactStore) by the last run of each test, under a
+#       key hashing everything the result depends on (including the
+#       source of the test center itself).
+#
+######################################################################
+
+import base64
+import getpass
+import glob
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import diffs
+from TestCase import MatchResult
+
+#  The caches of the test center are kept in directories of CACHE_ROOT (see
+#  cache_dir()), which belongs to the user running it and no one else may
+#  write to: what is read from them is trusted (results, executables, ...).
+CACHE_ROOT = os.path.join(tempfile.gettempdir(), "testcenter-%s"
+                          % (os.getuid() if hasattr(os, "getuid") else getpass.getuser()))
+
+
+def private_dir(path):
+    '''Creates the directory path (its parent must exist) readable and
+       writable by the user only, and returns path. Raises OSError if it
+       exists but is not a directory of the user that only the user may
+       write to, as another user may have put files in it.
+    '''
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) \
+            or (hasattr(os, "getuid") and info.st_uid != os.getuid()) \
+            or (os.name == "posix" and info.st_mode & 0o022):
+        raise PermissionError("%s is not a private directory of the user" % path)
+    return path
+
+
+def cache_dir(name):
+    '''The private directory CACHE_ROOT/name of a cache, created if needed
+       (see private_dir(), which raises OSError if it cannot be trusted).
+    '''
+    return private_dir(os.path.join(private_dir(CACHE_ROOT), name))
+
+
+def result_to_json(value):
+    '''The result details of a test (see TestCase.result_details) as JSON
+       values: bytes, tuples, diff files and MatchResults are written as
+       objects with a single key naming their type.
+    '''
+    if isinstance(value, bytes):
+        return {"bytes": base64.b64encode(value).decode()}
+    if isinstance(value, tuple):
+        return {"tuple": [result_to_json(item) for item in value]}
+    if isinstance(value, list):
+        return [result_to_json(item) for item in value]
+    if isinstance(value, diffs.DiffLines):
+        return {"diff_lines": [value.filename, value.count]}
+    if isinstance(value, MatchResult):
+        return {"match_result": {"files": {name: result_to_json(match)
+                                           for (name, match) in value.match_result.items()}
+                                , "unmatched_output_files": list(value.unmatched_output_files)
+                                , "unmatched_exp_files": list(value.unmatched_exp_files)}}
+    return value
+
+
+def result_from_json(value):
+    '''The inverse of result_to_json(). Raises ValueError on values it
+       did not write.
+    '''
+    if isinstance(value, list):
+        return [result_from_json(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    ((kind, data),) = value.items()
+    if kind == "bytes":
+        return base64.b64decode(data)
+    if kind == "tuple":
+        return tuple(result_from_json(item) for item in data)
+    if kind == "diff_lines":
+        return diffs.DiffLines(*data)
+    if kind == "match_result":
+        match_result = MatchResult()
+        match_result.match_result = {name: result_from_json(match)
+                                     for (name, match) in data["files"].items()}
+        match_result.unmatched_output_files = tuple(data["unmatched_output_files"])
+        match_result.unmatched_exp_files = tuple(data["unmatched_exp_files"])
+        return match_result
+    raise ValueError("unknown value %r in a stored result" % kind)
+
+
+def file_digest(path):
+    '''SHA-256 digest of the contents of a file.'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+class ResultCache:
+    #  The last result of a test is stored as JSON in <cache>/CACHE_NAME/<test>.json
+    #  (see cache_dir()), where <test> is a hash of its name and output directory.
+    CACHE_NAME = "results"
+    VERSION = 3
+
+    #  Changing any of these files invalidates all results
+    HARNESS_FILES = ("TestCase.py", "TestSuite.py", "diffs.py", "WarmRunner.py", "ResultCache.py"
+                    , "ExpectedCache.py", "Sandbox.py", "ArtifactStore.py")
+
+    #  Attributes of a TestCase restored from the cache (with result_details,
+    #  see result_to_json())
+    RESULT_ATTRIBUTES = ("result", "wall_time", "user_time", "sys_time", "max_rss")
+
+    def __init__(self, submission_files, settings, artifact_store):
+        '''submission_files are the files of the submission (sources, or
+           executables and scripts); settings is a tuple of the options of
+           the run that affect the results (timeout, output limit, ...);
+           artifact_store is the ArtifactStore the tests keep their files in.
+        '''
+        self.artifact_store = artifact_store
+        digest = hashlib.sha256(("%s\0%r\0" % (ResultCache.VERSION, settings)).encode())
+        harness_dir = os.path.dirname(os.path.abspath(__file__))
+        for name in ResultCache.HARNESS_FILES:
+            digest.update(file_digest(os.path.join(harness_dir, name)))
+        for path in sorted(submission_files, key=os.path.basename):
+            digest.update(os.path.basename(path).encode() + b"\0" + file_digest(path))
+        self.digest = digest.digest()
+
+    def key(self, test_case):
+        '''The key of the result of test_case: a hash of the submission,
+           the settings, and the files and configuration of the test.
+        '''
+        digest = hashlib.sha256(self.digest)
+        digest.update(("%s\0%s\0%r\0" % (test_case.script_name, test_case.name
+            , (test_case.compare, test_case.abs_tol, test_case.rel_tol
+              , test_case.cpu_limit, test_case.memory_limit))).encode())
+        files = [("input-" + test_type, path) for (test_type, path) in test_case.inputs] \
+              + [("resource", path) for path in test_case.resources] \
+              + [("expected-" + test_type, path) for (test_type, path) in test_case.exp_files]
+        for (role, path) in files:
+            digest.update(("%s\0%s\0" % (role, os.path.basename(path))).encode())
+            digest.update(file_digest(path))
+        return digest.hexdigest()
+
+    def load(self, test_case, key):
+        '''Restores the result of test_case (and its files in Outputs and
+           Errors, from the artifact store) if it was stored under key.
+           Returns whether it was.
+        '''
+        try:
+            with open(self.__record_path(test_case)) as record_file:
+                record = json.load(record_file)
+            if record["version"] != ResultCache.VERSION or record["key"] != key:
+                return False
+            details = result_from_json(record["result_details"])
+            for path in ResultCache.__test_files(test_case):
+                os.remove(path)
+            artifacts = {}
+            for (folder, name, digest) in record["files"]:
+                dest = os.path.join(test_case.output_path if folder == "Outputs"
+                                    else test_case.err_path, name)
+                self.artifact_store.link(digest, dest)
+                artifacts[dest] = digest
+        except (OSError, ValueError, KeyError, TypeError): # written by another version
+            return False
+        for attribute in ResultCache.RESULT_ATTRIBUTES:
+            setattr(test_case, attribute, record[attribute])
+        test_case.result_details = details
+        test_case.artifacts = artifacts
+        return True
+
+    def save(self, test_case, key):
+        '''Stores the result of test_case (just run) under key.'''
+        record = {attribute: getattr(test_case, attribute) for attribute in ResultCache.RESULT_ATTRIBUTES}
+        record.update(key=key, version=ResultCache.VERSION, files=[]
+                     , result_details=result_to_json(test_case.result_details))
+        for (path, digest) in test_case.artifacts.items():
+            if digest is None: # not in the store: the result cannot be restored
+                return
+            folder = "Outputs" if os.path.dirname(path) == test_case.output_path else "Errors"
+            record["files"].append((folder, os.path.basename(path), digest))
+        try:
+            (fd, tmp_path) = tempfile.mkstemp(dir=cache_dir(ResultCache.CACHE_NAME), suffix=".tmp")
+            with os.fdopen(fd, 'w') as record_file:
+                json.dump(record, record_file)
+            os.replace(tmp_path, self.__record_path(test_case))
+        except OSError: # the cache is only an optimization
+            pass
+
+    @staticmethod
+    def __record_path(test_case):
+        identity = "%s\0%s\0%s" % (os.path.abspath(test_case.output_path)
+                                   , test_case.script_name, test_case.name)
+        return os.path.join(cache_dir(ResultCache.CACHE_NAME)
+                            , hashlib.sha256(identity.encode()).hexdigest() + ".json")
+
+    @staticmethod
+    def __test_files(test_case):
+        '''The files of a test in Outputs and Errors (see TestCase.run_test).'''
+        output_prefix = os.path.join(test_case.output_path, test_case.name)
+        err_prefix = os.path.join(test_case.err_path, test_case.name)
+        return glob.glob(output_prefix + "-*") + glob.glob(output_prefix + ".*") \
+             + glob.glob(err_prefix + "-*") + glob.glob(err_prefix + ".*")
@@ -0,0 +1,331 @@
+######################################################################
+#   File: Sandbox.py
+#
+#   Description:
+#       Limits what the processes of a test can do to the machine that
+#       grades it, so that a fork bomb or a memory hog fails its own
+#       test instead of taking down the other tests (or the machine).
+#       Only used when asked for (--sandbox); POSIX only.
+#
+#   Included classes:
+#       - Sandbox() the limits applied to every process of a test:
+#       resource limits (address space, processes, open files), a
+#       network namespace without any network where unprivileged
+#       namespaces are available, and a cgroup per test (memory and
+#       number of processes of the test as a whole) when a delegated
+#       cgroup v2 directory is given.
+#
+#   Included functions:
+#       - limited_command(), apply_limits()
+#
+#       The limits of every test (those of the sandbox, and the output,
+#       CPU and memory limits of the test) are applied by helper programs
+#       the command of the test is run through, never in the forked child
+#       of the test center (see limited_command()).
+#
+######################################################################
+
+import ctypes
+import itertools
+import json
+import os
+import shutil
+import signal
+import sys
+import time
+from subprocess import run, DEVNULL, SubprocessError
+try:
+    import resource # not available on Windows
+except ImportError:
+    resource = None
+
+# flags of unshare(2)
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWNET = 0x40000000
+
+# the helper programs of util-linux applying limits before executing a command
+PRLIMIT = shutil.which("prlimit")
+UNSHARE = shutil.which("unshare")
+# the limits the ulimit of the shell sets where prlimit is missing (e.g. on
+# macOS): its option, and the unit of its values in bytes (seconds for cpu)
+SHELL_LIMITS = {"fsize": ("-f", 512), "cpu": ("-t", 1), "data": ("-d", 1024)
+               , "as": ("-v", 1024), "nofile": ("-n", 1)}
+
+
+def limited_command(command, limits=(), cgroup=None, unshare_flags=0):
+    '''The command running command (a list) with the resource limits
+       (name, soft, hard), where name is that of a RLIMIT_<NAME> constant in
+       lower case (as prlimit names them), in cgroup (a directory made by
+       Sandbox.create_cgroup()) and in the namespaces of unshare_flags.
+
+       Python cannot safely apply them in the child it forks (preexec_fn)
+       while other threads run, as they do in a pool of tests, so the
+       command is run through prlimit and unshare, which apply them and
+       execute the next program. Where prlimit is missing, the shell sets
+       the limits it can (those of the tests outside the sandbox), rounded
+       up to its units; otherwise this file is run as a script to do the
+       same (starting an interpreter for every test).
+    '''
+    limits = _clamped(limits)
+    if resource is None or not (limits or cgroup or unshare_flags):
+        return list(command)
+    if PRLIMIT is None and not (cgroup or unshare_flags) \
+            and all(name in SHELL_LIMITS for (name, soft, hard) in limits):
+        return _shell_command(command, limits)
+    if PRLIMIT is None or (unshare_flags and UNSHARE is None):
+        settings = {"limits": limits, "cgroup": cgroup, "unshare_flags": unshare_flags}
+        return [sys.executable, "-I", "-S", os.path.abspath(__file__), json.dumps(settings)
+               , "--"] + list(command)
+    wrapper = []
+    if cgroup:
+        # the shell moves itself into the cgroup, then becomes the next program
+        wrapper += ["/bin/sh", "-c", 'echo 0 > "$0" && exec "$@"'
+                   , os.path.join(cgroup, "cgroup.procs")]
+    if limits:
+        wrapper += [PRLIMIT] + ["--%s=%d:%d" % limit for limit in limits] + ["--"]
+    if unshare_flags:
+        wrapper += [UNSHARE] + (["--user"] if unshare_flags & CLONE_NEWUSER else []) \
+                 + (["--net"] if unshare_flags & CLONE_NEWNET else []) + ["--"]
+    return wrapper + list(command)
+
+
+def apply_limits(limits=(), cgroup=None, unshare_flags=0):
+    '''Applies the limits of limited_command() to the calling process (and
+       the processes it starts), which must not have other threads.
+    '''
+    if cgroup:
+        with open(os.path.join(cgroup, "cgroup.procs"), "w") as procs:
+            procs.write("0") # the calling process
+    if resource is not None:
+        for (name, soft, hard) in _clamped(limits):
+            resource.setrlimit(getattr(resource, "RLIMIT_" + name.upper()), (soft, hard))
+    if unshare_flags:
+        _unshare(unshare_flags)
+
+
+def _clamped(limits):
+    '''The limits (name, soft, hard), lowered to the hard limits of the
+       calling process where they are above (only root may raise them),
+       without those in effect already.
+    '''
+    if resource is None:
+        return []
+    clamped = []
+    for (name, soft, hard) in limits:
+        current = resource.getrlimit(getattr(resource, "RLIMIT_" + name.upper()))
+        if current[1] != resource.RLIM_INFINITY:
+            (soft, hard) = (min(soft, current[1]), min(hard, current[1]))
+        if (soft, hard) != current:
+            clamped.append((name, soft, hard))
+    return clamped
+
+
+def _shell_command(command, limits):
+    '''The command running command with limits set by the shell (see
+       SHELL_LIMITS), rounded up to its units.
+    '''
+    settings = []
+    for (name, soft, hard) in limits:
+        (option, unit) = SHELL_LIMITS[name]
+        # the soft limit first: it is below the hard limit of the shell
+        for (kind, value) in (("-S", soft), ("-H", hard)):
+            value = "unlimited" if value == resource.RLIM_INFINITY else -(-value // unit)
+            settings.append("ulimit %s %s %s" % (kind, option, value))
+    return ["/bin/sh", "-c", " && ".join(settings + ['exec "$@"']), "sh"] + list(command)
+
+
+def _unshare(flags):
+    if hasattr(os, "unshare"): # Python 3.12
+        os.unshare(flags)
+        return
+    libc = ctypes.CDLL(None, use_errno=True) # the C library is loaded already
+    if libc.unshare(flags) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+class Sandbox:
+    MEMORY_DEFAULT = 4096 * 1024 * 1024 # bytes of address space of each process
+    PROCESSES_DEFAULT = 64              # processes each test may have at a time
+    OPEN_FILES_DEFAULT = 256            # files each process may have open
+
+    #  Environment variable naming the delegated cgroup v2 directory in which
+    #  the cgroups of the tests are created (when it is not given)
+    CGROUP_ENV = "TESTCENTER_CGROUP"
+
+    __cgroup_numbers = itertools.count()
+
+    def __init__(self, memory=MEMORY_DEFAULT, processes=PROCESSES_DEFAULT
+                , open_files=OPEN_FILES_DEFAULT, network=False, cgroup_parent=None):
+        '''memory is the address space of each process (and the memory of
+           the cgroup of a test) in bytes, processes the number of processes
+           a test may have at a time, and open_files the number of files each
+           process may have open. Unless network is True, tests run in a
+           network namespace of their own where it is available.
+           cgroup_parent is a cgroup v2 directory the user may create cgroups
+           in (default: $TESTCENTER_CGROUP); without it no cgroups are used.
+        '''
+        self.memory = memory
+        self.processes = processes
+        self.open_files = open_files
+        self.network = network
+        cgroup_parent = cgroup_parent or os.environ.get(Sandbox.CGROUP_ENV)
+        self.cgroup_parent = cgroup_parent if cgroup_parent \
+            and os.access(os.path.join(cgroup_parent, "cgroup.procs"), os.W_OK) else None
+        # the controllers enabled for the cgroups of the tests
+        self.cgroup_controllers = set()
+        if self.cgroup_parent:
+            try:
+                with open(os.path.join(self.cgroup_parent, "cgroup.subtree_control")) as control:
+                    self.cgroup_controllers = set(control.read().split())
+            except OSError:
+                pass
+        self.unshare_flags = 0
+        if not network and sys.platform.startswith("linux"):
+            self.unshare_flags = CLONE_NEWNET if self.__is_root() else CLONE_NEWUSER | CLONE_NEWNET
+            if not self.__can_unshare():
+                self.unshare_flags = 0
+
+    def settings(self):
+        '''The limits as a dictionary of JSON values.'''
+        return {"memory": self.memory, "processes": self.processes
+               , "open_files": self.open_files, "unshare_flags": self.unshare_flags}
+
+    def describe(self):
+        '''One line describing the limits that are in effect.'''
+        text = "Sandbox: %d MB of address space, %d open files" \
+            % (self.memory // (1024 * 1024), self.open_files)
+        if "pids" in self.cgroup_controllers:
+            text += ", %d processes per test" % self.processes
+        elif self.__is_root():
+            text += ", processes not limited (root is not limited by RLIMIT_NPROC;" \
+                    " give a cgroup with the pids controller)"
+        else:
+            text += ", %d processes (for all the tests running at a time, as the limit" \
+                    " counts all the processes of the user; give a cgroup with the pids" \
+                    " controller for a limit per test)" % self.processes
+        if self.unshare_flags:
+            text += ", no network"
+        if self.cgroup_parent:
+            text += ", a cgroup per test in %s" % self.cgroup_parent
+        return text
+
+    def process_limit(self):
+        '''The value of RLIMIT_NPROC giving a test self.processes processes:
+           the limit counts all the processes of the user, so the processes
+           the user is running already are added to it.
+        '''
+        uid = os.getuid()
+        running = 0
+        for pid in os.listdir("/proc") if os.path.isdir("/proc") else ():
+            try:
+                running += pid.isdigit() and os.stat(os.path.join("/proc", pid)).st_uid == uid
+            except OSError: # the process ended
+                pass
+        return running + self.processes
+
+    def limits(self, cgroup=None):
+        '''The resource limits of every process of a test (see
+           limited_command()) running in cgroup (see create_cgroup()). The
+           number of processes is limited by RLIMIT_NPROC only when the
+           cgroup cannot limit it (pids.max), and the user is not root.
+        '''
+        limits = [("as", self.memory, self.memory), ("nofile", self.open_files, self.open_files)]
+        if not (cgroup and os.path.exists(os.path.join(cgroup, "pids.max"))) \
+                and not self.__is_root():
+            process_limit = self.process_limit()
+            limits.append(("nproc", process_limit, process_limit))
+        return limits
+
+    def create_cgroup(self, memory=None):
+        '''Creates the cgroup of a test, limited to memory bytes (default:
+           self.memory) and self.processes processes, and returns its directory
+           (None if the sandbox uses no cgroups, or the cgroup could not be
+           created).
+        '''
+        if self.cgroup_parent is None:
+            return None
+        memory = memory or self.memory
+        cgroup = os.path.join(self.cgroup_parent, "testcenter-%d-%d"
+                              % (os.getpid(), next(Sandbox.__cgroup_numbers)))
+        try:
+            os.mkdir(cgroup)
+            for (name, value) in (("memory.max", memory), ("memory.swap.max", 0)
+                                 , ("pids.max", self.processes)):
+                if os.path.exists(os.path.join(cgroup, name)): # if the controller is enabled
+                    with open(os.path.join(cgroup, name), "w") as control:
+                        control.write(str(value))
+        except OSError:
+            self.remove_cgroup(cgroup)
+            return None
+        return cgroup
+
+    def memory_peak(self, cgroup):
+        '''The peak memory of the cgroup of a test in bytes (None if the
+           kernel does not keep it: before Linux 5.19, or without the memory
+           controller).
+        '''
+        try:
+            with open(os.path.join(cgroup, "memory.peak")) as peak:
+                return int(peak.read())
+        except (OSError, ValueError):
+            return None
+
+    def remove_cgroup(self, cgroup):
+        '''Kills the processes left in the cgroup of a test and removes it.
+           Returns whether the kernel killed a process of the test because the
+           cgroup ran out of memory.
+        '''
+        oom_kills = 0
+        try:
+            with open(os.path.join(cgroup, "memory.events")) as events:
+                for line in events:
+                    (name, count) = line.split()
+                    if name == "oom_kill":
+                        oom_kills = int(count)
+        except (OSError, ValueError):
+            pass
+        for attempt in range(50):
+            try:
+                with open(os.path.join(cgroup, "cgroup.kill"), "w") as kill:
+                    kill.write("1")
+            except OSError: # before Linux 5.14: kill the processes one by one
+                try:
+                    with open(os.path.join(cgroup, "cgroup.procs")) as procs:
+                        for pid in procs.read().split():
+                            os.kill(int(pid), signal.SIGKILL)
+                except OSError:
+                    pass
+            try:
+                os.rmdir(cgroup)
+                break
+            except FileNotFoundError:
+                break
+            except OSError: # the processes killed have not ended yet
+                time.sleep(0.01)
+        return oom_kills > 0
+
+    @staticmethod
+    def __is_root():
+        return hasattr(os, "geteuid") and os.geteuid() == 0
+
+    def __can_unshare(self):
+        '''Whether the namespaces of unshare_flags can be created here.'''
+        try:
+            command = limited_command([sys.executable, "-c", ""], unshare_flags=self.unshare_flags)
+            return run(command, stdout=DEVNULL, stderr=DEVNULL).returncode == 0
+        except (OSError, SubprocessError):
+            return False
+
+
+if __name__ == "__main__":
+    # run by limited_command() where the helper programs are missing:
+    # <settings> -- <command>
+    settings = json.loads(sys.argv[1])
+    apply_limits(settings["limits"], settings["cgroup"], settings["unshare_flags"])
+    command = sys.argv[3:]
+    try:
+        os.execvp(command[0], command)
+    except OSError as err:
+        print("Cannot execute %s: %s" % (command[0], err), file=sys.stderr)
+        sys.exit(127)
@@ -9,6 +9,8 @@
 #       tests.
 #       - MatchResult() used to determine results (differences between
 #       student and expected output) and display quick difference output.
+#       - AccountedProcess() the process of a test, reaped with os.wait4
+#       to measure the resources it used.
 #
 ######################################################################
 
@@ -18,14 +20,21 @@ import signal
 import myplatform
 import glob
 import shutil
+import shlex
+import select
 import distutils.dir_util
 import tempfile
 import sys
 import time
-from subprocess import Popen, PIPE, TimeoutExpired, run
-import mimetypes
+import math
+from subprocess import Popen, TimeoutExpired, run
+try:
+    import resource # not available on Windows
+except ImportError:
+    resource = None
 import diffs
 import logging
+from Sandbox import limited_command
 
 def verbose(*args):
     print('-' * 80)
@@ -39,10 +48,13 @@ def quiet(*args):
 trace = quiet # nullifies debug output
 
 class MatchResult:
+    # the results of all the tests stay in memory (of every submission, in the GUI)
+    __slots__ = ("match_result", "unmatched_output_files", "unmatched_exp_files")
+
     def __init__(self):
         self.match_result = dict() # maps output files to pairs of soft-test and hard-test differences
-        self.unmatched_output_files = set()
-        self.unmatched_exp_files    = set()
+        self.unmatched_output_files = () # sets while the outputs are compared, then tuples
+        self.unmatched_exp_files    = ()
         
     def add_match_result(self,output_file,match_info):
         '''Stores the result of a match
@@ -88,6 +100,10 @@ Symbol Legend:
 +       you output this line but it was not expected
 ?       highlights the exact change in a line 
         using + or - if applicable
+@@ -5,7 +5,6 @@
+        the lines around a difference: 7 lines of
+        the expected output from line 5, and 6
+        lines of your output from line 5
 #       for Presentation Error only: spaces and
         newlines display visibly as #
 
@@ -113,12 +129,119 @@ Symbol Legend:
         return self.unmatched_exp_files
 
 
+class AccountedProcess:
+    '''A process started by Popen, which this class reaps itself with
+       os.wait4 (where available) so that its resource usage is kept in
+       rusage. Popen never waits for it. Supports the parts of the Popen
+       interface used by TestCase (pid, poll(), wait() and kill()), as
+       WarmRunner.WarmProcess does.'''
+    #  Seconds between the checks of a process that is waited for with a
+    #  timeout, where the kernel cannot tell when it ends (no pidfd)
+    POLL_INTERVAL = 0.01
+    #  Exit status of a process whose status was lost (reaped by someone else)
+    LOST_STATUS = 255
+
+    def __init__(self, popen):
+        self.popen = popen
+        self.pid = popen.pid
+        self.returncode = None
+        self.rusage = None
+        self.status_lost = False
+        # the peak memory of the test center, from which the process was forked
+        # (see TestCase.__record_usage), in the units of ru_maxrss
+        self.parent_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss \
+            if resource is not None else None
+
+    def poll(self):
+        '''The exit status once wait() returned it (None before).'''
+        return self.returncode
+
+    def kill(self):
+        if hasattr(os, "killpg"): # the process leads a session of its own
+            os.killpg(self.pid, signal.SIGKILL)
+        else:
+            self.popen.kill()
+
+    def wait(self, timeout=None):
+        '''Waits for the process to end and returns its exit status; raises
+           TimeoutExpired if it is still running after timeout seconds.'''
+        if self.returncode is not None:
+            return self.returncode
+        if not hasattr(os, "wait4"):
+            self.returncode = self.popen.wait(timeout)
+            return self.returncode
+        if timeout is None or not self.__wait_exit(timeout):
+            self.__reap(0)
+        return self.returncode
+
+    def __wait_exit(self, timeout):
+        '''Waits for the process to end (or raises TimeoutExpired) without
+           reaping it where possible. Returns whether it was reaped already.'''
+        pidfd = None
+        if hasattr(os, "pidfd_open"):
+            try:
+                pidfd = os.pidfd_open(self.pid)
+            except OSError: # before Linux 5.3
+                pass
+        if pidfd is not None:
+            try:
+                if not select.select([pidfd], [], [], timeout)[0]:
+                    raise TimeoutExpired(self.popen.args, timeout)
+            finally:
+                os.close(pidfd)
+            return False
+        deadline = time.monotonic() + timeout
+        while not self.__reap(os.WNOHANG):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutExpired(self.popen.args, timeout)
+            time.sleep(min(remaining, AccountedProcess.POLL_INTERVAL))
+        return True
+
+    def __reap(self, flags):
+        '''Reaps the process if it ended (waiting for it unless flags is
+           os.WNOHANG). Returns whether it was reaped.'''
+        try:
+            (pid, status, rusage) = os.wait4(self.pid, flags)
+        except ChildProcessError: # reaped by someone else: the test failed, as far as is known
+            self.status_lost = True
+            self.returncode = self.popen.returncode = AccountedProcess.LOST_STATUS
+            return True
+        if pid != self.pid:
+            return False
+        self.returncode = self.popen.returncode = os.waitstatus_to_exitcode(status)
+        self.rusage = rusage
+        return True
+
+
 # TODO: doesn't support multiple files passed in yet, also should handle
 # expected outputs here
 class TestCase:
+    __slots__ = ("name", "script_name", "exp_path", "output_path", "err_path", "assignment_name"
+                , "cli_files", "cli_args", "inputs", "exp_paths", "exp_files", "exp_text"
+                , "resources", "compare", "abs_tol", "rel_tol", "cpu_limit", "memory_limit"
+                , "wall_time", "user_time", "sys_time", "max_rss", "result", "result_details"
+                , "artifacts", "work_path", "command", "process", "output_log")
     
     # result of testing
-    TESTRESULT = (PASS, SOFTTEST_FAIL, HARDTEST_FAIL, ERR, TIMEOUT) = range(5)
+    TESTRESULT = (PASS, SOFTTEST_FAIL, HARDTEST_FAIL, ERR, TIMEOUT, OUTPUT_LIMIT
+                 , CPU_LIMIT, MEMORY_LIMIT) = range(8)
+    # results of tests stopped (or failed) for exceeding a limit
+    LIMIT_RESULTS = (TIMEOUT, OUTPUT_LIMIT, CPU_LIMIT, MEMORY_LIMIT)
+
+    # default maximum size of each file (stdout, stderr, ..) written by a test
+    OUTPUT_LIMIT_DEFAULT = 64 * 1024 * 1024
+    # number of bytes of stderr kept in memory for the error message
+    ERR_MSG_LIMIT = 64 * 1024
+    # what the end of stderr shows when an allocation failed (python, C++, C)
+    OUT_OF_MEMORY_ERRORS = (b"MemoryError", b"std::bad_alloc", b"Cannot allocate memory"
+                           , b"out of memory")
+
+    # ways of comparing text outputs (set by "compare" in the test configuration):
+    # exactly (up to whitespace), or as tokens with numbers compared within a tolerance
+    COMPARE_MODES = (TEXT_COMPARE, NUMERIC_COMPARE) = ("text", "numeric")
+    ABS_TOL_DEFAULT = 1e-6
+    REL_TOL_DEFAULT = 1e-5
 
     def __init__(self, name, script_name,exp_path,output_path,err_path):
         self.name = name
@@ -129,18 +252,35 @@ class TestCase:
         # name of assignment
         self.assignment_name = ''
         # inputs
-        self.stdin = ''     # standard input (read in during setup)
         self.cli_files = [] # list of files (with full path) available from command line
         self.cli_args = ''  # string holding the command line arguments
+        self.inputs = []    # (type, path) of each input file (stdin is read from its file when the test runs)
         # list of files holding expected results (stdout, stderr, ..):
         self.exp_paths = []
+        self.exp_files = [] # (type, path) of each expected file
+        self.exp_text = {}  # path -> (size, mtime, is text) of the expected files (see is_text_exp)
         # list of resource files:
         self.resources = []
+        # configuration (see set_config)
+        self.compare = TestCase.TEXT_COMPARE
+        self.abs_tol = TestCase.ABS_TOL_DEFAULT
+        self.rel_tol = TestCase.REL_TOL_DEFAULT
+        self.cpu_limit = None    # seconds of CPU time (None: no limit)
+        self.memory_limit = None # bytes of memory of each process (None: no limit)
+        # resources used by the last run: seconds of wall-clock, user and
+        # system time, and the peak resident memory in bytes (None if unknown)
+        self.wall_time = None
+        self.user_time = None
+        self.sys_time = None
+        self.max_rss = None
         self.result = None # one of TESTRESULT
         self.result_details = MatchResult() # When Error, the exitmsg, otherwise MatchResult
+        self.artifacts = {} # path -> digest of the files written to Outputs and Errors (see ArtifactStore)
 
         self.work_path = None
         self.command   = None
+        self.process   = None # the running process (while the test runs)
+        self.output_log = None # what the test printed (when run in a thread pool)
 
     def openExp(self):
         pass
@@ -149,35 +289,110 @@ class TestCase:
         return self.result==TestCase.SOFTTEST_FAIL or self.result==TestCase.HARDTEST_FAIL
 
     def is_err(self):
-        return self.result==TestCase.ERR or self.result==TestCase.TIMEOUT
+        return self.result == TestCase.ERR or self.result in TestCase.LIMIT_RESULTS
 
     def is_pass(self):
         return self.result==TestCase.PASS
 
+    def kill(self):
+        '''Kills the process of the test if it is still running.'''
+        process = self.process
+        if process is None or process.poll() is not None:
+            return
+        try:
+            if myplatform.is_linux():
+                os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError: # exited in the meantime
+            pass
+
     def reset_result(self):
         self.result = None
         self.result_details = None
+        self.wall_time = self.user_time = self.sys_time = self.max_rss = None
+        self.artifacts = {}
 
     def get_result_str(self):
         if self.result==None:
             return "N/A"
-        return ("Pass", "Fail", "Presentation Error", "Runtime Error", "Timeout Error")[self.result]
+        return ("Pass", "Fail", "Presentation Error", "Runtime Error", "Timeout Error"
+               , "Output Limit Exceeded", "CPU Time Limit Exceeded"
+               , "Memory Limit Exceeded")[self.result]
+
+    def get_usage_str(self):
+        '''The resources used by the last run, e.g. "0.52 s, CPU 0.48 s, 12.1 MB".'''
+        if self.wall_time is None:
+            return ""
+        usage = "%.2f s" % self.wall_time
+        if self.user_time is not None:
+            usage += ", CPU %.2f s" % (self.user_time + self.sys_time)
+        if self.max_rss is not None:
+            usage += ", %.1f MB" % (self.max_rss / (1024 * 1024))
+        return usage
 
     def add_input(self, test_type, input_path):
-        if test_type == 'stdin':
-            with open(input_path, 'r') as input_file:
-                self.stdin = str(''.join(input_file.readlines()))
-        elif test_type == 'args':
+        self.inputs.append((test_type, input_path))
+        # stdin is not read here: the script reads the file itself (see stdin_path)
+        if test_type == 'args':
             with open(input_path, 'r') as input_file: 
-                self.cli_args = str(''.join(input_file.readlines())).rstrip()
-        else:
+                self.cli_args = input_file.read().rstrip()
+        elif test_type != 'stdin':
             self.cli_files.append(os.path.abspath(input_path))
 
+    def stdin_path(self):
+        '''The absolute path of the file given on stdin, or None.'''
+        for (test_type, input_path) in self.inputs:
+            if test_type == 'stdin':
+                return os.path.abspath(input_path)
+        return None
+
+    def set_config(self, options):
+        '''Configures the test from a section of the test configuration file
+           (see TestSuite.TESTCONFIG_FILE): a mapping of option names to strings.
+        '''
+        self.compare = options.get("compare", TestCase.TEXT_COMPARE).strip().lower()
+        if self.compare not in TestCase.COMPARE_MODES:
+            raise RuntimeError("Unknown comparison \"%s\" for test %s; use one of: %s"
+                % (self.compare, self.name, ", ".join(TestCase.COMPARE_MODES)))
+        try:
+            self.abs_tol = float(options.get("abs_tol", TestCase.ABS_TOL_DEFAULT))
+            self.rel_tol = float(options.get("rel_tol", TestCase.REL_TOL_DEFAULT))
+        except ValueError as err:
+            raise RuntimeError("Invalid tolerance for test %s: %s" % (self.name, err))
+        try:
+            cpu_limit = options.get("cpu_limit")
+            self.cpu_limit = float(cpu_limit) if cpu_limit else None
+            memory_limit = options.get("memory_limit") # in MB
+            self.memory_limit = int(float(memory_limit) * 1024 * 1024) if memory_limit else None
+        except ValueError as err:
+            raise RuntimeError("Invalid limit for test %s: %s" % (self.name, err))
+
+    def tolerance(self):
+        '''The (absolute, relative) tolerance of numeric comparison, or None
+           when the outputs are compared as text.'''
+        if self.compare == TestCase.NUMERIC_COMPARE:
+            return (self.abs_tol, self.rel_tol)
+        return None
+
     def add_resource(self, resource):
         self.resources.append(resource)
 
     def add_exp_path(self, test_type, exp_path):
         self.exp_paths.append(exp_path)
+        self.exp_files.append((test_type, exp_path))
+
+    def is_text_exp(self, exp_path):
+        '''Returns whether the expected file exp_path holds text (see
+           diffs.is_text_file()). The answer is kept, and stored in the test
+           index, until the size or modification time of the file changes.
+        '''
+        stat = os.stat(exp_path)
+        (size, mtime, is_text) = self.exp_text.get(exp_path, (None, None, None))
+        if (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+            is_text = diffs.is_text_file(exp_path)
+            self.exp_text[exp_path] = (stat.st_size, stat.st_mtime_ns, is_text)
+        return is_text
 
     def get_cli(self):
         '''Get the command line arguments for this test'''
@@ -199,6 +414,12 @@ class TestCase:
             args = args_repl
         return args
 
+    def get_argv(self):
+        '''Get the command line arguments for this test as a list'''
+        if len(self.cli_args) == 0 and len(self.cli_files) == 1:
+            return [self.cli_files[0]]
+        return shlex.split(self.get_cli())
+
     def __copy_resources(self,work_path, print_cmd):
         '''Copy all resources from the resource directory
          to the working directory. 
@@ -214,30 +435,29 @@ class TestCase:
             res_basenames.append(pure_name)
         return res_basenames
 
-    def __copy_sourcefiles(self,script_path,work_path, up_dir, print_cmd):
-        '''Copy all files from the script source directory
-        to the working directory.
-        Return the names of files copied.
+    def __link_sourcefiles(self,staged,work_path, print_cmd):
+        '''Link the staged files of the submission (see
+        TestSuite.stage_submission_files) into the working directory,
+        falling back to a symbolic link or a copy where a hard link fails.
+        Return the names of files linked.
         '''
         basenames = []
-        if up_dir:
-            spath = os.path.join(os.path.dirname(script_path), '..', '*')
-        else:
-            spath = os.path.join(os.path.dirname(script_path), '*')
-        files = glob.glob(spath)
-        for filepath in files:
+        for filepath in staged:
             filename = os.path.basename(filepath)
             tofile = os.path.join(work_path,filename)
-            if os.path.isfile(filepath):
-                shutil.copyfile(filepath, tofile)
-                if print_cmd:
-                    print("Copying %s to %s" %(filename,tofile))
-                basenames.append(filename)
-
-        # print(basenames)
+            try:
+                os.link(filepath, tofile)
+            except OSError: # e.g. another file system
+                try:
+                    os.symlink(filepath, tofile)
+                except OSError:
+                    shutil.copy2(filepath, tofile)
+            if print_cmd:
+                print("Linking %s to %s" %(filename,tofile))
+            basenames.append(filename)
         return basenames
 
-    def __run_script(self,work_path,script_path,timeout,any_language,print_cmd=False):
+    def __run_script(self,work_path,script_path,timeout,any_language,print_cmd=False,staged=(),output_limit=None,runner=None,sandbox=None):
         """ Runs a test using the script. 
         
         Arguments:
@@ -245,6 +465,14 @@ class TestCase:
             timeout is the timeout per test case
             any_language is a boolean set to False if the script file has a .py extension
             print_cmd is the same as verbose in other files
+            staged lists the files of the submission to link into the work directory
+            output_limit is the maximum size (in bytes) of each file written by the script
+            runner is a WarmRunner used instead of a new interpreter for python scripts
+            sandbox is the Sandbox limiting the processes of the test (None: no limits)
+
+        Returns the paths of the files holding stdout and stderr, the reason
+        of the kill (empty if the script was not killed), the exit status and
+        the files linked into the work directory.
         """
 
         # Run the test with redirected streams
@@ -252,83 +480,188 @@ class TestCase:
         (base,ext) = os.path.splitext(script_path)
         if ext==".py": 
             any_language = False
-        command = '%s "%s" %s' % (interpreter_path, script_path, self.get_cli()) \
-            if not any_language else "%s %s" % (script_path, self.get_cli())
+        # the script is executed directly (without a shell)
+        command = ([script_path] if any_language else [interpreter_path, script_path]) \
+                + self.get_argv()
         extra_files_in_workpath = []
         if any_language:
-            # copy all files from the script_path to the work directory
-            extra_files_in_workpath = self.__copy_sourcefiles(script_path,work_path, False, print_cmd)
-            extra_files_in_workpath += self.__copy_sourcefiles(script_path, work_path, True, print_cmd)
+            # the files of the submission (and the prebuilt executables, which the
+            # build script only compiles when they are missing)
+            extra_files_in_workpath = self.__link_sourcefiles(staged, work_path, print_cmd)
             
         if print_cmd:
             print("From directory %s, on test-case %s, running command:\n%s"
-                % (work_path,self.name,command) 
+                % (work_path,self.name," ".join(shlex.quote(arg) for arg in command))
             )
         self.work_path = work_path
         self.command   = command
-        process = Popen(command, shell=True, stdin=PIPE
-                    , stdout=PIPE, stderr=PIPE, cwd=work_path
-                    , preexec_fn=os.setsid)
-        usePoll = False;
-        if usePoll:
-            process.stdin.write(bytes(self.stdin, "utf-8"))
-            fin_time = time.time() + timeout
-            s = 0.01
-            while process.poll() == None and fin_time > time.time():
-                print("Sleeping for",s,"seconds")
-                time.sleep(s)
-                s *= 2.0
-            # if timeout reached, raise an exception
-            if fin_time < time.time():
-                print("Script has not exited after " + str(timeout) +
-                      " seconds. So forcing termination.")
-                process.terminate()
-    
-            outdata = process.stdout.read()
-            errdata = process.stderr.read()   # data are bytes
-        else:
-            # fin_time = time.time() + timeout
+        # the streams of the script go straight to files in the work directory;
+        # writing more than output_limit bytes to a file kills the script (SIGXFSZ),
+        # or makes the write fail (python ignores SIGXFSZ): the file is then
+        # output_limit + 1 bytes long, the most RLIMIT_FSIZE lets it reach
+        stdout_path = os.path.join(work_path, 'stdout.txt')
+        stderr_path = os.path.join(work_path, 'stderr.txt')
+        limits = []
+        if output_limit:
+            limits.append(("fsize", output_limit + 1, output_limit + 1))
+        if self.cpu_limit:
+            # SIGXCPU once the limit is reached, SIGKILL a second later
+            seconds = math.ceil(self.cpu_limit)
+            limits.append(("cpu", seconds, seconds + 1))
+        if self.memory_limit:
+            # the allocations (heap and mappings) above the limit fail
+            limits.append(("data", self.memory_limit, self.memory_limit))
+        cgroup = None
+        unshare_flags = 0
+        if sandbox is not None:
+            # the test as a whole, which the kernel kills when it needs more
+            cgroup_memory = min(sandbox.memory, self.memory_limit or sandbox.memory)
+            cgroup = sandbox.create_cgroup(cgroup_memory)
+            limits += sandbox.limits(cgroup)
+            unshare_flags = sandbox.unshare_flags
+        warm = runner is not None and not any_language
+        # the files there before (resources, the submission) are not outputs
+        sizes_before = TestCase.__file_sizes(work_path)
+        start_time = time.monotonic()
+        stdin_path = self.stdin_path()
+        with open(stdin_path, 'rb') if stdin_path else open(os.devnull, 'rb') as stdin_file \
+                , open(stdout_path, 'wb') as stdout_file, open(stderr_path, 'wb') as stderr_file:
+            if warm:
+                # forked from an interpreter that already imported the modules used
+                process = self.process = runner.start(work_path, script_path
+                            , self.get_argv(), stdin_path
+                            , stdout_path, stderr_path, limits, cgroup, unshare_flags)
+            else:
+                # the script reads the input file itself, not a copy held by python;
+                # it runs in a session of its own, under the limits (see Sandbox.py)
+                process = self.process = AccountedProcess(Popen(
+                              limited_command(command, limits, cgroup, unshare_flags)
+                            , stdin=stdin_file, stdout=stdout_file, stderr=stderr_file
+                            , cwd=work_path, start_new_session=True))
+        kill_msg = b""
+        try:
+            process.wait(timeout)
+        except TimeoutExpired:
+            if print_cmd:
+                print("Timeout of %s seconds expired. Trying to kill process." % timeout)
+            else:
+                print("Timeout of %s seconds expired." % timeout, end=" ")
+            # the script runs in a session of its own (see above): on Linux, kill the
+            # process group, so that the processes it started (make, the executable) die too
+            if myplatform.is_linux():
+                os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+            else:
+                process.kill()
+
+            if print_cmd:
+                print("Kill sent. Waiting for process to return.", end=" ")
             try:
-                outdata, errdata = process.communicate(bytes(self.stdin, "utf-8"),timeout=timeout)    
+                process.wait(0.1)
             except TimeoutExpired:
-                if print_cmd:
-                    print("Timeout of %s seconds expired. Trying to kill process." % timeout)
-                else:
-                    print("Timeout of %s seconds expired." % timeout, end=" ")
-                # because we started with shell=True, we need to kill the process group on Linux:
-                # see http://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
-                if myplatform.is_linux():
-                    os.killpg(os.getpgid(process.pid), signal.SIGKILL)
-                else:
-                    process.kill()
+                print("OOPS: process got stuck")
 
-                if print_cmd:
-                    print("Kill sent. Waiting for process to return.", end=" ")
-                # process.wait()
-                outdata, errdata = (b"",b"")
-                try:
-                    outdata, errdata = process.communicate(timeout=0.1)
-                except TimeoutExpired:
-                    outdata, errdata = (b"",b"")
-                    print("OOPS: process got stuck")
-                
-                if print_cmd:
-                    print("Process returned.")
-                
-                errdata = b"Timeout expired.\n" + errdata
+            if print_cmd:
+                print("Process returned.")
 
-                self.result = TestCase.TIMEOUT   # et result to TIMEOUT
-                #~ exitstatus = process.wait()
-                #~ print("outs",outs,"\nerrs:", errs, "\nexitstatus", exitstatus)
-                #~ raise
+            kill_msg = b"Timeout expired.\n"
+            self.result = TestCase.TIMEOUT   # et result to TIMEOUT
         exitstatus = process.wait()       # requires binary files
+        self.process = None
+        if warm:
+            runner.release(process)
+        self.__record_usage(time.monotonic() - start_time, process.rusage, process.parent_maxrss
+                           , cgroup and sandbox.memory_peak(cgroup))
+        if process.status_lost:
+            kill_msg += b"The exit status of the script was lost.\n"
+        # also kills the processes the script left running
+        out_of_memory = cgroup is not None and sandbox.remove_cgroup(cgroup)
+
+        # SIGXCPU may come a clock tick before the CPU time reported reaches the limit
+        xcpu = getattr(signal, "SIGXCPU", None)
+        if self.cpu_limit and self.user_time is not None \
+                and (self.user_time + self.sys_time >= self.cpu_limit
+                     or xcpu is not None and exitstatus in (-xcpu, 128 + xcpu)):
+            kill_msg = b"CPU time limit of %g seconds exceeded.\n" % self.cpu_limit
+            self.result = TestCase.CPU_LIMIT
+        # the peak resident memory (max_rss) is only reported: the limit is enforced
+        # by RLIMIT_DATA and the cgroup, and exceeded when an allocation failed
+        if out_of_memory:
+            kill_msg = b"Memory limit of %.1f MB exceeded.\n" % (cgroup_memory / (1024 * 1024))
+            self.result = TestCase.MEMORY_LIMIT
+        elif self.memory_limit and exitstatus != 0 and TestCase.__allocation_failed(stderr_path):
+            kill_msg = b"Memory limit of %.1f MB exceeded.\n" % (self.memory_limit / (1024 * 1024))
+            self.result = TestCase.MEMORY_LIMIT
+
+        xfsz = getattr(signal, "SIGXFSZ", None)
+        written = [size for (name, size) in TestCase.__file_sizes(work_path).items()
+                   if sizes_before.get(name) != size]
+        if output_limit and (xfsz is not None and exitstatus in (-xfsz, 128 + xfsz)
+                             or max(written, default=0) > output_limit):
+            kill_msg = b"Output limit of %d bytes exceeded.\n" % output_limit
+            self.result = TestCase.OUTPUT_LIMIT
 
         if print_cmd:
             trace(exitstatus)
-        # trace(outdata + errdata + exitstatus)
-        return (outdata,errdata,exitstatus,extra_files_in_workpath)
-    
-    def run_test(self,submission_dir,timeout,gen_res,visible_space_diff,any_language,print_cmd=False,script_based=False):
+        return (stdout_path,stderr_path,kill_msg,exitstatus,extra_files_in_workpath)
+
+    def __record_usage(self, wall_time, rusage, parent_maxrss=None, memory_peak=None):
+        '''Stores the resources used by the run (rusage from os.wait4, or
+           None). The kernel counts in ru_maxrss the memory the process had
+           when it was forked (that of the test center, or of the warm
+           server: parent_maxrss at most), so it is only the peak memory of
+           the test when it is above parent_maxrss; memory_peak, the peak of
+           the cgroup of the test, is used instead where known.
+        '''
+        self.wall_time = wall_time
+        if rusage is None:
+            self.user_time = self.sys_time = self.max_rss = None
+        else:
+            self.user_time = rusage.ru_utime
+            self.sys_time = rusage.ru_stime
+            # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+            self.max_rss = rusage.ru_maxrss * (1 if myplatform.is_mac() else 1024) \
+                if parent_maxrss is not None and rusage.ru_maxrss > parent_maxrss else None
+        if memory_peak:
+            self.max_rss = memory_peak
+
+    @staticmethod
+    def __allocation_failed(stderr_path):
+        '''Whether the end of the stderr of a script shows that an allocation
+           failed (see OUT_OF_MEMORY_ERRORS).
+        '''
+        try:
+            with open(stderr_path, 'rb') as stderr_file:
+                stderr_file.seek(max(0, os.path.getsize(stderr_path) - 4096))
+                tail = stderr_file.read()
+        except OSError:
+            return False
+        return any(error in tail for error in TestCase.OUT_OF_MEMORY_ERRORS)
+
+    @staticmethod
+    def __file_sizes(directory):
+        '''name -> size of the files of directory.'''
+        return {entry.name: entry.stat(follow_symlinks=False).st_size
+                for entry in os.scandir(directory) if entry.is_file(follow_symlinks=False)}
+
+    @staticmethod
+    def __read_head(filename, limit):
+        '''Returns at most limit bytes from the start of the file.'''
+        with open(filename, 'rb') as file:
+            data = file.read(limit)
+            if file.read(1):
+                data += b"\n... (truncated)\n"
+        return data
+
+    def run_test(self,submission_dir,timeout,gen_res,visible_space_diff,any_language,print_cmd=False,script_based=False,staged=(),output_limit=None,runner=None,expected_cache=None,sandbox=None,artifact_store=None):
+        '''Runs the test against the submission and compares its outputs.
+           staged lists the files linked into the work directory of a
+           submission in any language (see TestSuite.stage_submission_files).
+           expected_cache (an ExpectedCache) holds the normalized forms of
+           the expected outputs, and sandbox (a Sandbox) limits the processes
+           of the test. The files written to Outputs and Errors are kept in
+           artifact_store (an ArtifactStore) if given.
+           Returns (result, result_details).
+        '''
         script_path = os.path.abspath(os.path.join(submission_dir, self.script_name))
         # If C++
         if any_language:
@@ -340,51 +673,101 @@ class TestCase:
             print("Running",script_path)
         else:
             print("Running {}...".format(self.name), end = " ")
-        work_path = tempfile.mkdtemp(prefix="work-") #@todo clean this up at the end
+        self.result = None
+        self.wall_time = self.user_time = self.sys_time = self.max_rss = None
+        self.artifacts = {}
+        if output_limit is None:
+            output_limit = TestCase.OUTPUT_LIMIT_DEFAULT
+        work_path = tempfile.mkdtemp(prefix="work-")
+        try:
+            return self.__run_in(work_path,script_path,timeout,gen_res,visible_space_diff
+                                ,any_language,print_cmd,script_based,staged,output_limit,runner
+                                ,expected_cache,sandbox,artifact_store)
+        finally:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    def __run_in(self,work_path,script_path,timeout,gen_res,visible_space_diff
+                ,any_language,print_cmd,script_based,staged,output_limit,runner,expected_cache,sandbox,artifact_store):
+        '''Runs the test in the (new) work directory work_path.'''
         res_basenames = self.__copy_resources(work_path, print_cmd)
 
-        # remove all the old outputs from this test
-        old_outs = glob.glob(os.path.join(self.output_path, self.name) + "*")
+        # remove all the old outputs from this test (but not those of tests
+        # whose name merely starts with the name of this test)
+        old_outs = glob.glob(os.path.join(self.output_path, self.name) + "-*") \
+                 + glob.glob(os.path.join(self.output_path, self.name) + ".*")
         for old_out in old_outs:
             os.remove(old_out)
 
-        # remove all the old error reports from this test
+        # remove all the old error reports from this test (they may be links
+        # to read-only files of the artifact store, which must not be written)
         err_file = os.path.join(self.err_path, self.name + ".txt")
+        old_errs = glob.glob(os.path.join(self.err_path, self.name) + "-*")
+        for old_err in old_errs + [err_file]:
+            if os.path.lexists(old_err):
+                os.remove(old_err)
 
-        if os.path.exists(err_file):
-            os.remove(err_file)
-
-        (outdata,errdata,exitstatus,extra_files_in_workpath) = \
-        self.__run_script(work_path,script_path,timeout,any_language,print_cmd)
+        (stdout_path,stderr_path,kill_msg,exitstatus,extra_files_in_workpath) = \
+        self.__run_script(work_path,script_path,timeout,any_language,print_cmd,staged,output_limit,runner,sandbox)
         
         res_basenames += extra_files_in_workpath
+        # only the start of stderr is kept in memory (for the error message)
+        errdata = kill_msg + TestCase.__read_head(stderr_path, TestCase.ERR_MSG_LIMIT)
         
         if exitstatus or errdata:  # save status+stderr
-            open(err_file, 'wb').write(errdata)  # redundant??
+            # move the streams out of the work directory (so they are not compared)
+            with open(err_file, 'wb') as file, open(stderr_path, 'rb') as stderr_file:
+                file.write(kill_msg)
+                shutil.copyfileobj(stderr_file, file)
+            os.remove(stderr_path)
+            self.__keep_file(err_file, err_file, artifact_store)
             outpathbad = os.path.join(self.output_path, self.name + '.stdout.txt') # during generation mode!?
-            open(outpathbad, 'wb').write(outdata)
+            self.__keep_file(stdout_path, outpathbad, artifact_store)
 
-            if self.result != TestCase.TIMEOUT:
+            if self.result not in TestCase.LIMIT_RESULTS:
                 self.result = TestCase.ERR
             self.result_details = (exitstatus,errdata,err_file,outpathbad)
 #            self.info = "Crashed with error message and status:" + str(exitstatus)
-        else:
-            stdout_path = os.path.join(work_path, 'stdout.txt')
-            stderr_path = os.path.join(work_path, 'stderr.txt')
-    
-            with open(stderr_path, "wb") as stderr_file:
-                stderr_file.write(errdata)        
-            with open(stdout_path, "wb") as stdout_file:
-                stdout_file.write(outdata)
+            if self.result != TestCase.ERR: # killed: the outputs are incomplete
+                return (self.result,self.result_details)
 
-        self.__compare_results(outdata,errdata,exitstatus,work_path,res_basenames,gen_res,visible_space_diff,script_based)
+        self.__compare_results(errdata,exitstatus,work_path,res_basenames,gen_res,visible_space_diff,script_based,expected_cache,artifact_store)
             
         return (self.result,self.result_details)
 
+    def __keep_file(self, path, dest, artifact_store):
+        '''Moves the file path to dest, in Outputs or Errors (into
+           artifact_store, linked at dest, if given).
+        '''
+        if artifact_store is None:
+            if path != dest:
+                shutil.move(path, dest)
+        else:
+            self.artifacts[dest] = artifact_store.put(path, dest)
+
+    def __copy_file(self, path, dest, artifact_store):
+        '''Copies the file path, kept by __keep_file(), to dest.'''
+        if self.artifacts.get(path) is None:
+            shutil.copyfile(path, dest)
+            if artifact_store is not None:
+                self.artifacts[dest] = None
+        else:
+            artifact_store.link(self.artifacts[path], dest)
+            self.artifacts[dest] = self.artifacts[path]
+
+    def __spill_diff(self, diff_lines, diff_path, artifact_store):
+        '''Writes diff_lines (if a non-empty list) to diff_path, and returns
+           them as diffs.DiffLines.
+        '''
+        if not isinstance(diff_lines, list) or not diff_lines:
+            return diff_lines
+        diff_lines = diffs.spill_lines(diff_lines, diff_path)
+        self.__keep_file(diff_path, diff_path, artifact_store)
+        return diff_lines
+
     def err_msg(self):
         '''Returns the error message from the result (if there was an error)'''
-        if self.result==TestCase.ERR or self.result==TestCase.TIMEOUT:
-            return self.result_details[1].decode('utf-8') 
+        if self.is_err():
+            return self.result_details[1].decode('utf-8', errors='replace')
         return ""
     
     def __create_exp_files(self,actual_files):
@@ -400,18 +783,10 @@ class TestCase:
         
     @staticmethod
     def __read_file(filename):
-        file_type = mimetypes.guess_type(filename)[0]
-        contents = None
-        is_text = (file_type==None or file_type.startswith('text'))
-        if is_text:
-            with open(filename, 'r', errors="replace") as file: 
-                contents = file.readlines()
-        else:
-            with open(filename, 'rb', errors="replace") as file:
-                contents = file.read()
-        return (contents,is_text)
+        is_text = diffs.is_text_file(filename)
+        return (diffs.read_file(filename, is_text),is_text)
                 
-    def __compare_results(self,outdata,errdata,exitstatus,work_path,res_basenames,gen_res,visible_diff,script_based=False):
+    def __compare_results(self,errdata,exitstatus,work_path,res_basenames,gen_res,visible_diff,script_based=False,expected_cache=None,artifact_store=None):
         trace("Comparing results")
         self.result = TestCase.PASS
         self.result_details = MatchResult()
@@ -433,6 +808,7 @@ class TestCase:
 #        self.result_details.unmatched_exp_files = set(self.exp_paths)
         self.result_details.unmatched_output_files = set(output_files)
         self.result_details.unmatched_exp_files = set(self.exp_paths)
+        stdout_path = os.path.join(work_path, 'stdout.txt')
         for output_file in output_files:
             output_file_basename = os.path.basename(output_file)
             # ignore resources, __pycache__, and files from the script source dir
@@ -448,11 +824,13 @@ class TestCase:
             # move the actual file into the output directory and rename it
             actual_dest = os.path.join(self.output_path, actual_basename)
 
-            shutil.move(output_file, actual_dest)
-            actual,is_text = TestCase.__read_file(actual_dest)
+            self.__keep_file(output_file, actual_dest, artifact_store)
+            if output_file == stdout_path:
+                stdout_path = actual_dest
             trace("Looking for match for output file %s" % (actual_basename,))
 
             if script_based:
+                actual,is_text = TestCase.__read_file(actual_dest)
                 script_path = os.path.join(os.getcwd(), "soln/mark_script.py")
                 # Compare actual output against marking script
                 args = ["python", script_path]
@@ -468,20 +846,31 @@ class TestCase:
                     if exp_path_basename == actual_basename:
                         self.result_details.unmatched_exp_files.remove(exp_path)
                         self.result_details.unmatched_output_files.remove(output_file)
-                        expected, is_text = TestCase.__read_file(exp_path)
+                        is_text = self.is_text_exp(exp_path)
+                        forms = None
+                        if expected_cache is not None and is_text and self.tolerance() is None:
+                            forms = expected_cache.forms(exp_path)
                         trace("Comparing %s and %s" % (exp_path, output_file))
                         
                         (softtest_diffs,hardtest_diffs) =\
-                            diffs.diff(actual, expected, is_text, visible_diff)
+                            diffs.diff_files(actual_dest, exp_path, is_text, visible_diff, self.tolerance(), forms)
                         if softtest_diffs or hardtest_diffs:
+                            # the lines of the diff are read from a file when they are shown
+                            diff_path = os.path.join(self.output_path, actual_basename + ".diff")
+                            (softtest_diffs, hardtest_diffs) = \
+                                (self.__spill_diff(diff_lines, diff_path, artifact_store)
+                                 for diff_lines in (softtest_diffs, hardtest_diffs))
                             outpathbad = os.path.join(self.output_path, actual_basename+".err")                        
-                            open(outpathbad, 'wb').write(outdata)
+                            if os.path.exists(stdout_path):
+                                self.__copy_file(stdout_path, outpathbad, artifact_store)
                             self.result = TestCase.SOFTTEST_FAIL if softtest_diffs else TestCase.HARDTEST_FAIL 
                             self.result_details.add_match_result( output_file_basename, (softtest_diffs, hardtest_diffs, actual_dest, exp_path) )
                         break
-                                        
+
+        self.result_details.unmatched_output_files = tuple(sorted(self.result_details.unmatched_output_files))
+        self.result_details.unmatched_exp_files = tuple(sorted(self.result_details.unmatched_exp_files))
         for exp_path in self.result_details.unmatched_exp_files:
-            errdata = errdata.decode('utf-8')
+            errdata = errdata.decode('utf-8', errors='replace')
             errdata += "\nExpected file \"{}\" has no output file match".format(exp_path)
             errdata = str.encode(errdata)
             trace(errdata)
@@ -489,7 +878,11 @@ class TestCase:
             basename = os.path.basename(exp_path)
 
             err_file = os.path.join(self.err_path, basename)
-            open(err_file, 'wb').write(errdata + b"\n")
+            if os.path.lexists(err_file): # never write through a link to a stored file
+                os.remove(err_file)
+            with open(err_file, 'wb') as file:
+                file.write(errdata + b"\n")
+            self.__keep_file(err_file, err_file, artifact_store)
 
             self.result = TestCase.ERR
             self.result_details = (
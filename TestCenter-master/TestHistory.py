@@ -0,0 +1,179 @@
+######################################################################
+#   File: TestHistory.py
+#
+#   Description:
+#       Remembers how long each test of a test-case directory took in
+#       the previous runs, so that the longest tests can be started
+#       first, and a suite can be split into shards that take about
+#       the same time (see TestSuite.run_tests and TestSuite.select_shard).
+#       Also remembers which tests failed, so that a run stopping at the
+#       first failure can run the tests most likely to fail first.
+#
+#   Included classes:
+#       - TestHistory() the duration of the last run of every test, how
+#       often and when it last failed, and the tests each submission
+#       failed in its last run, stored as JSON in a file of its own per
+#       test-case directory in the private cache directory of the user
+#       (or in a file given by the user, which can be shared by the
+#       machines running the shards of a suite).
+#
+######################################################################
+
+import hashlib
+import json
+import math
+import os
+import tempfile
+import time
+from TestCase import TestCase
+from ResultCache import cache_dir
+
+
+class TestHistory:
+    #  The history of a test-case directory is stored in <cache>/HISTORY_NAME/<key>.json
+    #  (see ResultCache.cache_dir()), where the key is a hash of the absolute
+    #  path of the directory.
+    HISTORY_NAME = "history"
+    VERSION = 2
+
+    #  The numbers kept for a test (all optional)
+    TEST_FIELDS = ("duration", "runs", "failures", "last_failure")
+
+    #  Seconds assumed for a test that never ran, when no test ran either
+    DEFAULT_DURATION = 1.0
+    #  Number of submissions whose failures are remembered (the most recent ones)
+    SUBMISSION_LIMIT = 200
+
+    def __init__(self, testcase_dir, path=None):
+        '''path is the file the history is kept in (default: one in
+           <cache>/HISTORY_NAME for testcase_dir).
+        '''
+        self.path = path
+        self.key = hashlib.sha256(os.path.abspath(testcase_dir).encode()).hexdigest()
+        # "script/test" -> {"duration": seconds, "runs": n, "failures": n,
+        #                   "last_failure": time}
+        # and submission -> {"time": time of its last run, "failed": {"script/test": time}}
+        (self.tests, self.submissions) = self.__load()
+        self.changed = set()             # keys of the tests recorded since the last save()
+        self.changed_submissions = set() # and of the submissions
+
+    def estimate(self, script_name, test_name):
+        '''Expected seconds of a run of the test: its last duration, or the
+           mean of the known durations if it never ran.
+        '''
+        record = self.tests.get(TestHistory.__key(script_name, test_name), {})
+        if "duration" in record:
+            return record["duration"]
+        durations = [record["duration"] for record in self.tests.values() if "duration" in record]
+        return sum(durations) / len(durations) if durations else TestHistory.DEFAULT_DURATION
+
+    def failure_priority(self, submission, script_name, test_name):
+        '''Sort key putting the tests most likely to fail first: those the
+           submission failed in its last run (the most recent failures first),
+           then those failing most often (for any submission), then those that
+           failed most recently.
+        '''
+        key = TestHistory.__key(script_name, test_name)
+        failed = self.submissions.get(submission, {}).get("failed", {}).get(key)
+        record = self.tests.get(key, {})
+        failure_rate = record.get("failures", 0) / record["runs"] if record.get("runs") else 0
+        return (failed is None, -(failed or 0), -failure_rate, -record.get("last_failure", 0))
+
+    def record(self, script_name, test_case, submission=None):
+        '''Records the run of test_case (once its result is known) against
+           submission (a name identifying it between runs).
+        '''
+        if test_case.result is None:
+            return
+        key = TestHistory.__key(script_name, test_case.name)
+        now = time.time()
+        failed = test_case.is_err() or test_case.result == TestCase.SOFTTEST_FAIL
+        record = self.tests.setdefault(key, {})
+        if test_case.wall_time is not None:
+            record["duration"] = test_case.wall_time
+        record["runs"] = record.get("runs", 0) + 1
+        record["failures"] = record.get("failures", 0) + failed
+        if failed:
+            record["last_failure"] = now
+        self.changed.add(key)
+        if submission is not None:
+            submission_record = self.submissions.setdefault(submission, {"failed": {}})
+            submission_record["time"] = now
+            if failed:
+                submission_record["failed"].setdefault(key, now)
+            else:
+                submission_record["failed"].pop(key, None)
+            self.changed_submissions.add(submission)
+
+    def save(self):
+        '''Writes the tests and submissions recorded since the last save()
+           into the file, keeping what other runs wrote there in the meantime.
+        '''
+        if not self.changed and not self.changed_submissions:
+            return
+        (tests, submissions) = self.__load()
+        for key in self.changed:
+            tests[key] = self.tests[key]
+        for submission in self.changed_submissions:
+            submissions[submission] = self.submissions[submission]
+        recent = sorted(submissions, key=lambda submission: submissions[submission]["time"])
+        for submission in recent[:-TestHistory.SUBMISSION_LIMIT]:
+            del submissions[submission]
+        (self.tests, self.submissions) = (tests, submissions)
+        self.changed = set()
+        self.changed_submissions = set()
+        try:
+            path = self.__path()
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            (fd, tmp_path) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, 'w') as history_file:
+                json.dump({"version": TestHistory.VERSION, "tests": tests
+                          , "submissions": submissions}, history_file, indent=1, sort_keys=True)
+            os.replace(tmp_path, path)
+        except OSError: # the history is only an optimization
+            pass
+
+    def __path(self):
+        if self.path is not None:
+            return self.path
+        return os.path.join(cache_dir(TestHistory.HISTORY_NAME), self.key + ".json")
+
+    def __load(self):
+        '''The tests and submissions of the file, without the records that
+           are not what save() writes (which are dropped).
+        '''
+        try:
+            with open(self.__path()) as history_file:
+                data = json.load(history_file)
+            if data["version"] == TestHistory.VERSION:
+                tests = {key: record for (key, record) in dict(data["tests"]).items()
+                         if TestHistory.__is_test(record)}
+                submissions = {submission: record for (submission, record)
+                               in dict(data["submissions"]).items()
+                               if TestHistory.__is_submission(record)}
+                return (tests, submissions)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return ({}, {})
+
+    @staticmethod
+    def __is_test(record):
+        return isinstance(record, dict) and all(
+            name in TestHistory.TEST_FIELDS and TestHistory.__is_number(value)
+            for (name, value) in record.items())
+
+    @staticmethod
+    def __is_submission(record):
+        return isinstance(record, dict) and set(record) == {"time", "failed"} \
+            and TestHistory.__is_number(record["time"]) and isinstance(record["failed"], dict) \
+            and all(TestHistory.__is_number(value) for value in record["failed"].values())
+
+    @staticmethod
+    def __is_number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool) \
+            and math.isfinite(value) and value >= 0
+
+    @staticmethod
+    def __key(script_name, test_name):
+        return "%s/%s" % (script_name, test_name)
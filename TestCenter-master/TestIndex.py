@@ -0,0 +1,158 @@
+######################################################################
+#   File: TestIndex.py
+#
+#   Description:
+#       Persists the test cases collected by a TestSuite, so that
+#       collecting an unchanged test-case directory does not need to
+#       list and match every file again.
+#
+#   Included classes:
+#       - TestIndex() stores the names, input types and the paths,
+#       sizes and modification times of the input, resource and
+#       expected files of every test case, and whether each expected
+#       file holds text or binary data. The index is valid as
+#       long as none of the directories it was built from changed, and
+#       only refers to files of the test-case directory.
+#
+######################################################################
+
+import hashlib
+import json
+import os
+import tempfile
+from TestCase import TestCase
+from ResultCache import cache_dir
+
+
+class TestIndex:
+    #  The index of a test-case directory is stored in <cache>/INDEX_NAME/<key>.json
+    #  (see ResultCache.cache_dir()), where the key is a hash of the directory
+    #  (as given and as absolute path) and of the languages allowed.
+    INDEX_NAME = "index"
+    VERSION = 2
+
+    #  Subdirectories of a test directory whose contents make up the index
+    #  (Outputs and Errors change on every run)
+    INDEXED_SUBDIRECTORIES = ("Expected", "Inputs", "Resources")
+
+    def __init__(self, testcase_dir, any_language):
+        self.testcase_dir = testcase_dir
+        self.any_language = any_language
+        key = hashlib.sha256(("%s\0%s\0%s" % (os.path.abspath(testcase_dir)
+                             , testcase_dir, any_language)).encode()).hexdigest()
+        self.key = key
+        self.data = None
+
+    def load(self):
+        '''Loads the index from disk. Returns whether a valid index
+           (one built from the current contents of the directories) was found.
+        '''
+        self.data = None
+        try:
+            with open(self.__path()) as index_file:
+                data = json.load(index_file)
+            if data["version"] != TestIndex.VERSION or not self.__covers(data):
+                return False
+            for (dir_path, mtime) in data["dirs"].items():
+                if os.stat(dir_path).st_mtime_ns != mtime:
+                    return False
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        self.data = data
+        return True
+
+    def save(self, assignment_name, testpaths, test_cases):
+        '''Builds the index of the collected test cases and writes it to disk.'''
+        dirs = [self.testcase_dir]
+        for test_path in testpaths:
+            if os.path.isdir(test_path):
+                dirs.append(test_path)
+                dirs += [os.path.join(test_path, fld) for fld in TestIndex.INDEXED_SUBDIRECTORIES
+                         if os.path.isdir(os.path.join(test_path, fld))]
+        scripts = {}
+        for (script_name, script_tests) in test_cases.items():
+            tests = scripts[script_name] = {}
+            for (test_name, test_case) in script_tests.items():
+                test_path = os.path.dirname(test_case.exp_path)
+                tests[test_name] = {
+                    "test_path": test_path,
+                    "inputs": [[input_type] + TestIndex.file_info(path)
+                               for (input_type, path) in test_case.inputs],
+                    "resources": [TestIndex.file_info(path) for path in test_case.resources],
+                    "expected": [[exp_type, path] + list(TestIndex.exp_info(test_case, path))
+                                 for (exp_type, path) in test_case.exp_files],
+                }
+        self.data = {
+            "version": TestIndex.VERSION,
+            "assignment_name": assignment_name,
+            "testpaths": testpaths,
+            "dirs": {dir_path: os.stat(dir_path).st_mtime_ns for dir_path in dirs},
+            "scripts": scripts,
+        }
+        try:
+            (fd, tmp_path) = tempfile.mkstemp(dir=cache_dir(TestIndex.INDEX_NAME), suffix=".tmp")
+            with os.fdopen(fd, 'w') as index_file:
+                json.dump(self.data, index_file)
+            os.replace(tmp_path, self.__path())
+        except OSError: # the index is only an optimization
+            pass
+
+    def assignment_name(self):
+        return self.data["assignment_name"]
+
+    def testpaths(self):
+        return self.data["testpaths"]
+
+    def test_cases(self):
+        '''Recreates the indexed test cases: test_cases[scriptname][testname]'''
+        test_cases = {}
+        for (script_name, tests) in self.data["scripts"].items():
+            script_tests = test_cases[script_name] = {}
+            for (test_name, record) in tests.items():
+                test_path = record["test_path"]
+                test_case = script_tests[test_name] = TestCase(test_name, script_name
+                    , os.path.join(test_path, "Expected")
+                    , os.path.join(test_path, "Outputs")
+                    , os.path.join(test_path, "Errors"))
+                for (input_type, path, size, mtime) in record["inputs"]:
+                    test_case.add_input(input_type, path)
+                for (path, size, mtime) in record["resources"]:
+                    test_case.add_resource(path)
+                for (exp_type, path, size, mtime, is_text) in record["expected"]:
+                    test_case.add_exp_path(exp_type, path)
+                    test_case.exp_text[path] = (size, mtime, is_text)
+        return test_cases
+
+    def __path(self):
+        return os.path.join(cache_dir(TestIndex.INDEX_NAME), self.key + ".json")
+
+    def __covers(self, data):
+        '''Whether data indexes the test-case directory (its mtime and those
+           of all the test directories are recorded) and only refers to
+           files in it.
+        '''
+        dirs = data["dirs"]
+        if self.testcase_dir not in dirs:
+            return False
+        root = os.path.abspath(self.testcase_dir)
+        paths = list(dirs) + data["testpaths"]
+        for tests in data["scripts"].values():
+            for record in tests.values():
+                if record["test_path"] not in dirs:
+                    return False
+                paths += [record["test_path"]] + [path for (_, path, *_) in record["inputs"]] \
+                       + [path for (path, *_) in record["resources"]] \
+                       + [path for (_, path, *_) in record["expected"]]
+        return all(os.path.commonpath([root, os.path.abspath(path)]) == root for path in paths)
+
+    @staticmethod
+    def file_info(path):
+        '''Returns [path, size, mtime] of the given file.'''
+        stat = os.stat(path)
+        return [path, stat.st_size, stat.st_mtime_ns]
+
+    @staticmethod
+    def exp_info(test_case, path):
+        '''Returns (size, mtime, is text) of an expected file of test_case.'''
+        test_case.is_text_exp(path)
+        return test_case.exp_text[path]
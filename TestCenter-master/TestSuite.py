@@ -10,6 +10,8 @@
 #       - prepSubmission(), verbose(), quiet()
 #
 #   Included classes:
+#       - ThreadLocalStdout() collects what tests print while they
+#       run in parallel so that it can be printed in order.
 #       - TestSuite() manages test case information using instances
 #       of the TestCase() class. Important functions to note:
 #           - print_result(): used to print result information to
@@ -21,7 +23,21 @@
 import glob
 import os
 import re
+import sys
+import io
+import threading
+import hashlib
+import configparser
+import shutil
+from subprocess import run, PIPE, STDOUT
+from concurrent.futures import ThreadPoolExecutor
 from TestCase import TestCase
+from TestIndex import TestIndex
+from WarmRunner import WarmRunner
+from ResultCache import ResultCache, cache_dir
+from ExpectedCache import ExpectedCache
+from ArtifactStore import ArtifactStore
+from TestHistory import TestHistory
 import logging
 # logging.basicConfig(level=logging.DEBUG)
 # logging.basicConfig(level=logging.WARNING)
@@ -76,6 +92,38 @@ def prep_submission(submission,assignment_name,verify_dir_structure=True):
     return submission
 
 
+class ThreadLocalStdout:
+    '''Stand-in for sys.stdout while tests run in a thread pool.
+    Threads that called capture() write into their own buffer, so that
+    the output of each test can be printed in a deterministic order;
+    all other threads write through to the real stream.
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buffer = io.StringIO()
+
+    def release(self):
+        '''Stops capturing and returns what the current thread printed.'''
+        text = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return text
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
 class TestSuite:
     #  the pattern of testcase names is ASSIGNMENTNAME-SCRIPTNAME-test, as below:
     TESTCASENAME_REGEXP_PY = re.compile("(as-(\d+)-(\d+))-([\w\-]+\.py)-test")
@@ -114,28 +162,59 @@ class TestSuite:
     (EXPECTED_DIR, ERROR_DIR, INPUT_DIR, OUTPUT_DIR, RESOURCE_DIR) =\
      ("Expected", "Errors", "Inputs", "Outputs", "Resources")
 
+    #  Optional configuration of the tests in a test directory: the [DEFAULT]
+    #  section applies to every test, a [<testname>] section to a single test.
+    #  See TestCase.set_config for the options, e.g.
+    #      [DEFAULT]
+    #      compare = numeric
+    #      abs_tol = 1e-4
+    TESTCONFIG_FILE = "testcase.ini"
+
+    #  Compiled submissions are cached in <cache>/BUILD_CACHE_NAME/<key> (see
+    #  ResultCache.cache_dir()), where the key is a hash of the submission's
+    #  source files, BUILD_COMMAND and the compiler flags taken from the
+    #  environment (BUILD_ENV_VARS).
+    BUILD_CACHE_NAME = "build"
+    BUILD_COMMAND = ("make", "-s")
+    BUILD_ENV_VARS = ("CXX", "CXXFLAGS", "CC", "CFLAGS", "CPPFLAGS", "LDFLAGS")
+
     #  list of files allowed to be in the test directory:
     allowed_files = ("marking.py", "pep8.py", "marking.ini", "marking_gui.pyw"
         , "diffs.py", "TestCase.py", "TestSuite.py", "myplatform.py"
         , "SimpleDialog.py"
         )
 
-    def __init__(self,testcase_dir,any_language):
+    def __init__(self,testcase_dir,any_language,history_path=None):
         ''' Sets up the TestSuite by collecting all the test cases
-            from the testcase_dir directory.
+            from the testcase_dir directory. The durations of the tests
+            are kept in history_path (see TestHistory).
         '''
         self.testcase_dir = testcase_dir
         self.any_language = any_language
         self.TESTCASENAME_REGEXP = TestSuite.TESTCASENAME_REGEXP_ANY if self.any_language else TestSuite.TESTCASENAME_REGEXP_PY
         self.test_cases = {} #  dict of dict; usage: test_cases[scriptname][testname]
-        self.assignment_name = self.__verify_testdir_contents()
+        # an up to date index means the contents were verified before
+        self.index = TestIndex(testcase_dir, any_language)
+        if self.index.load():
+            self.assignment_name = self.index.assignment_name()
+        else:
+            self.assignment_name = self.__verify_testdir_contents()
         self.testpaths = None
+        self.cancelled = threading.Event() # set by cancel() to stop run_tests
+        self.expected_cache = ExpectedCache() # normalized forms of the expected outputs
+        self.artifact_store = ArtifactStore(near=testcase_dir) # the files in Outputs and Errors, by contents
+        self.history = TestHistory(testcase_dir, history_path) # durations of the previous runs
 
     def collect_tests(self, create_missing_dirs):
         ''' Collects all test cases in the given marking dir.
             - create_missing_dirs (boolean): Whether to create missing directories
             (set this to True when the suite is used to generate the expected output files)
         '''
+        if self.index.data is not None:
+            print("     Using the index of the unchanged test cases...")
+            self.__collect_indexed_tests()
+            return
+
         test_cases = self.test_cases = {}
 
         test_directories = glob.glob(os.path.join(self.testcase_dir, "*"))
@@ -169,6 +248,37 @@ class TestSuite:
             print("     Adding expected output files...", end=" ")
             self.__add_exp_files(test_cases,script_name,test_path)
 
+        self.index.save(self.assignment_name, self.testpaths, self.test_cases)
+        self.__configure_tests()
+
+    def __configure_tests(self):
+        '''Applies the configuration file of each test directory (if any)
+           to its tests. The file is read on every collection, so it is
+           never stale, not even when the tests come from the index.
+        '''
+        configs = {}
+        for script_tests in self.test_cases.values():
+            for (test_name, test_case) in script_tests.items():
+                config_path = os.path.join(os.path.dirname(test_case.exp_path)
+                                          , TestSuite.TESTCONFIG_FILE)
+                if config_path not in configs:
+                    configs[config_path] = configparser.ConfigParser()
+                    try:
+                        configs[config_path].read(config_path)
+                    except configparser.Error as err:
+                        raise RuntimeError("Invalid test configuration %s: %s" % (config_path, err))
+                config = configs[config_path]
+                test_case.set_config(config[test_name] if config.has_section(test_name)
+                                     else config["DEFAULT"])
+
+    def __collect_indexed_tests(self):
+        self.test_cases = self.index.test_cases()
+        self.testpaths = self.index.testpaths()
+        self.problem_name = "matrix"
+        for script_name in self.test_cases:
+            if script_name[-3:] == ".py":
+                self.any_language = False
+        self.__configure_tests()
 
     def __verify_scripttest_dir(self, test_path, create_missing_dirs):
         for fld in self.TESTCASE_SUBDIRECTORIES:
@@ -181,16 +291,24 @@ class TestSuite:
                     raise RuntimeError("Missing directory %s" % (dir_path,))
 
     def print_result(self, result, test_case, detail, stop_early, verbose):
+        usage = test_case.get_usage_str()
+        end = " [%s]\n" % usage if usage else "\n"
         if result==TestCase.PASS:
-            print("Pass")
+            print("Pass", end=end)
         elif result==TestCase.SOFTTEST_FAIL:
-            print("Failed with incorrect output")
+            print("Failed with incorrect output", end=end)
         elif result==TestCase.HARDTEST_FAIL:
-            print("Presentation error")
+            print("Presentation error", end=end)
         elif result ==TestCase.TIMEOUT:
-            print("Time limit exceeded.")
+            print("Time limit exceeded.", end=end)
+        elif result ==TestCase.OUTPUT_LIMIT:
+            print("Output limit exceeded.", end=end)
+        elif result ==TestCase.CPU_LIMIT:
+            print("CPU time limit exceeded.", end=end)
+        elif result ==TestCase.MEMORY_LIMIT:
+            print("Memory limit exceeded.", end=end)
         else:
-            print("Failed with error")
+            print("Failed with error", end=end)
 
             # PRINT THE ERROR ONLY IF THIS IS THE ONLY ERROR MESSAGE THAT WILL PRINT
             if stop_early:
@@ -206,45 +324,319 @@ class TestSuite:
             detail.print()
 
     def run_tests(self, submission_dir, timeout, gen_res, visible_space_diff
-                  , verbose, stop_early, script_based = False):
-        # if C++, then compile ahead of time
+                  , verbose, stop_early, script_based = False, jobs = 1, output_limit = None
+                  , warm = False, force = False, cache = True, reporters = (), sandbox = None
+                  , submission_name = None):
+        '''Runs all test cases against the submission.
+            - jobs (int): number of test cases run concurrently (0: one per CPU).
+            - output_limit (int): maximum size of each output of a test in bytes
+              (default: TestCase.OUTPUT_LIMIT_DEFAULT); bigger outputs fail the test.
+            - warm (bool): run python scripts in children forked from jobs
+              interpreters started once (see WarmRunner), instead of starting
+              a new interpreter for every test.
+            - force (bool): run every test, even those whose result is in the
+              result cache (see ResultCache); the cache is still updated.
+            - cache (bool): whether to use the result cache at all.
+            - reporters (list of Reporters.Reporter): given each test as soon as
+              its result is printed.
+            - sandbox (Sandbox): limits the processes of every test (None: no limits
+              other than the timeout, output limit and those of testcase.ini).
+            - submission_name (str): identifies the submission in the history of
+              failures: the path of the zip file or directory given by the user
+              (default: the absolute path of submission_dir, which prep_submission()
+              makes a new temporary directory for a zip file every time).
+            Results are printed in the order of the test names regardless of jobs,
+            except with stop_early: then the tests that the submission failed last
+            time, and those that fail most often, are run and printed first (see
+            TestHistory). With jobs > 1 the tests are otherwise started longest
+            first (according to their durations in the previous runs).
+            The run can be stopped from another thread with cancel().
+        '''
+        self.cancelled.clear()
+        # if C++, then compile once ahead of time, and stage the files linked into every test
+        staging = None
+        staged = ()
         if self.any_language:
-            # os.system("mkdir " + submission_dir + "/.build")
-            os.system("g++ " + submission_dir + "/" + self.problem_name + ".cpp -o " + submission_dir + "/.build/" + self.problem_name + " -c -std=c++11")
-        for (k,v) in sorted(list(self.test_cases.items())):
-            trace("Running tests against script %s" % (k,))
-            for (kk,vv) in sorted(list(v.items())):
-                trace("Running test %s" % (kk,))
-                (result,detail) = \
-                    vv.run_test(submission_dir,timeout,gen_res,visible_space_diff,self.any_language,verbose,script_based)
+            prebuilt = self.build_submission(submission_dir, verbose)
+            (staging, staged) = self.stage_submission_files(submission_dir, prebuilt)
+        if jobs == 0:
+            jobs = os.cpu_count() or 1
+        schedule = [(k,kk,vv) for (k,v) in sorted(list(self.test_cases.items()))
+                              for (kk,vv) in sorted(list(v.items()))]
+        if submission_name is None:
+            submission_name = os.path.abspath(submission_dir)
+        if stop_early: # fail fast
+            schedule.sort(key=lambda test: self.history.failure_priority(submission_name, test[0], test[1]))
+        result_cache = None
+        if cache and not gen_res:
+            # the files staged for a submission in any language include the executables
+            submission_files = staged if self.any_language else \
+                [f for f in glob.glob(os.path.join(submission_dir, "*"))
+                   + glob.glob(os.path.join(submission_dir, ".build", "*")) if os.path.isfile(f)]
+            result_cache = ResultCache(submission_files, (timeout, output_limit
+                , visible_space_diff, script_based, self.any_language
+                , sandbox and sandbox.settings()), self.artifact_store)
+        if not gen_res and not script_based:
+            self.expected_cache.prepare(self.test_cases)
+        warm = warm and not self.any_language and hasattr(os, "fork")
+        runner = WarmRunner(submission_dir, jobs) if warm else None
+        run_args = (submission_dir,timeout,gen_res,visible_space_diff,self.any_language,verbose,script_based,staged,output_limit,runner,self.expected_cache,sandbox,self.artifact_store)
+        def run_test(test_case):
+            return self.__run_test(test_case, run_args, result_cache, force)
+        if jobs > 1:
+            start_order = schedule if stop_early else \
+                sorted(schedule, key=lambda test: -self.history.estimate(test[0], test[1]))
+            completed = self.__run_parallel(schedule, start_order, run_test, jobs)
+        else:
+            completed = self.__run_sequential(schedule, run_test)
+
+        try:
+            for (k,kk,vv,(result,detail)) in completed:
+                if self.cancelled.is_set(): # the test may have been killed
+                    vv.reset_result()
+                    print("Cancelled.")
+                    return
                 if verbose:
                     print("Script %s on test %s: " % (k,kk),end='')
 
                 self.print_result(result, vv, detail, stop_early, verbose)
+                for reporter in reporters:
+                    reporter.report(k, vv)
+                self.history.record(k, vv, submission_name)
 
                 if stop_early and (result != TestCase.PASS and result != TestCase.HARDTEST_FAIL):
                     print("""FAILED TEST CASE FOUND. STOPPING EARLY and preventing all other test runs
 so the issue can be resolved. (To disable this option, see the Options menu\nin the application.)""")
-                    if self.any_language:
-                        os.system("rm -f " + submission_dir + "/.build/" + self.problem_name)
                     return
+        finally:
+            completed.close()
+            if runner is not None:
+                runner.close()
+            if staging is not None:
+                shutil.rmtree(staging, ignore_errors=True)
+            self.__write_manifest(submission_dir, schedule)
+            self.history.save()
 
-        if self.any_language:
-            os.system("rm -f " + submission_dir + "/.build/" + self.problem_name)
         if verbose:
             print("All tests complete.")
 
+    def __write_manifest(self, submission_dir, schedule):
+        '''Records the files of the tests of the run in the artifact store.'''
+        tests = {}
+        for (k,kk,vv) in schedule:
+            if vv.artifacts:
+                tests["%s/%s" % (k,kk)] = {os.path.abspath(path): digest
+                                           for (path, digest) in vv.artifacts.items()}
+        if tests:
+            self.artifact_store.write_manifest({"submission": os.path.abspath(submission_dir)
+                                               , "tests": tests})
+
+    def build_submission(self, submission_dir, verbose=False):
+        '''Compiles the submission (running BUILD_COMMAND on a copy of the
+           files in submission_dir) unless it is in the build cache already.
+           Returns the paths of the executables built, which the tests place
+           into their work directory instead of compiling the submission
+           themselves. Returns () if there is no Makefile or the build failed
+           (in which case each test builds the submission and reports the error).
+        '''
+        if not os.path.isfile(os.path.join(submission_dir, "Makefile")):
+            return ()
+        sources = sorted(f for f in glob.glob(os.path.join(submission_dir, "*"))
+                         if os.path.isfile(f))
+        key = TestSuite.__build_key(sources)
+        try:
+            build_cache_dir = cache_dir(TestSuite.BUILD_CACHE_NAME)
+        except OSError as err: # executables from there could be anyone's
+            if verbose:
+                print("Not using the build cache: %s" % (err,))
+            return ()
+        build_dir = os.path.join(build_cache_dir, key)
+        if os.path.isdir(build_dir):
+            if verbose:
+                print("Using cached build %s" % (build_dir,))
+        else:
+            print("Compiling submission...", end=" ")
+            staging = tempfile.mkdtemp(prefix=key + "-", dir=build_cache_dir)
+            try:
+                for source in sources:
+                    shutil.copyfile(source, os.path.join(staging, os.path.basename(source)))
+                process = run(TestSuite.BUILD_COMMAND, cwd=staging, stdout=PIPE, stderr=STDOUT)
+                if process.returncode:
+                    print("failed.")
+                    if verbose:
+                        print(process.stdout.decode('utf-8', errors='replace'))
+                    return ()
+                # keep only the executables that were built
+                source_names = {os.path.basename(source) for source in sources}
+                for built in glob.glob(os.path.join(staging, "*")):
+                    if not os.path.isfile(built):
+                        shutil.rmtree(built)
+                    elif os.path.basename(built) in source_names or not os.access(built, os.X_OK):
+                        os.remove(built)
+                try:
+                    os.rename(staging, build_dir)
+                except OSError: # built by a concurrent run in the meantime
+                    pass
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            print("Done.")
+        return tuple(sorted(glob.glob(os.path.join(build_dir, "*"))))
+
+    def stage_submission_files(self, submission_dir, prebuilt=()):
+        '''Copies the files of a submission in any language (those of its
+           .build directory and of submission_dir, and the prebuilt executables)
+           once into a new staging directory, and makes them read-only: the tests
+           link them into their work directory instead of copying them.
+           Returns the staging directory and the paths of the staged files.
+        '''
+        sources = {}
+        for path in glob.glob(os.path.join(submission_dir, ".build", "*")) \
+                  + glob.glob(os.path.join(submission_dir, "*")) + list(prebuilt):
+            if os.path.isfile(path):
+                sources[os.path.basename(path)] = path # later files replace earlier ones
+        staging = tempfile.mkdtemp(prefix="staged-")
+        staged = []
+        for (name, path) in sorted(sources.items()):
+            dest = os.path.join(staging, name)
+            shutil.copy2(path, dest)
+            os.chmod(dest, os.stat(dest).st_mode & ~0o222)
+            staged.append(dest)
+        return (staging, tuple(staged))
+
+    @staticmethod
+    def __build_key(sources):
+        '''Hash of the source files and of everything else affecting the build.'''
+        digest = hashlib.sha256()
+        digest.update(repr(TestSuite.BUILD_COMMAND).encode())
+        for var in TestSuite.BUILD_ENV_VARS:
+            digest.update(("%s=%s\0" % (var, os.environ.get(var, ""))).encode())
+        for source in sources:
+            digest.update(os.path.basename(source).encode() + b"\0")
+            with open(source, 'rb') as source_file:
+                digest.update(hashlib.sha256(source_file.read()).digest())
+        return digest.hexdigest()
+
+    def __run_test(self, test_case, run_args, result_cache, force):
+        '''Runs a test (test_case.run_test(*run_args)), unless its result
+           is in result_cache and force is False.
+        '''
+        if result_cache is None:
+            return test_case.run_test(*run_args)
+        key = result_cache.key(test_case)
+        if not force and result_cache.load(test_case, key):
+            print("Running {}... (unchanged)".format(test_case.name), end = " ")
+            return (test_case.result, test_case.result_details)
+        outcome = test_case.run_test(*run_args)
+        # a timeout may pass on a less busy machine, and a cancelled test was killed
+        if test_case.result != TestCase.TIMEOUT and not self.cancelled.is_set():
+            result_cache.save(test_case, key)
+        return outcome
+
+    def __run_sequential(self, schedule, run_test):
+        for (k,kk,vv) in schedule:
+            trace("Running test %s of script %s" % (kk,k))
+            yield (k,kk,vv,run_test(vv))
+
+    def __run_parallel(self, schedule, start_order, run_test, jobs):
+        '''Runs the scheduled tests on a pool of jobs threads (each test
+           runs in a separate process, in its own work directory), starting
+           them in start_order (the same tests as schedule), and yields
+           them in schedule order, each after replaying what it printed.
+           When the consumer stops early, queued tests are cancelled, running
+           ones are killed, and the results of all unreported tests are reset.
+        '''
+        stdout = sys.stdout
+        sys.stdout = ThreadLocalStdout(stdout)
+
+        def run_one(test_case):
+            sys.stdout.capture()
+            try:
+                return run_test(test_case)
+            finally:
+                test_case.output_log = sys.stdout.release()
+
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        started = {id(vv): executor.submit(run_one, vv) for (k,kk,vv) in start_order}
+        futures = [started[id(vv)] for (k,kk,vv) in schedule]
+        reported = 0
+        try:
+            for ((k,kk,vv),future) in zip(schedule, futures):
+                outcome = future.result()
+                stdout.write(vv.output_log)
+                vv.output_log = None
+                reported += 1
+                yield (k,kk,vv,outcome)
+        finally:
+            for future in futures[reported:]:
+                future.cancel()
+            for (k,kk,vv) in schedule[reported:]:
+                vv.kill()
+            executor.shutdown(wait=True)
+            for (k,kk,vv) in schedule[reported:]:
+                vv.reset_result()
+            sys.stdout = stdout
+
+    def cancel(self):
+        '''Stops run_tests (called from another thread): the running tests
+           are killed, and no further tests are started or reported.
+        '''
+        self.cancelled.set()
+        for test_caselist in self.test_cases.values():
+            for test_case in test_caselist.values():
+                test_case.kill()
+
+    def select_shard(self, index, count, by_time=True):
+        '''Keeps only the tests of shard index (1 to count) of the suite.
+           If by_time, the tests are dealt out longest first, each to the
+           shard with the least expected time so far, so that the shards take
+           about the same time: the machines running the shards must share
+           the history (a file given to TestSuite) to split the suite the same
+           way. Otherwise the tests are dealt out in the order of their names,
+           which every machine does alike. Returns the number of tests kept
+           and their expected seconds.
+        '''
+        tests = sorted(((-self.history.estimate(k,kk),k,kk) for (k,v) in self.test_cases.items()
+                                                           for kk in v))
+        if not by_time:
+            tests.sort(key=lambda test: test[1:])
+        loads = [0.0] * count
+        kept = set()
+        for (position,(negative_estimate,k,kk)) in enumerate(tests):
+            shard = loads.index(min(loads)) if by_time else position % count
+            loads[shard] -= negative_estimate
+            if shard == index - 1:
+                kept.add((k,kk))
+        for (k,v) in list(self.test_cases.items()):
+            self.test_cases[k] = {kk: vv for (kk,vv) in v.items() if (k,kk) in kept}
+            if not self.test_cases[k]:
+                del self.test_cases[k]
+        return (len(kept), loads[index - 1])
+
+    def reset_results(self):
+        for test_caselist in self.test_cases.values():
+            for test_case in test_caselist.values():
+                test_case.reset_result()
+
     def get_summary(self,script_name=None):
         tests = 0
         errs = 0
         softtest_fails = 0
         hardtest_fails = 0
         passes = 0
+        slowest = None  # the test with the longest run
+        biggest = None  # the test with the highest peak memory
+        cpu_time = 0
         for (k,v) in sorted(list(self.test_cases.items())):
             if script_name==None or script_name==k:
                 for (kk,vv) in sorted(list(v.items())):
                     tests += 1
-                    if vv.result==TestCase.ERR or vv.result==TestCase.TIMEOUT:
+                    if vv.wall_time is not None and (slowest is None or vv.wall_time > slowest.wall_time):
+                        slowest = vv
+                    if vv.max_rss is not None and (biggest is None or vv.max_rss > biggest.max_rss):
+                        biggest = vv
+                    if vv.user_time is not None:
+                        cpu_time += vv.user_time + vv.sys_time
+                    if vv.is_err():
                         errs += 1
                     elif vv.result==TestCase.SOFTTEST_FAIL:
                         softtest_fails += 1
@@ -253,6 +645,10 @@ so the issue can be resolved. (To disable this option, see the Options menu\nin
                     elif vv.result == TestCase.PASS:
                         passes += 1
 
+        if slowest is not None:
+            print("Total CPU time: %.2f s. Slowest test: %s [%s]" % (cpu_time, slowest.name, slowest.get_usage_str()))
+        if biggest is not None:
+            print("Highest peak memory: %s (%.1f MB)" % (biggest.name, biggest.max_rss / (1024 * 1024)))
         if (errs == 0 and softtest_fails == 0 and passes == tests):
             print("All tests passed.\n")
         else:
@@ -0,0 +1,261 @@
+######################################################################
+#   File: WarmRunner.py
+#
+#   Description:
+#       Runs python submissions without starting a new interpreter for
+#       every test. A pool of server interpreters is started once per
+#       test run; each server imports the modules used by the
+#       submission and then forks a fresh child for every test, so the
+#       tests remain isolated from each other.
+#
+#   Included functions:
+#       - serve(), run_child(), finish(), reseed(), imported_modules()
+#
+#   Included classes:
+#       - WarmRunner() manages the pool of servers, and is used by
+#       TestCase.run_test() instead of starting the script in a shell.
+#       - WarmProcess() stands for the process of a test run by a server.
+#
+######################################################################
+
+import ast
+import atexit
+import gc
+import glob
+import io
+import json
+import os
+import queue
+import random
+import runpy
+import select
+import signal
+import sys
+import traceback
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+try:
+    import resource # not available on Windows
+except ImportError:
+    resource = None
+from Sandbox import apply_limits
+
+
+class WarmProcess:
+    '''The process of a test started by a server. Supports the parts of the
+       Popen interface used by TestCase (pid, poll(), wait() and kill()).'''
+    def __init__(self, server, pid):
+        self.server = server
+        self.pid = pid
+        self.returncode = None
+        self.rusage = None  # resource usage, sent by the server with the exit status
+        self.status_lost = False # the server reaps the process itself
+        self.parent_maxrss = None # the peak memory of the server, sent with the exit status
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        os.killpg(self.pid, signal.SIGKILL)
+
+    def wait(self, timeout=None):
+        '''Waits for the exit status (sent by the server); raises
+           TimeoutExpired if the process is still running after timeout seconds.'''
+        if self.returncode is None:
+            ready = select.select([self.server.stdout], [], [], timeout)[0]
+            if not ready:
+                raise TimeoutExpired(self.pid, timeout)
+            reply = self.server.stdout.readline()
+            if not reply: # the server died
+                self.returncode = -signal.SIGKILL
+                return self.returncode
+            reply = json.loads(reply)
+            self.returncode = reply["status"]
+            if resource is not None:
+                self.rusage = resource.struct_rusage(reply["rusage"])
+                self.parent_maxrss = reply["parent_maxrss"]
+        return self.returncode
+
+
+class WarmRunner:
+    def __init__(self, submission_dir, size):
+        '''Starts size servers that preload the modules imported by the
+           python files of submission_dir.'''
+        self.submission_dir = os.path.abspath(submission_dir)
+        self.servers = queue.Queue()
+        for i in range(size):
+            self.servers.put(self.__start_server())
+
+    def __start_server(self):
+        # unbuffered, so that select() sees every reply that was not read yet
+        return Popen([sys.executable, os.path.abspath(__file__), self.submission_dir]
+                    , stdin=PIPE, stdout=PIPE, stderr=DEVNULL, bufsize=0)
+
+    def start(self, work_path, script_path, argv, stdin_path, stdout_path, stderr_path
+             , limits=(), cgroup=None, unshare_flags=0):
+        '''Runs the script in a forked child of a server and returns its
+           WarmProcess; the server must be given back with release().
+           The child is limited as by Sandbox.limited_command().
+        '''
+        request = json.dumps({"cwd": work_path, "script": script_path, "argv": argv
+                             , "stdin": stdin_path, "stdout": stdout_path
+                             , "stderr": stderr_path, "limits": limits
+                             , "cgroup": cgroup, "unshare_flags": unshare_flags})
+        server = self.servers.get()
+        for attempt in range(2):
+            try:
+                server.stdin.write(request.encode() + b"\n")
+                reply = server.stdout.readline()
+                if reply:
+                    return WarmProcess(server, json.loads(reply)["pid"])
+            except (OSError, ValueError):
+                pass
+            # the server died: replace it
+            server.kill()
+            server.wait()
+            server = self.__start_server()
+        self.servers.put(server)
+        raise RuntimeError("The warm runner could not start %s" % (script_path,))
+
+    def release(self, process):
+        self.servers.put(process.server)
+
+    def close(self):
+        while not self.servers.empty():
+            server = self.servers.get()
+            server.stdin.close()
+            server.wait()
+
+
+def imported_modules(submission_dir):
+    '''Names of the top level modules imported by the python files in
+       submission_dir, except for the modules of the submission itself.'''
+    local = {os.path.splitext(os.path.basename(f))[0]
+             for f in glob.glob(os.path.join(submission_dir, "*"))}
+    modules = set()
+    for path in glob.glob(os.path.join(submission_dir, "*.py")):
+        try:
+            with open(path, 'rb') as source:
+                tree = ast.parse(source.read(), path)
+        except (SyntaxError, ValueError, OSError):
+            continue
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules.update(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+                modules.add(node.module.split(".")[0])
+    return sorted(modules - local)
+
+
+def reseed():
+    '''Seeds the random generators of the (just forked) child from the
+       entropy of the system, as a new interpreter would: otherwise every
+       child of a server draws the same "random" numbers. The hash seed of
+       str and bytes (PYTHONHASHSEED) is still that of the server.
+    '''
+    random.seed()
+    numpy = sys.modules.get("numpy") # if a module of the submission imported it
+    if numpy is not None and hasattr(numpy, "random"):
+        numpy.random.seed()
+
+
+def run_child(request):
+    '''Runs the requested script in the (just forked) child process, in the
+       same way as "python script args" with redirected streams would.'''
+    os.setsid()
+    # the server has no other threads: the limits can be applied here
+    apply_limits(request["limits"], request["cgroup"], request["unshare_flags"])
+    reseed()
+    os.chdir(request["cwd"])
+    stdin_path = request["stdin"] or os.devnull
+    for (fd, path, flags) in ((0, stdin_path, os.O_RDONLY)
+                             , (1, request["stdout"], os.O_WRONLY | os.O_TRUNC)
+                             , (2, request["stderr"], os.O_WRONLY | os.O_TRUNC)):
+        file_fd = os.open(path, flags)
+        os.dup2(file_fd, fd)
+        os.close(file_fd)
+    sys.stdin = sys.__stdin__ = io.TextIOWrapper(io.open(0, 'rb', closefd=False))
+    sys.stdout = sys.__stdout__ = io.TextIOWrapper(io.open(1, 'wb', closefd=False))
+    sys.stderr = sys.__stderr__ = io.TextIOWrapper(io.open(2, 'wb', closefd=False)
+                                                  , errors="backslashreplace", line_buffering=True)
+    sys.argv = [request["script"]] + request["argv"]
+    sys.path[0] = os.path.dirname(request["script"])
+    status = 0
+    try:
+        runpy.run_path(request["script"], run_name="__main__")
+    except SystemExit as exit:
+        if exit.code is None:
+            status = 0
+        elif isinstance(exit.code, int):
+            status = exit.code
+        else:
+            print(exit.code, file=sys.stderr)
+            status = 1
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    os._exit(finish(status) & 0xff)
+
+
+def finish(status):
+    '''Ends the script in the child the way the interpreter ends: waits for
+       the threads it started, runs its atexit functions, flushes the files
+       it left open (which the interpreter flushes when it releases them),
+       then the streams. Returns the exit status.'''
+    threading = sys.modules.get("threading")
+    if threading is not None:
+        try:
+            threading._shutdown()
+        except BaseException:
+            traceback.print_exc()
+    atexit._run_exitfuncs()
+    # before the collection of the garbage: a file in a reference cycle may be
+    # released after its buffer, losing the text not written yet
+    for stream in gc.get_objects():
+        if isinstance(stream, io.IOBase) and stream not in (sys.stdout, sys.stderr):
+            try:
+                if not stream.closed and stream.writable():
+                    stream.flush()
+            except (OSError, ValueError): # ignored, as by the interpreter
+                pass
+    gc.collect() # runs the finalizers of the objects left by the script
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except OSError: # e.g. the output limit was exceeded
+        status = status or 1
+    return status
+
+
+def serve(submission_dir):
+    '''Server loop: reads one request per line from stdin, forks a child
+       running the request, replies with its pid and then its exit status.'''
+    for module in imported_modules(submission_dir):
+        try:
+            __import__(module)
+        except BaseException: # only preloading: the test reports the error
+            pass
+    control_in = sys.stdin.buffer
+    control_out = sys.stdout.buffer
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for line in control_in:
+        request = json.loads(line)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_child(request)
+            finally:
+                os._exit(1)
+        control_out.write(json.dumps({"pid": pid}).encode() + b"\n")
+        control_out.flush()
+        (pid, status, rusage) = os.wait4(pid, 0)
+        control_out.write(json.dumps({"status": os.waitstatus_to_exitcode(status)
+                                     , "rusage": list(rusage)
+                                     , "parent_maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                                     }).encode() + b"\n")
+        control_out.flush()
+
+
+if __name__ == "__main__":
+    sys.path[0] = sys.argv[1] # imports are resolved as in the submission
+    serve(sys.argv[1])
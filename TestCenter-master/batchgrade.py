@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+######################################################################
+#   File: batchgrade.py
+#
+#   Description:
+#       Grades a collection of submissions (e.g. all morning problem
+#       submissions of a class) against a single test suite, and
+#       writes one row per submission into a CSV results table.
+#       Replaces the loop in run-tests_morning_problem.sh, which
+#       started a new testcenter.py (and collected the tests again)
+#       for every submission. With --listen, the submissions are
+#       graded by workers (gradeworker.py) on this and other machines
+#       instead (see GradingQueue.py).
+#
+#   Included functions:
+#       - main(), find_submissions(), stage_submission(),
+#         init_worker(), grade_submission()
+#
+######################################################################
+
+import argparse
+import contextlib
+import csv
+import glob
+import os
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import TestSuite
+import GradingQueue
+from Sandbox import Sandbox
+
+# columns of the results table
+RESULT_FIELDS = ("submission", "verdict", "tests", "passes", "errors"
+                , "failures", "presentation_errors", "seconds", "message")
+
+# options of main() used by grade_submission, which are sent to remote workers
+WORKER_OPTIONS = ("script_name", "timeout", "stop_early", "sandbox", "sandbox_memory"
+                 , "sandbox_processes")
+
+# state of a worker process (set up by init_worker)
+worker = {}
+
+
+def find_submissions(srcdir, script_name, test_directory):
+    '''Returns the submissions found in srcdir: the files having the same
+       extension as script_name, and the directories or zip files holding a
+       complete submission (other than the test and result directories).
+    '''
+    ext = os.path.splitext(script_name)[1]
+    skip = {os.path.abspath(test_directory)} \
+         | {os.path.abspath(os.path.join(srcdir, d)) for d in ("passed", "failed")}
+    submissions = []
+    for path in sorted(glob.glob(os.path.join(srcdir, "*"))):
+        if os.path.abspath(path) in skip:
+            continue
+        if os.path.isdir(path) or path.lower().endswith(".zip") \
+                or (os.path.isfile(path) and path.endswith(ext)):
+            submissions.append(path)
+    return submissions
+
+
+def stage_submission(submission, script_name, assignment_name, srcdir, work_dir):
+    '''Returns the directory to run the tests against.
+       A single file is copied into work_dir as script_name, together with
+       the shell scripts and the .build directory of srcdir (used by C++
+       submissions); directories and zip files are used as they are.
+    '''
+    if not os.path.isfile(submission) or submission.lower().endswith(".zip"):
+        return TestSuite.prep_submission(submission, assignment_name, verify_dir_structure=False)
+    stage = os.path.join(work_dir, "submission")
+    shutil.rmtree(stage, ignore_errors=True)
+    os.mkdir(stage)
+    shutil.copyfile(submission, os.path.join(stage, script_name))
+    for script in glob.glob(os.path.join(srcdir, "*.sh")):
+        shutil.copy2(script, stage)
+    if os.path.isdir(os.path.join(srcdir, ".build")):
+        shutil.copytree(os.path.join(srcdir, ".build"), os.path.join(stage, ".build"))
+    return stage
+
+
+def init_worker(test_suite, options, grading_dir):
+    '''Sets up a worker process: the outputs and error reports of the
+       tests are redirected from the test-case tree into a private
+       directory in grading_dir, so that workers do not overwrite each
+       other's outputs.
+    '''
+    work_dir = tempfile.mkdtemp(prefix="worker-", dir=grading_dir)
+    for script_name, script_tests in test_suite.test_cases.items():
+        output_path = os.path.join(work_dir, script_name, TestSuite.TestSuite.OUTPUT_DIR)
+        err_path = os.path.join(work_dir, script_name, TestSuite.TestSuite.ERROR_DIR)
+        os.makedirs(output_path)
+        os.makedirs(err_path)
+        for test_case in script_tests.values():
+            test_case.output_path = output_path
+            test_case.err_path = err_path
+    sandbox = None
+    if options.sandbox:
+        sandbox = Sandbox(memory=int(options.sandbox_memory * 1024 * 1024)
+                         , processes=options.sandbox_processes)
+    worker.update(test_suite=test_suite, options=options, work_dir=work_dir, sandbox=sandbox)
+
+
+def grade_submission(submission, submission_name=None):
+    '''Runs the test suite of the worker against a submission and returns
+       the row of the results table. submission_name names the submission in
+       the history of failures (default: the absolute path of submission;
+       a remote worker gives its path on the coordinator).
+    '''
+    test_suite, options = worker["test_suite"], worker["options"]
+    row = dict.fromkeys(RESULT_FIELDS, "")
+    row["submission"] = os.path.basename(submission)
+    start = time.time()
+    test_suite.reset_results()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            script_dir = stage_submission(submission, options.script_name
+                                         , test_suite.assignment_name
+                                         , options.srcdir, worker["work_dir"])
+            test_suite.run_tests(script_dir, timeout=options.timeout, gen_res=False
+                                , visible_space_diff=False, verbose=False
+                                , stop_early=options.stop_early, cache=False
+                                , sandbox=worker["sandbox"]
+                                , submission_name=submission_name or os.path.abspath(submission))
+            (tests, errs, softtest_fails, hardtest_fails) = test_suite.get_summary()
+    except RuntimeError as err:
+        row.update(verdict="error", message=str(err))
+    else:
+        passes = sum(test_case.is_pass() for script_tests in test_suite.test_cases.values()
+                     for test_case in script_tests.values())
+        passed = errs == 0 and softtest_fails == 0
+        row.update(verdict="passed" if passed else "failed", tests=tests, passes=passes
+                  , errors=errs, failures=softtest_fails, presentation_errors=hardtest_fails)
+    row["seconds"] = "%.2f" % (time.time() - start)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Grade all submissions in a directory against one test suite.')
+    parser.add_argument(
+        'srcdir',
+        help='directory containing the submissions (files, directories or zip '
+             'files) and the test-cases directory')
+    parser.add_argument(
+        'script_name',
+        help="the problem's script filename, e.g. songs.py; submitted files "
+             "are renamed to this before testing")
+    parser.add_argument(
+        'submission',
+        nargs='?',
+        help='grade only this submission and print the result instead of '
+             'sorting the submissions into passed/ and failed/')
+    parser.add_argument(
+        '--test_directory',
+        '-t',
+        help='directory containing the tests (defaults to srcdir/test-cases)')
+    parser.add_argument(
+        '--results',
+        '-o',
+        help='CSV file the results table is written to (defaults to srcdir/results.csv)')
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=0,
+        help='number of submissions graded in parallel (0: one per CPU)')
+    parser.add_argument('--timeout', type=float, default=5
+                       , help='Terminate a test with an error after the '\
+                              'timeout has passed')
+    parser.add_argument(
+        '--stop_early',
+        '-e',
+        action='store_true',
+        help='stop grading a submission after its first failed test')
+    parser.add_argument(
+        '--sandbox',
+        action='store_true',
+        help='limit the address space, processes and open files of the tests, '
+             'and run them without network where possible (see Sandbox.py)')
+    parser.add_argument('--sandbox_memory', type=float
+                       , default=Sandbox.MEMORY_DEFAULT / (1024 * 1024)
+                       , help='megabytes of address space of each process of a '
+                              'sandboxed test')
+    parser.add_argument('--sandbox_processes', type=int, default=Sandbox.PROCESSES_DEFAULT
+                       , help='processes a sandboxed test may have at a time')
+    parser.add_argument(
+        '--listen',
+        metavar='[HOST:]PORT',
+        help='have the submissions graded by workers connecting to this address '
+             '(python3 gradeworker.py HOST:PORT --token TOKEN) instead of by local '
+             'processes; use 127.0.0.1:PORT to accept workers of this machine only')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='with --listen, number of workers started on this machine')
+    parser.add_argument(
+        '--token',
+        help='with --listen, the token the workers must present (default: a random one, '
+             'which is printed)')
+    args = parser.parse_args()
+
+    srcdir = args.srcdir
+    test_directory = args.test_directory or os.path.join(srcdir, "test-cases")
+    results = args.results or os.path.join(srcdir, "results.csv")
+    jobs = args.jobs or os.cpu_count() or 1
+    try:
+        print("Collecting tests from %s" % test_directory)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            test_suite = TestSuite.TestSuite(test_directory, any_language=True)
+            test_suite.collect_tests(create_missing_dirs=False)
+        print("# of tests found = %s" % sum(len(v) for v in test_suite.test_cases.values()))
+    except RuntimeError as err:
+        print("Error:\n" + str(err))
+        return
+
+    if args.submission:
+        submissions = [args.submission]
+    else:
+        submissions = find_submissions(srcdir, args.script_name, test_directory)
+        for verdict in ("passed", "failed"):
+            shutil.rmtree(os.path.join(srcdir, verdict), ignore_errors=True)
+            os.mkdir(os.path.join(srcdir, verdict))
+    grading_dir = tempfile.mkdtemp(prefix="grade-")
+    local_workers = []
+    with contextlib.ExitStack() as stack:
+        if args.listen:
+            token = args.token or secrets.token_hex(16)
+            options = {name: getattr(args, name) for name in WORKER_OPTIONS}
+            coordinator = GradingQueue.Coordinator(GradingQueue.parse_address(args.listen), token
+                , options, test_directory, srcdir, submissions)
+            (host, port) = coordinator.address
+            print("Grading %s submission(s) on the workers connecting to port %s (token %s)..."
+                  % (len(submissions), port, token))
+            if host in ("", "0.0.0.0", "::"):
+                host = "127.0.0.1"
+            worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gradeworker.py")
+            local_workers = [subprocess.Popen([sys.executable, worker_script
+                                              , "%s:%s" % (host, port), "--token", token])
+                             for i in range(args.workers)]
+            graded = coordinator.run()
+        else:
+            print("Grading %s submission(s) with %s worker(s)..." % (len(submissions), jobs))
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=jobs
+                , initializer=init_worker, initargs=(test_suite, args, grading_dir)))
+            graded = zip(submissions, executor.map(grade_submission, submissions))
+        results_file = stack.enter_context(open(results, 'w', newline=''))
+        writer = csv.DictWriter(results_file, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        for (submission, row) in graded:
+            writer.writerow(row)
+            results_file.flush()
+            print("%s: %s" % (row["submission"], row["verdict"].capitalize()))
+            if not args.submission:
+                verdict = "passed" if row["verdict"] == "passed" else "failed"
+                dest = os.path.join(srcdir, verdict, os.path.basename(submission))
+                if os.path.isdir(submission):
+                    shutil.copytree(submission, dest)
+                else:
+                    shutil.copy2(submission, dest)
+    for worker_process in local_workers:
+        worker_process.wait()
+    shutil.rmtree(grading_dir, ignore_errors=True)
+    print("Results written to %s" % results)
+
+
+if __name__ == "__main__":
+    main()
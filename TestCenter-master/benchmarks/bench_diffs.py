@@ -0,0 +1,112 @@
+######################################################################
+#   File: benchmarks/bench_diffs.py
+#
+#   Description:
+#       Times diffs.diff() against the comparison it replaced (which
+#       always built the difflib report of the soft-test) on large
+#       matrix outputs that pass, that differ in whitespace only, and
+#       that fail.
+#
+#   Usage:
+#       python3 benchmarks/bench_diffs.py [--rows N] [--columns N]
+#
+######################################################################
+
+import argparse
+import difflib
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import diffs
+
+
+def legacy_diff(actual, expected, is_text_exp, visible_diff):
+    '''diffs.diff() as it was before the linear-time fast path (a copy, as
+       the functions it used have changed since).'''
+    softtest_diffs = None
+    hardtest_diffs = None
+    if is_text_exp:
+        softtest_diffs = legacy_softtest_diff(expected, actual)
+        if not softtest_diffs:
+            if visible_diff:
+                expected = legacy_clean_data(expected, r'[\s\n]', '#', True)
+                actual = legacy_clean_data(actual, r'[\s\n]', '#', True)
+            hardtest_diffs = legacy_hardtest_diff(expected, actual)
+        else:
+            softtest_diffs = legacy_hardtest_diff(expected, actual)
+    elif actual != expected:
+        softtest_diffs = actual
+    return (softtest_diffs, hardtest_diffs)
+
+
+def legacy_clean_data(data, patt, repl, hard_test=False):
+    '''diffs.clean_data() as it was.'''
+    cleaned = []
+    for line in data:
+        if not hard_test:
+            line = line.strip()
+            if not line:
+                continue
+        cleaned.append(re.sub(patt, repl, line) + '\n')
+    return cleaned
+
+
+def legacy_hardtest_diff(expected, actual, fuzz_level=0):
+    '''diffs.get_hardtest_diff() as it was: the whole difflib.Differ report.'''
+    diff_result = list(difflib.Differ().compare(expected, actual))
+    count = 0
+    for line in diff_result:
+        if line[0] == '+' or line[0] == '-':
+            count += 1
+            if count >= fuzz_level:
+                return diff_result
+    return []
+
+
+def legacy_softtest_diff(expected, actual, fuzz_level=0):
+    '''diffs.get_softtest_diff() as it was.'''
+    return legacy_hardtest_diff(legacy_clean_data(expected, r'\s+', '')
+                               , legacy_clean_data(actual, r'\s+', ''), fuzz_level)
+
+
+def matrix_lines(rows, columns, seed=0):
+    '''The lines printed for a rows x columns float matrix.'''
+    return ["%s\n" % " ".join("%g" % ((r * columns + c + seed) % 997 / 8.0)
+                              for c in range(columns)) for r in range(rows)]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - start, result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark diffs.diff() on large outputs.')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--columns', type=int, default=200)
+    args = parser.parse_args()
+
+    expected = matrix_lines(args.rows, args.columns)
+    size = sum(len(line) for line in expected)
+    cases = (
+        ("pass", list(expected)),
+        ("presentation error", expected[:-1] + [expected[-1].replace("\n", " \n")]),
+        ("fail (one value)", expected[:-1] + ["0 " + expected[-1]]),
+    )
+    print("%d x %d matrix, %.1f MB of output" % (args.rows, args.columns, size / 1e6))
+    print("%-20s %12s %12s" % ("case", "diff (s)", "legacy (s)"))
+    for (name, actual) in cases:
+        (fast, fast_result) = timed(diffs.diff, actual, expected, True, True)
+        (legacy, legacy_result) = timed(legacy_diff, actual, expected, True, True)
+        # the reports differ in form (see diffs.diff_report()), not the verdicts
+        assert [bool(report) for report in fast_result] == [bool(report) for report in legacy_result] \
+            , "results differ for %s" % name
+        print("%-20s %12.3f %12.3f" % (name, fast, legacy))
+
+
+if __name__ == "__main__":
+    main()
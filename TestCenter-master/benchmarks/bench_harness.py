@@ -0,0 +1,213 @@
+######################################################################
+#   File: benchmarks/bench_harness.py
+#
+#   Description:
+#       Benchmarks the test center itself (not the submissions) on
+#       synthetic test-case trees, and writes the results as JSON so
+#       that they can be compared between versions. The submission of
+#       the synthetic trees is a build script that runs cat, so the
+#       times measured are the overhead of the harness. Measured:
+#           - collect: TestSuite() and collect_tests() on trees of
+#             10, 1k and 10k cases, without and with the index
+#           - run_test: time per test of trees whose stdin is a few
+#             bytes to 100 MB
+#           - diff: diffs.diff() on large passing and failing outputs
+#           - suite: tests per second of whole runs (run_tests and
+#             get_summary) on trees with passing and failing tests
+#
+#   Usage:
+#       python3 benchmarks/bench_harness.py [--cases 10,1000,10000]
+#           [--stdin-sizes 16,1M,100M] [--max-run N] [--jobs N]
+#           [--output results.json]
+#
+######################################################################
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import diffs
+import ResultCache
+import TestIndex
+import TestSuite
+from bench_diffs import matrix_lines
+
+ASSIGNMENT = "as-900-1"
+SCRIPT_NAME = "cat.cpp"
+
+
+def parse_size(text):
+    '''Parses a size such as 16, 64K, 1M or 100M (in bytes).'''
+    units = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def make_submission(root):
+    '''A submission in any language whose build script copies stdin to stdout.'''
+    submission = os.path.join(root, "submission")
+    os.makedirs(os.path.join(submission, ".build"))
+    build_script = os.path.join(submission, ".build", "build.sh")
+    with open(build_script, "w") as script:
+        script.write("#!/bin/sh\nexec cat\n")
+    os.chmod(build_script, 0o755)
+    return submission
+
+
+def make_tree(root, cases, stdin_size=16, fail_every=0):
+    '''Creates a test-case directory of cases tests, each with a stdin of
+       about stdin_size bytes. Every fail_every-th test expects a different
+       output (0: all tests pass). Returns the test-case directory.
+    '''
+    testcase_dir = os.path.join(root, "test-cases")
+    test_path = os.path.join(testcase_dir, "%s-%s-test" % (ASSIGNMENT, SCRIPT_NAME))
+    for fld in TestSuite.TestSuite.TESTCASE_SUBDIRECTORIES:
+        os.makedirs(os.path.join(test_path, fld))
+    line = b"0123456789 abcdefghijklmnopqrstuvwxyz ABCDEFGHIJKLMNOPQRSTUVWXYZ\n"
+    for i in range(cases):
+        name = "t%05d" % i
+        data = line * max(1, stdin_size // len(line))
+        with open(os.path.join(test_path, "Inputs", name + "-stdin.txt"), "wb") as stdin:
+            stdin.write(data)
+        with open(os.path.join(test_path, "Expected", name + "-stdout.txt"), "wb") as expected:
+            expected.write(data)
+            if fail_every and i % fail_every == 0:
+                expected.write(b"a line that cat does not print\n")
+        open(os.path.join(test_path, "Expected", name + "-stderr.txt"), "wb").close()
+    return testcase_dir
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return (time.perf_counter() - start, result)
+
+
+def collect(testcase_dir):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        test_suite = TestSuite.TestSuite(testcase_dir, any_language=True)
+        test_suite.collect_tests(create_missing_dirs=False)
+    return test_suite
+
+
+def run_suite(test_suite, submission, jobs, output_limit=None):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        test_suite.run_tests(submission, timeout=600, gen_res=False, visible_space_diff=False
+                            , verbose=False, stop_early=False, jobs=jobs
+                            , output_limit=output_limit, cache=False)
+        return test_suite.get_summary()
+
+
+def bench_collect(root, cases):
+    '''Seconds to collect a tree of cases tests, without and with the index.'''
+    testcase_dir = make_tree(root, cases)
+    shutil.rmtree(os.path.join(ResultCache.CACHE_ROOT, TestIndex.TestIndex.INDEX_NAME)
+                 , ignore_errors=True)
+    (cold, test_suite) = timed(collect, testcase_dir)
+    (indexed, test_suite) = timed(collect, testcase_dir)
+    return {"cases": cases, "cold_s": cold, "indexed_s": indexed}
+
+
+def bench_run_test(root, stdin_size, jobs):
+    '''Seconds per test of a run of passing tests with the given stdin size.'''
+    cases = 3 if stdin_size >= 16 * 1024 * 1024 else 20
+    testcase_dir = make_tree(root, cases, stdin_size)
+    submission = make_submission(root)
+    test_suite = collect(testcase_dir)
+    (seconds, summary) = timed(run_suite, test_suite, submission, jobs, 2 * stdin_size + 1024)
+    return {"stdin_bytes": stdin_size, "cases": cases, "errors": summary[1]
+           , "per_test_s": seconds / cases}
+
+
+def bench_diff(rows, columns):
+    '''Seconds of diffs.diff() on a passing, a whitespace-only and a failing output.'''
+    expected = matrix_lines(rows, columns)
+    cases = (
+        ("pass", list(expected)),
+        ("presentation_error", expected[:-1] + [expected[-1].replace("\n", " \n")]),
+        ("fail", expected[:-1] + ["0 " + expected[-1]]),
+    )
+    results = {"bytes": sum(len(line) for line in expected)}
+    for (name, actual) in cases:
+        results[name + "_s"] = timed(diffs.diff, actual, expected, True, True)[0]
+    return results
+
+
+def bench_suite(root, cases, jobs):
+    '''Throughput of a whole run on a tree where every tenth test fails.'''
+    testcase_dir = make_tree(root, cases, fail_every=10)
+    submission = make_submission(root)
+    test_suite = collect(testcase_dir)
+    (seconds, summary) = timed(run_suite, test_suite, submission, jobs)
+    (tests, errs, softtest_fails, hardtest_fails) = summary
+    return {"cases": cases, "jobs": jobs, "seconds": seconds, "tests_per_s": tests / seconds
+           , "errors": errs, "failures": softtest_fails}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the test center on synthetic tests.')
+    parser.add_argument('--cases', default="10,1000,10000"
+                       , help='comma separated numbers of tests of the trees collected')
+    parser.add_argument('--stdin-sizes', default="16,1M,100M"
+                       , help='comma separated stdin sizes of the run_test benchmark')
+    parser.add_argument('--max-run', type=int, default=1000
+                       , help='largest tree run as a whole (larger ones are only collected)')
+    parser.add_argument('--jobs', '-j', type=int, default=1
+                       , help='number of tests run in parallel')
+    parser.add_argument('--rows', type=int, default=2000, help='rows of the diff benchmark')
+    parser.add_argument('--columns', type=int, default=200, help='columns of the diff benchmark')
+    parser.add_argument('--output', '-o', help='JSON file written (default: stdout)')
+    args = parser.parse_args()
+
+    case_counts = [int(cases) for cases in args.cases.split(",")]
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "collect": [], "run_test": [], "diff": None, "suite": [],
+    }
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    # keep the caches, the history and the artifacts of the synthetic trees out of
+    # those of the user (they all go to work_dir, removed at the end)
+    ResultCache.CACHE_ROOT = os.path.join(work_dir, "cache")
+    def scratch(name):
+        path = os.path.join(work_dir, name)
+        os.mkdir(path)
+        return path
+    try:
+        for cases in case_counts:
+            print("collect: %d cases" % cases, file=sys.stderr)
+            results["collect"].append(bench_collect(scratch("collect-%d" % cases), cases))
+        for size in args.stdin_sizes.split(","):
+            print("run_test: stdin of %s bytes" % size, file=sys.stderr)
+            results["run_test"].append(bench_run_test(scratch("run-%s" % size)
+                                                     , parse_size(size), args.jobs))
+        print("diff: %d x %d matrix" % (args.rows, args.columns), file=sys.stderr)
+        results["diff"] = bench_diff(args.rows, args.columns)
+        for cases in case_counts:
+            if cases <= args.max_run:
+                print("suite: %d cases" % cases, file=sys.stderr)
+                results["suite"].append(bench_suite(scratch("suite-%d" % cases), cases, args.jobs))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,15 +10,59 @@
 #         This is set to 0 by default.
 #
 #   Included functions:
-#       - diff(), clean_data(), get_hardtest_diff(), 
-#         get_softtest_diff()
+#       - diff(), diff_files(), is_text_file(), read_file(),
+#         expected_forms(), soft_lines(), soft_equal(), clean_data(),
+#         get_hardtest_diff(), count_differences(), diff_report(),
+#         changed_groups(), hunk_lines(), fancy_replace(), cut_line(),
+#         get_softtest_diff(), get_numeric_diff(), numbers_close(),
+#         first_byte_difference(), first_line_difference(), spill_lines()
+#
+#   Included classes:
+#       - FileLines() the lines of a text file, read from the file each
+#       time they are iterated over.
+#       - DiffLines() the lines of a diff written to a file by
+#       spill_lines(), used in place of the list of lines.
 #
 ######################################################################
 
+import codecs
 import difflib  # tool used to generate quick difference output
+import itertools
+import math
+import mmap
+import os
 import re       
 
-def diff(actual,expected,is_text_exp,visible_diff):
+# files of at least this many bytes are compared by diff_files() without
+# reading them into memory
+LARGE_FILE = 8 * 1024 * 1024
+# bytes compared at a time when looking for the first difference
+CHUNK_SIZE = 1024 * 1024
+# lines shown before and after the first difference of large text files,
+# and characters kept of each of them (and of every line of a diff report)
+CONTEXT_LINES = 20
+CONTEXT_LINE_LIMIT = 1000
+# bytes of a large binary output kept around its first difference
+CONTEXT_BYTES = 4096
+# bytes at the start of a file looked at by is_text_file(), and the control
+# characters (other than whitespace) that text that is not UTF-8 never has
+SNIFF_SIZE = 8192
+CONTROL_BYTES = re.compile(b'[\x00-\x08\x0e-\x1f\x7f]')
+# the patterns given to clean_data(): whitespace (removed by the soft-test)
+# and the characters shown as '#' by visible diffs
+WHITESPACE = re.compile(r'\s+')
+VISIBLE_SPACE = re.compile(r'[\s\n]')
+# unchanged lines shown around each change in a diff report, and lines after
+# which the report stops (set by --diff_context and --diff_lines)
+DIFF_CONTEXT = 3
+DIFF_LINES = 200
+# changed blocks of at most this many pairs of lines, and whose characters on
+# each side multiply to at most FANCY_REPLACE_CHARS, are compared character by
+# character ("? " lines): the cost grows with the product of their lengths
+FANCY_REPLACE_PAIRS = 2500
+FANCY_REPLACE_CHARS = 16 * 1000 * 1000
+
+def diff(actual,expected,is_text_exp,visible_diff,tolerance=None,forms=None):
     '''Compares actual and expected and returns differences.
 
         When expected parameter is text (is_text_exp==True) then
@@ -33,6 +77,10 @@ def diff(actual,expected,is_text_exp,visible_diff):
         When visible_diff==True, whitespaces are replaced by '#'
         when computing the soft-test diff.
 
+        When a tolerance is given, text is compared as a sequence of
+        whitespace separated tokens instead (see get_numeric_diff()),
+        so there are no whitespace (hard-test) differences.
+
         When the expected parameter is binary, byte-by-byte comparison
         is used and the pair (actual,None) is returned if differences
         are detected. 
@@ -43,6 +91,10 @@ def diff(actual,expected,is_text_exp,visible_diff):
             is_text_exp (bool): text flag (if true, expect text, else expect binary)      
             visible_diff (bool): determines whether or not to replace spaces with # characters
                           to make differences visible
+            tolerance (tuple): (absolute, relative) tolerance for comparing numbers,
+                          or None to compare the text exactly
+            forms (tuple): expected_forms(expected) if known, so that only the
+                          actual output is normalized
 
         Returns:
             A tuple of (incorrect output diffs, whitespace diffs)
@@ -51,18 +103,26 @@ def diff(actual,expected,is_text_exp,visible_diff):
     softtest_diffs = None       # initialize to None
     hardtest_diffs = None
 
-    if is_text_exp:
-        # determine if there are softtest differences
-        softtest_diffs = get_softtest_diff(expected, actual)
+    if is_text_exp and tolerance is not None:
+        softtest_diffs = get_numeric_diff(expected, actual, *tolerance)
+        hardtest_diffs = []
 
-        if not softtest_diffs:
+    elif is_text_exp:
+        # determine if there are softtest differences (in linear time: the
+        # difflib report is only built for the outputs that differ)
+        (expected, soft_expected, visible_expected) = forms or (expected, None, None)
+        if soft_equal(expected, actual, soft_expected):
+            softtest_diffs = []
 
-            if visible_diff:  # show a visible diff by replacing spaces with #
-                expected = clean_data(expected, r'[\s\n]', '#', True)
-                actual = clean_data(actual, r'[\s\n]', '#', True)
+            if expected == actual:
+                hardtest_diffs = []
+            else:
+                if visible_diff:  # show a visible diff by replacing spaces with #
+                    expected = visible_expected or clean_data(expected, VISIBLE_SPACE, '#', True)
+                    actual = clean_data(actual, VISIBLE_SPACE, '#', True)
 
-            # determine if there are whitespace differences
-            hardtest_diffs = get_hardtest_diff(expected,actual)
+                # determine if there are whitespace differences
+                hardtest_diffs = get_hardtest_diff(expected,actual)
 
         else:
             softtest_diffs = get_hardtest_diff(expected,actual)
@@ -72,13 +132,240 @@ def diff(actual,expected,is_text_exp,visible_diff):
 
     return (softtest_diffs,hardtest_diffs)
 
+def is_text_file(filename):
+    '''Returns whether the file holds text (and not binary data), judging
+       by its first SNIFF_SIZE bytes: text has no NUL bytes, and is either
+       valid UTF-8 or free of control characters (as in other encodings).
+       Empty files are text.
+    '''
+    with open(filename, 'rb') as file:
+        prefix = file.read(SNIFF_SIZE)
+    if b"\0" in prefix:
+        return False
+    try:
+        # not final: the prefix may end in the middle of a character
+        codecs.getincrementaldecoder('utf-8')().decode(prefix)
+        return True
+    except UnicodeDecodeError:
+        return not CONTROL_BYTES.search(prefix)
+
+
+def read_file(filename, is_text):
+    '''Returns the lines of a text file, or the contents of a binary file.'''
+    if is_text:
+        with open(filename, 'r', errors="replace") as file:
+            return file.readlines()
+    with open(filename, 'rb') as file:
+        return file.read()
+
+
+def diff_files(actual_path, expected_path, is_text_exp, visible_diff, tolerance=None, forms=None):
+    '''Same as diff(), but compares the files actual_path and expected_path
+       (forms are the expected_forms() of the expected file, if known).
+
+       Files smaller than LARGE_FILE are read and compared by diff(). Larger
+       ones are never held in memory: they are memory-mapped and compared
+       chunk by chunk, and when they differ, only the lines (or bytes)
+       around the first difference are read to build the report, which
+       starts with a line telling where that difference is. The memory used
+       is bounded by the longest line of the files.
+    '''
+    if os.path.getsize(actual_path) < LARGE_FILE and os.path.getsize(expected_path) < LARGE_FILE:
+        expected = forms[0] if forms else read_file(expected_path, is_text_exp)
+        return diff(read_file(actual_path, is_text_exp), expected
+                   , is_text_exp, visible_diff, tolerance, forms)
+
+    offset = first_byte_difference(actual_path, expected_path)
+    if not is_text_exp:
+        if offset is None:
+            return (None, None)
+        with open(actual_path, 'rb') as file:
+            file.seek(max(0, offset - CONTEXT_BYTES // 2))
+            return (file.read(CONTEXT_BYTES), None)
+    if offset is None:
+        return ([], [])
+
+    expected = FileLines(expected_path)
+    actual = FileLines(actual_path)
+    if tolerance is not None:
+        return (get_numeric_diff(expected, actual, *tolerance), [])
+
+    # the files may still be equal as text (line endings, invalid characters)
+    soft_difference = first_line_difference(expected, actual, soft=True)
+    difference = soft_difference or first_line_difference(expected, actual)
+    if difference is None:
+        return ([], [])
+    (exp_line, actual_line) = difference
+    expected = lines_around(expected, exp_line)
+    actual = lines_around(actual, actual_line)
+    if not soft_difference and visible_diff:
+        expected = clean_data(expected, VISIBLE_SPACE, '#', True)
+        actual = clean_data(actual, VISIBLE_SPACE, '#', True)
+    report = get_hardtest_diff(expected, actual
+                              , start=(max(0, exp_line - CONTEXT_LINES) + 1
+                                      , max(0, actual_line - CONTEXT_LINES) + 1))
+    if report:
+        report.insert(0, "First difference at line %d of the expected output and line %d of the output"
+                         " (only the lines around it are shown):\n" % (exp_line + 1, actual_line + 1))
+    return (report, []) if soft_difference else ([], report)
+
+
+class FileLines:
+    '''The lines of a text file (as file.readlines() would return them),
+       read from the file each time they are iterated over, so that they
+       are never all in memory.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __iter__(self):
+        with open(self.filename, 'r', errors="replace") as file:
+            yield from file
+
+
+class DiffLines:
+    '''The lines of a diff kept in a file (see spill_lines()) instead of
+       a list in memory. Iterating, len(), bool() and indexing (including
+       slices) work as on the list; only the lines asked for are read.
+    '''
+    __slots__ = ("filename", "count")
+
+    def __init__(self, filename, count):
+        self.filename = filename
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        with open(self.filename, 'r', encoding='utf-8', errors='surrogateescape'
+                 , newline='') as file:
+            yield from file
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(itertools.islice(self, *index.indices(self.count)))
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("diff line index out of range")
+        return next(itertools.islice(self, index, None))
+
+
+def spill_lines(lines, filename):
+    '''Writes the lines of a diff to filename and returns them as DiffLines.'''
+    with open(filename, 'w', encoding='utf-8', errors='surrogateescape', newline='') as file:
+        file.writelines(lines)
+    with open(filename, 'r', encoding='utf-8', errors='surrogateescape', newline='') as file:
+        count = sum(1 for line in file)
+    return DiffLines(filename, count)
+
+
+def first_byte_difference(path1, path2):
+    '''Returns the offset of the first byte that differs between the files
+       (the size of the shorter file if it is a prefix of the other one),
+       or None if their contents are equal. Both files are memory-mapped
+       and compared CHUNK_SIZE bytes at a time.
+    '''
+    (size1, size2) = (os.path.getsize(path1), os.path.getsize(path2))
+    size = min(size1, size2)
+    if size: # empty files cannot be mapped
+        with open(path1, 'rb') as file1, open(path2, 'rb') as file2, \
+             mmap.mmap(file1.fileno(), size, access=mmap.ACCESS_READ) as data1, \
+             mmap.mmap(file2.fileno(), size, access=mmap.ACCESS_READ) as data2:
+            for start in range(0, size, CHUNK_SIZE):
+                equal = data1[start:start + CHUNK_SIZE] == data2[start:start + CHUNK_SIZE]
+                if equal and hasattr(mmap, "MADV_DONTNEED"):
+                    # unmap the pages compared, so that they do not add up
+                    # to the resident memory of the test center
+                    length = min(CHUNK_SIZE, size - start)
+                    data1.madvise(mmap.MADV_DONTNEED, start, length)
+                    data2.madvise(mmap.MADV_DONTNEED, start, length)
+                if not equal:
+                    # bisect the chunk: the bytes before low are equal and
+                    # the first difference is before high
+                    (low, high) = (start, min(start + CHUNK_SIZE, size))
+                    while high - low > 1:
+                        middle = (low + high) // 2
+                        if data1[low:middle] == data2[low:middle]:
+                            low = middle
+                        else:
+                            high = middle
+                    return low
+    return None if size1 == size2 else size
+
+
+def first_line_difference(expected, actual, soft=False):
+    '''Returns the indexes (from 0) of the first lines of expected and actual
+       that differ, or None if there are none. A missing line is at the
+       index of the end of its data. When soft is True, the lines are
+       compared as in soft_equal(), and the indexes are those of the lines
+       before whitespace was removed.
+    '''
+    def numbered(data):
+        count = 0
+        for (count, line) in enumerate(data, 1):
+            if soft:
+                line = ''.join(line.split())
+                if not line:
+                    continue
+            yield (count - 1, line)
+        yield (count, None)
+
+    for ((exp_line, e), (actual_line, a)) in zip(numbered(expected), numbered(actual)):
+        if e != a:
+            return (exp_line, actual_line)
+    return None
+
+
+def lines_around(data, index):
+    '''The lines of data up to CONTEXT_LINES away from index, each cut to
+       CONTEXT_LINE_LIMIT characters.
+    '''
+    lines = itertools.islice(data, max(0, index - CONTEXT_LINES), index + CONTEXT_LINES + 1)
+    return [cut_line(line) for line in lines]
+
+
+def cut_line(line):
+    '''line, cut to CONTEXT_LINE_LIMIT characters.'''
+    return line if len(line) <= CONTEXT_LINE_LIMIT else line[:CONTEXT_LINE_LIMIT] + "...\n"
+
+
+def soft_lines(data):
+    '''Yields the lines of data with all whitespace removed, skipping the
+       lines that are empty afterwards (the lines compared by the soft-test).
+    '''
+    for line in data:
+        stripped_line = ''.join(line.split())
+        if stripped_line:
+            yield stripped_line
+
+
+def soft_equal(expected, actual, soft_expected=None):
+    '''Returns True when get_softtest_diff(expected, actual) would find no
+       differences, comparing the lines one by one (linear time).
+       soft_expected are the soft_lines() of expected, if known.
+    '''
+    if soft_expected is None:
+        soft_expected = soft_lines(expected)
+    return all(e == a for (e, a) in itertools.zip_longest(soft_expected, soft_lines(actual)))
+
+
+def expected_forms(expected):
+    '''Returns the forms of the lines of an expected output used by diff():
+       (the lines, their soft_lines() and their visible form, where spaces
+       and newlines are replaced by '#').
+    '''
+    return (expected, list(soft_lines(expected)), clean_data(expected, VISIBLE_SPACE, '#', True))
+
+
 def clean_data(data, patt, repl, hard_test=False):
     '''Replaces the given pattern throughout the data
        and returns the result.
        
        Arguments:
             data (list): A list of strings
-            patt (str): the string that should be replaced
+            patt (str or re.Pattern): the pattern that should be replaced
             repl (str): the string to replace the pattern.
             hard_test (bool): True if this is a hard_test
 
@@ -107,12 +394,13 @@ def clean_data(data, patt, repl, hard_test=False):
     return cleaned
 
 
-def get_hardtest_diff(expected, actual, fuzz_level=0):
+def get_hardtest_diff(expected, actual, fuzz_level=0, start=(1, 1)):
     """Finds all differences between expected and actual,
     including whitespace differences.
 
     Line by line comparison of two lists of strings.
-    Returns a list of the lines where differences were found.
+    Returns a list of the lines where differences were found
+    (see diff_report()).
     Prefix of differences:
     '- ': lines missing from actual
     '+ ': extra lines in actual
@@ -123,33 +411,128 @@ def get_hardtest_diff(expected, actual, fuzz_level=0):
         expected (str): what is expected as the correct answer
         fuzz_level: the number of allowable differences before 
                     they are considered significant.
+        start: the line numbers of the first lines of expected and actual
 
     Returns:
         diff_result (list): the quick difference output showing differences
         or
         []: if a non-significant number of errors were found
-    """   
-    diff_engine = difflib.Differ()
-    diff_result = list(diff_engine.compare(expected, actual))
 
-    # print("HERE")
+    Whether the outputs differ is decided on the whole of them (see
+    count_differences()); DIFF_CONTEXT and DIFF_LINES only shape the report.
+    """
+    if count_differences(expected, actual, fuzz_level) < max(fuzz_level, 1):
+        return []
+    return list(diff_report(expected, actual, start=start))
+
+
+def count_differences(expected, actual, fuzz_level=0):
+    """The number of lines of expected and actual that are not matched
+    (the '- ' and '+ ' lines of a full diff). Only whether there is any
+    difference is computed when fuzz_level is at most 1 (linear time).
+    """
+    (expected, actual) = (list(expected), list(actual))
+    if fuzz_level <= 1:
+        return int(expected != actual)
+    matcher = difflib.SequenceMatcher(None, expected, actual, autojunk=False)
+    return sum((i2 - i1) + (j2 - j1) for (tag, i1, i2, j1, j2) in matcher.get_opcodes()
+               if tag != 'equal')
+
+
+def diff_report(expected, actual, context=None, limit=None, start=(1, 1)):
+    """Generates the lines of a report of the differences between the lists
+    of lines expected and actual: only the changed parts, each with context
+    unchanged lines (default: DIFF_CONTEXT) around it, under a header
+    "@@ -l,n +l,n @@" giving the first line and the number of lines shown of
+    expected and of actual (numbered from start). The lines are those of
+    difflib.Differ. The report stops after limit lines (default: DIFF_LINES),
+    and the context is cut so that the first change fits in it.
+    The lines are matched only as far as the report goes (see
+    changed_groups()), so a long output with many differences costs about
+    as much as the lines reported.
+    """
+    limit = DIFF_LINES if limit is None else limit
+    # the context must leave room in the report for the changes themselves
+    context = min(DIFF_CONTEXT if context is None else context, max(0, (limit - 2) // 2))
     count = 0
-    found_diff = False
-    for line in diff_result:
-        if line[0] == '+' or line[0] == '-':
+    for (a0, b0, a, b, group) in changed_groups(expected, actual, context, max(limit, 1)):
+        (i1, j1) = (group[0][1], group[0][3])
+        (i2, j2) = (group[-1][2], group[-1][4])
+        header = "@@ -%d,%d +%d,%d @@\n" % (start[0] + a0 + i1, i2 - i1, start[1] + b0 + j1, j2 - j1)
+        for line in itertools.chain([header], hunk_lines(a, b, group)):
+            if count == limit:
+                yield "... (more differences are not shown)\n"
+                return
             count += 1
+            yield line if line.endswith("\n") else line + "\n"
 
-            # if line.strip() == '+' or line.strip() == "-":
-                # print("NEWLINE")
 
-            if count >= fuzz_level:
-                found_diff = True
+def changed_groups(expected, actual, context, window):
+    """Generates the changes between the lists of lines expected and actual
+    as (a0, b0, a, b, group): group is a group of opcodes (see
+    difflib.SequenceMatcher.get_grouped_opcodes()) indexing a and b, the
+    parts of expected and actual from a0 and b0. Equal lines are skipped one
+    by one, and only window lines past each difference are matched at a time
+    (more when a change goes on past them). When the outputs still differ
+    after 16 windows, the first group is the last one.
+    """
+    (i, j) = (0, 0)
+    (n, m) = (len(expected), len(actual))
+    while True:
+        (synced_i, synced_j) = (i, j)
+        while i < n and j < m and expected[i] == actual[j]:
+            i += 1
+            j += 1
+        if i == n and j == m:
+            return
+        back = min(context, i - synced_i)
+        (a0, b0) = (i - back, j - back)
+        size = window
+        while True:
+            (a, b) = (expected[a0:i + size], actual[b0:j + size])
+            at_end = i + size >= n and j + size >= m
+            groups = list(difflib.SequenceMatcher(None, a, b, autojunk=False)
+                          .get_grouped_opcodes(context))
+            # a group is complete when equal lines follow it (or the lines end)
+            complete = [group for group in groups
+                        if at_end or (group[-1][2] < len(a) and group[-1][4] < len(b))]
+            if complete or size >= 16 * window:
                 break
-    if found_diff:
-        return diff_result
-    return []
+            size *= 2
+        if not complete: # too different to be matched: show how it starts
+            yield (a0, b0, a, b, groups[0])
+            return
+        for group in complete:
+            yield (a0, b0, a, b, group)
+        (i, j) = (a0 + complete[-1][-1][2], b0 + complete[-1][-1][4])
+
+
+def hunk_lines(expected, actual, group):
+    """The difflib.Differ lines of a group of opcodes (see diff_report()),
+    each cut to CONTEXT_LINE_LIMIT characters. Blocks of lines too long to be
+    compared character by character (see FANCY_REPLACE_CHARS) are shown as
+    they are removed and added.
+    """
+    for (tag, i1, i2, j1, j2) in group:
+        if tag == 'equal':
+            yield from ('  ' + cut_line(line) for line in expected[i1:i2])
+        elif tag == 'replace' and fancy_replace(expected[i1:i2], actual[j1:j2]):
+            yield from difflib.Differ().compare(expected[i1:i2], actual[j1:j2])
+        else:
+            yield from ('- ' + cut_line(line) for line in expected[i1:i2])
+            yield from ('+ ' + cut_line(line) for line in actual[j1:j2])
 
 
+def fancy_replace(expected, actual):
+    """Whether the changed lines expected and actual are few and short enough
+    to be compared character by character (they are then shown whole).
+    """
+    if len(expected) * len(actual) > FANCY_REPLACE_PAIRS:
+        return False
+    lengths = [len(line) for line in expected + actual]
+    return max(lengths, default=0) <= CONTEXT_LINE_LIMIT \
+        and sum(lengths[:len(expected)]) * sum(lengths[len(expected):]) <= FANCY_REPLACE_CHARS
+
 
 def get_softtest_diff(expected, actual, fuzz_level=0):
     """ Same as get_hardtest_diff(), but before comparison all
@@ -161,6 +544,66 @@ def get_softtest_diff(expected, actual, fuzz_level=0):
         fuzz_level: the number of allowable differences before 
                     they are considered significant.
     """
-    stripped_one = clean_data(expected, r'\s+', '')
-    stripped_two = clean_data(actual, r'\s+', '')
+    stripped_one = clean_data(expected, WHITESPACE, '')
+    stripped_two = clean_data(actual, WHITESPACE, '')
     return get_hardtest_diff(stripped_one, stripped_two, fuzz_level)
+
+
+def numbers_close(expected, actual, abs_tol, rel_tol):
+    """Returns True when both tokens are numbers that are equal within the
+    given absolute or relative tolerance (two NaNs are considered equal).
+    """
+    try:
+        e = float(expected)
+        a = float(actual)
+    except ValueError:
+        return False
+    if math.isnan(e) and math.isnan(a):
+        return True
+    return math.isclose(e, a, rel_tol=rel_tol, abs_tol=abs_tol)
+
+
+def get_numeric_diff(expected, actual, abs_tol, rel_tol):
+    """Compares the whitespace separated tokens of expected and actual
+    in a single pass. Tokens that are equal as strings match, and so do
+    numbers within the tolerance (see numbers_close()); whitespace and
+    line breaks are ignored.
+
+    Arguments:
+        actual (list): the lines of the student's output
+        expected (list): the lines of the correct answer
+        abs_tol, rel_tol (float): absolute and relative tolerance
+
+    Returns:
+        []: if all tokens match
+        or
+        the lines of a report on the first token that does not match
+    """
+    def tokens(data):
+        return itertools.chain.from_iterable(line.split() for line in data)
+
+    def position(data, index):
+        '''Line and token number (from 1) of the token at index, or None.'''
+        for (line_no, line) in enumerate(data, 1):
+            line_tokens = line.split()
+            if index < len(line_tokens):
+                return (line_no, index + 1, line_tokens[index])
+            index -= len(line_tokens)
+        return None
+
+    pairs = itertools.zip_longest(tokens(expected), tokens(actual))
+    for (index, (e, a)) in enumerate(pairs):
+        if e == a or (e is not None and a is not None
+                      and numbers_close(e, a, abs_tol, rel_tol)):
+            continue
+        report = ["First mismatch at token %d (absolute tolerance %g, relative tolerance %g):\n"
+                  % (index + 1, abs_tol, rel_tol)]
+        for (sign, name, data) in (("-", "expected", expected), ("+", "actual", actual)):
+            found = position(data, index)
+            if found:
+                report.append("%s %-8s line %d, token %d: %s" % ((sign, name) + found[:2]
+                                                                + (cut_line(found[2] + "\n"),)))
+            else:
+                report.append("%s %-8s end of output\n" % (sign, name))
+        return report
+    return []
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+######################################################################
+#   File: gradeworker.py
+#
+#   Description:
+#       A worker of distributed batch grading: connects to a
+#       coordinator (python3 batchgrade.py ... --listen PORT), receives
+#       the test suite, and grades the submissions it sends with
+#       batchgrade.grade_submission() until there are none left.
+#       Start as many workers on as many machines as wanted; each
+#       grades one submission at a time.
+#
+#   Usage:
+#       python3 gradeworker.py HOST:PORT --token TOKEN [--jobs N]
+#
+#   Included functions:
+#       - main(), setup(), work()
+#
+######################################################################
+
+import argparse
+import contextlib
+import os
+import multiprocessing
+import TestSuite
+import GradingQueue
+from TestHistory import TestHistory
+import batchgrade
+
+
+def setup(test_directory, srcdir, options, name=None):
+    '''Collects the test suite received and sets up the worker state of
+       batchgrade, as batchgrade.init_worker() does for local workers. The
+       history of the suite is that of name, its path on the coordinator
+       (test_directory is a new copy every time).
+    '''
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        test_suite = TestSuite.TestSuite(test_directory, any_language=True)
+        test_suite.collect_tests(create_missing_dirs=False)
+    if name:
+        test_suite.history = TestHistory(name)
+    batchgrade.init_worker(test_suite, argparse.Namespace(srcdir=srcdir, **options)
+                          , os.path.dirname(test_directory))
+
+
+def work(address, token):
+    try:
+        GradingQueue.run_worker(address, token, setup, batchgrade.grade_submission)
+    except (OSError, EOFError) as err:
+        print("Worker %d stopped: %s" % (os.getpid(), err))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Grade the submissions sent by a batchgrade.py coordinator.')
+    parser.add_argument(
+        'address',
+        metavar='HOST:PORT',
+        help='address the coordinator listens on (batchgrade.py --listen)')
+    parser.add_argument(
+        '--token',
+        required=True,
+        help='the token printed by the coordinator')
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=1,
+        help='number of workers started (each grades one submission at a time; '
+             '0: one per CPU)')
+    args = parser.parse_args()
+
+    address = GradingQueue.parse_address(args.address)
+    jobs = args.jobs or os.cpu_count() or 1
+    workers = [multiprocessing.Process(target=work, args=(address, args.token))
+               for i in range(jobs)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -26,7 +26,8 @@
 # This will test all .py files in slimes/, renaming them to slimes.py first,
 # and will test them against the data in slimes/test-cases/. Two new folders
 # will be created: slimes/passed/ and slimes/failed/. If a submission 
-# passes/fails, it will be copied into the appropriate folder.
+# passes/fails, it will be copied into the appropriate folder. One row per
+# submission is written to slimes/results.csv.
 #
 
 # Uncomment to debug this script.
@@ -44,83 +45,17 @@ if [[ $# < 2 ]] || [[ $1 == "--help" ]] ; then
   echo "              if provided only the given student's assignment is tested, and the"
   echo "              result is printed to the terminal"
   echo ""
-  echo "This script MUST be run from the TestCenter directory."
+  echo "This script MUST be run from the TestCenter directory. It is a wrapper"
+  echo "around batchgrade.py."
   exit 1
 fi
 
-if [ ! -e testcenter.py ] ; then
+if [ ! -e batchgrade.py ] ; then
   echo "Please run this from the TestCenter directory."
   exit 1
 fi
 
-srcdir=$1
-pyname=$2
-file=$3
-have_file=$(( $# >= 3 ? 1 : 0 ))
-
-echo "-----------------------------------------------------------"
-if [[ $have_file == 0 ]] ; then
-  echo "Batch testing ..."
-else
-  echo "Testing single file ..."
-fi
-
-# Timeout for running ALL test cases. This should be sufficient for all
-# reasonable solutions.
-maxtime="120s"
-
-# How many test cases are there?
-test_case_dir="test-cases"
-num_tests=$( ls -1 $srcdir/$test_case_dir/*/Inputs/ | wc -l )
-echo "# of tests found = $num_tests"
-
-# If bulk-marking, then create the output directories.
-if [[ $have_file == 0 ]] ; then
-  if [ -d "$srcdir/passed" ] ; then rm -R "$srcdir/passed"; fi
-  if [ -d "$srcdir/failed" ] ; then rm -R "$srcdir/failed"; fi
-  mkdir "$srcdir/passed"
-  mkdir "$srcdir/failed"
-fi
-
-# Prepare the temporary marking directory.
-if [ -d tmp ] ; then rm -R tmp; fi
-mkdir tmp
-cp -fR "$srcdir/$test_case_dir" tmp/
-#if [ "$test_case_dir" != "test-cases" ] ; then
-#  mv "tmp/$test_case_dir" tmp/test-cases
-#fi
-
-# Runs the tests on $file.
-function run_test() {
-  echo $file
-  cp -f "$file" "tmp/$pyname"
-  cp -f $srcdir/*.sh "tmp/" # for cpp files
-  timeout $maxtime python3 testcenter.py -t tmp/test-cases -s tmp/ 2> /dev/null | grep 'Number of tests' > tmp/result
-  failed=$?
-  #echo "errcode = $failed"
-  if [[ $failed == 0 ]] ; then
-    if [[ "$(cat tmp/result)" == "Number of tests: $num_tests Errors: 0 Serious failures: 0"* ]] ; then
-      echo "Passed"
-      if [[ $have_file == 0 ]] ; then cp "$file" "$srcdir/passed/"; fi
-    else
-      echo "Failed - incorrect output"
-      if [[ $have_file == 0 ]] ; then cp "$file" "$srcdir/failed/"; fi
-    fi
-  else
-    echo "Failed - timeout ($maxtime)"
-    if [[ $have_file == 0 ]] ; then cp "$file" "$srcdir/failed/"; fi
-  fi
-}
-
-# Bulk-mark.
-if [[ $have_file == 0 ]] ; then
-  for file in $srcdir/*.py ; do
-  # for file in $srcdir/*.cpp ; do # for cpp files
-    run_test
-  done
-# Single-mark.
-else
-  run_test
-fi
-
-exit 0
+# The grading itself is done by batchgrade.py, which collects the test cases
+# once, grades the submissions in parallel and writes the results table
+# $1/results.csv (see python3 batchgrade.py --help for more options).
+exec python3 batchgrade.py "$@"
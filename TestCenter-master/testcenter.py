@@ -7,7 +7,7 @@
 #       no use for it).
 #
 #   Included functions:
-#       - main()
+#       - parse_shard(), main()
 #
 ######################################################################
 
@@ -15,6 +15,9 @@
 
 import argparse
 import TestSuite
+import Reporters
+import diffs
+from Sandbox import Sandbox
 import logging
 import os
 logging.basicConfig(level=logging.DEBUG)
@@ -41,6 +44,17 @@ AND a confirmation to avoid students screwing up their test dirs.
 '''
 
 
+def parse_shard(text):
+    '''Parses "I/N" (the I-th of N shards, 1 <= I <= N) into (I, N).'''
+    try:
+        (index, count) = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected I/N, e.g. 2/4, not %r" % text)
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard %d/%d does not exist" % (index, count))
+    return (index, count)
+
+
 def main():
     # default directory for the tests: the current working directory
     # @todo: test these
@@ -81,6 +95,10 @@ def main():
     parser.add_argument('--timeout', type=int,default=200
                        ,  help='Terminate the script with an error after the '\
                                'timeout has passed')
+    parser.add_argument('--output_limit', type=float, default=None
+                       , help='Fail a test when it writes more than this many '\
+                              'megabytes to stdout, stderr or any other file '\
+                              '(default: 64)')
     parser.add_argument(
         '--generate',
         '-g',
@@ -93,6 +111,59 @@ def main():
         '-e', 
         action='store_true',
         help='stop running test cases after first failure')
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=1,
+        help='number of test cases to run in parallel (0: one per CPU)')
+    parser.add_argument(
+        '--jsonl',
+        help='write the result of every test to this file as a line of JSON, '
+             'as soon as the test finishes')
+    parser.add_argument(
+        '--junit',
+        help='write the results to this file as JUnit XML, as soon as each test finishes')
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='run every test, even those whose result is reused because '
+             'neither the submission nor the test changed since the last run')
+    parser.add_argument(
+        '--warm',
+        action='store_true',
+        help='run python scripts in processes forked from interpreters that '
+             'are started once, instead of a new interpreter per test')
+    parser.add_argument(
+        '--sandbox',
+        action='store_true',
+        help='limit the address space, processes and open files of the tests, '
+             'and run them without network where possible (see Sandbox.py)')
+    parser.add_argument('--sandbox_memory', type=float
+                       , default=Sandbox.MEMORY_DEFAULT / (1024 * 1024)
+                       , help='megabytes of address space of each process of a '
+                              'sandboxed test')
+    parser.add_argument('--sandbox_processes', type=int, default=Sandbox.PROCESSES_DEFAULT
+                       , help='processes a sandboxed test may have at a time')
+    parser.add_argument(
+        '--cgroup',
+        help='delegated cgroup v2 directory in which sandboxed tests get a cgroup '
+             'each (default: $%s)' % Sandbox.CGROUP_ENV)
+    parser.add_argument('--diff_context', type=int, default=diffs.DIFF_CONTEXT
+                       , help='unchanged lines shown around each difference')
+    parser.add_argument('--diff_lines', type=int, default=diffs.DIFF_LINES
+                       , help='lines after which a difference report is cut')
+    parser.add_argument(
+        '--shard',
+        metavar='I/N',
+        type=parse_shard,
+        help='run only the I-th of N parts of the tests: split by the names of the '
+             'tests, or with --timings so that the parts take about the same time')
+    parser.add_argument(
+        '--timings',
+        help='JSON file keeping the durations of the tests, by which they are '
+             'scheduled and sharded (default: one per test directory in the private '
+             'cache directory); give the machines running the shards the same file')
     parser.add_argument('--wait_on_exit', '-w', action='store_true'
                        , help='Exit on finish instead of pausing and waiting '\
                               'for the user')
@@ -103,23 +174,39 @@ def main():
     parser.add_argument(
         '--python_only', action='store_true', help='Allow python only')
     args = parser.parse_args()
+    diffs.DIFF_CONTEXT = args.diff_context
+    diffs.DIFF_LINES = args.diff_lines
 
+    reporters = []
     testcase_source = os.path.abspath(os.getcwd())
     if args.test_directory:
         testcase_source = args.test_directory
     try:
         any_language = not args.python_only
         print("Creating test suite")
-        test_suite = TestSuite.TestSuite(testcase_source, any_language)
+        test_suite = TestSuite.TestSuite(testcase_source, any_language, args.timings)
         print("Collecting script-tests")
         test_suite.collect_tests(create_missing_dirs=False)
         print("Collected %s script-tests" % len(test_suite.test_cases))
+        if args.shard:
+            # without a timings file shared by the machines, their histories differ
+            (tests, seconds) = test_suite.select_shard(*args.shard, by_time=args.timings is not None)
+            print("Running shard %d/%d: %d tests (about %.1f s)" % (args.shard + (tests, seconds)))
 
         print("Verifying submission files")
         script_source = args.submission
         script_dir = TestSuite.prep_submission(
             script_source, test_suite.assignment_name, args.verify_script_dir)
 
+        if args.jsonl:
+            reporters.append(Reporters.JsonLinesReporter(args.jsonl))
+        if args.junit:
+            reporters.append(Reporters.JUnitReporter(args.junit))
+        sandbox = None
+        if args.sandbox:
+            sandbox = Sandbox(memory=int(args.sandbox_memory * 1024 * 1024)
+                             , processes=args.sandbox_processes, cgroup_parent=args.cgroup)
+            print(sandbox.describe())
         print("Running tests")
         test_suite.run_tests(
             script_dir,
@@ -127,7 +214,15 @@ def main():
             gen_res=args.generate,
             visible_space_diff=args.visible_space_diff,
             verbose=args.verbose,
-            stop_early=args.stop_early)
+            stop_early=args.stop_early,
+            jobs=args.jobs,
+            warm=args.warm,
+            force=args.force,
+            reporters=reporters,
+            sandbox=sandbox,
+            submission_name=os.path.abspath(script_source),
+            output_limit=None if args.output_limit is None
+                         else int(args.output_limit * 1024 * 1024))
         summary = test_suite.get_summary()
         print(
             "Number of tests: %s Errors: %s Serious failures: %s All failures: %s"
@@ -138,6 +233,9 @@ def main():
             input("Press <Enter> to exit")
     except RuntimeError as err:
         print("Error:\n" + str(err))
+    finally:
+        for reporter in reporters:
+            reporter.close()
 
 
 if __name__ == "__main__":
@@ -22,6 +22,9 @@
 #       ResultViewer()- Creates and implements the menu that displays
 #                       when you right click on a failed test case.
 #
+#       FinishedTests() - Passes the tests finished by the worker thread
+#                       running the tests to the GUI.
+#
 ######################################################################
 
 import tkinter as tk
@@ -30,10 +33,13 @@ from tkinter import filedialog
 from tkinter import messagebox
 import myplatform
 import TestSuite
+from Sandbox import Sandbox
 import configparser
 #import TestCase
 import subprocess
 import os
+import queue
+import threading
 from SimpleDialog import TextDialog, HelpMenu, ErrorDialog
 
 #@todo: Add diffmerge exec to the config file 
@@ -43,13 +49,13 @@ from SimpleDialog import TextDialog, HelpMenu, ErrorDialog
 #@todo: Nicer status bar
 #@todo: Run selected tests (context menu, global menu)
 #@todo: Instead of messagebox, use Labels as popups for showing differences
-#@todo: Add progress bar to notify user of progress when running tests
 #@todo: Add standard menu items (about) 
 #@todo: many tabs in Notebook: hide some tabs, scroll them, etc.
 #@todo: ordering tabs: alphabetic(?)
 #@todo: reordering of tests based on Results
 
 INI_FILE = "testcenter.ini"
+POLL_MS = 100 # how often the GUI looks for finished tests while the tests run (ms)
 
 def enable_menu_item(menu,entry,enable=True):
     menu.entryconfig(entry,state=(tk.ACTIVE if enable else tk.DISABLED))
@@ -277,8 +283,10 @@ class ResultViewer(ttk.Frame):
         item = self.treeview.identify('item', event.x, event.y)
         print("you clicked on", item, self.treeview.item(item,"values"))
         
-    def update_results(self):
-        for k,v in self.script_tests.items():
+    def update_results(self, test_names=None):
+        '''Shows the results of the given tests (by default, of all tests).'''
+        for k in (self.script_tests.keys() if test_names is None else test_names):
+            v = self.script_tests[k]
 
             r = v.get_result_str()
 
@@ -294,6 +302,30 @@ class ResultViewer(ttk.Frame):
             self.treeview.set(k,'Result',v.get_result_str())
 
 
+class FinishedTests:
+    '''A reporter (see Reporters.py) queueing the (script name, test name)
+       of each test finished by the worker thread, for the GUI to show.'''
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def report(self, script_name, test_case):
+        self.queue.put((script_name, test_case.name))
+
+    def close(self):
+        pass
+
+    def get_all(self):
+        '''Returns the names of the tests finished since the last call,
+           as a dictionary of lists of test names by script name.'''
+        finished = {}
+        while True:
+            try:
+                (script_name, test_name) = self.queue.get_nowait()
+            except queue.Empty:
+                return finished
+            finished.setdefault(script_name, []).append(test_name)
+
+
 class Application(ttk.Frame):
     def __init__(self, master=None):
         ttk.Frame.__init__(self, master)
@@ -309,7 +341,14 @@ class Application(ttk.Frame):
         self.summary = (0,0,0,0) # Tests, Errs, Soft-test failures, Hard-test failures
         self.any_language = True # whether any language is allowed, or just python
         self.timeout = 5    # default is 5 seconds, change using config file (testcenter.ini)
+        self.jobs = 1       # number of test cases run in parallel, change using config file
+        self.output_limit = None # maximum output size per test (bytes), change using config file (in MB)
+        self.warm = False   # fork python scripts from preloaded interpreters, change using config file
+        self.sandbox = None # limits of the processes of the tests (a Sandbox), change using config file
         self.script_based = 0 # whether the marking will be diff based (distinct correct answers) or script based (multiple correct answers)
+        self.worker = None  # the thread running the tests (while they run)
+        self.finished_tests = None # FinishedTests of the run
+        self.worker_error = None   # error raised by the run
         
         self.config = configparser.ConfigParser()
         self.root = master # must be a toplevel window or the root
@@ -369,6 +408,13 @@ class Application(ttk.Frame):
         self.verify_script_dir = dc.get('verify_script_dir',False)
 
         self.timeout = float(dc.get("timeout", 5))     # set the timeout to 5 if not specified in the file
+        self.jobs = int(dc.get("jobs", 1))              # run tests one at a time if not specified in the file
+        if "output_limit" in dc:
+            self.output_limit = int(float(dc["output_limit"]) * 1024 * 1024)
+        self.warm = eval(dc.get("warm", "False"))       # start a new interpreter per test if not specified in the file
+        if eval(dc.get("sandbox", "False")):            # no limits if not specified in the file
+            self.sandbox = Sandbox()
+            print(self.sandbox.describe())
         self.script_based = dc.get("script_based", 0)       
         print(self.script_based)
         self.update_statusbar()
@@ -421,6 +467,7 @@ class Application(ttk.Frame):
               , ("<Control-x>",lambda x: self.root.quit())
               , ("<Control-r>",lambda x: self.runall()) 
               , ("<Control-h>",lambda x: self.helpMenu()) 
+            , ("<Escape>",lambda x: self.cancel())
         )
         if myplatform.is_mac():
             acc = ( ("<Command-z>",lambda x: self.select_script_zip())
@@ -429,6 +476,7 @@ class Application(ttk.Frame):
                   , ("<Command-x>",lambda x: self.root.quit())
                   , ("<Command-r>",lambda x: self.runall()) 
                   , ("<Command-h>",lambda x: self.helpMenu())
+                  , ("<Escape>",lambda x: self.cancel())
             )            
         for a in acc:
             self.root.bind_all(a[0],a[1])        
@@ -462,6 +510,8 @@ class Application(ttk.Frame):
         run.add_command(label="Run all"
             , command=self.runall, underline=0, accelerator
             =acc_str+"+R")
+        run.add_command(label="Cancel"
+            , command=self.cancel, underline=0, accelerator="Esc")
         top.add_cascade(label='Run', menu=run, underline=0)
 
          ##### OPTIONS MENU #####
@@ -486,6 +536,7 @@ class Application(ttk.Frame):
                          
     def update_menustate(self):
         enable_menu_item(self.menu_run,0,self.runall_enabled())
+        enable_menu_item(self.menu_run,1,self.worker is not None)
 
     def update_statusbar(self):
         self.sb4.set_data(self.timeout)
@@ -522,20 +573,56 @@ class Application(ttk.Frame):
             self.testcase_changed()
                                 
     def runall(self):
+        """ Starts running the tests in a worker thread, so that the window
+        stays responsive; poll_worker() shows the results as they come. """
         if self.runall_enabled():
             self.reset_results()
             self.update_notebook()            
             self.update_statusbar()
             try:
                 self.prep_submission()
-                print("Running all tests against the submission files: ")
-                self.test_suite.run_tests(self.script_dir,timeout=self.timeout,gen_res=False,visible_space_diff=True,verbose=self.verbose, stop_early=self.stop_early, script_based=self.script_based)
-                print("Finished running tests.")
             except RuntimeError as err:
                 tk.messagebox.showerror("Error", str(err))
+                return
+            print("Running all tests against the submission files: ")
+            self.finished_tests = FinishedTests()
+            self.worker_error = None
+            self.worker = threading.Thread(target=self.run_worker, daemon=True)
+            self.worker.start()
             self.update_menustate()
-            self.update_notebook()            
-            self.update_statusbar()
+            self.after(POLL_MS, self.poll_worker)
+
+    def run_worker(self):
+        """ Runs the tests (in the worker thread: must not use tkinter). """
+        try:
+            self.test_suite.run_tests(self.script_dir,timeout=self.timeout,gen_res=False,visible_space_diff=True,verbose=self.verbose, stop_early=self.stop_early, script_based=self.script_based, jobs=self.jobs, output_limit=self.output_limit, warm=self.warm, reporters=(self.finished_tests,), sandbox=self.sandbox, submission_name=os.path.abspath(self.script_source[1]))
+        except RuntimeError as err:
+            self.worker_error = err
+
+    def poll_worker(self):
+        """ Shows the results of the tests finished since the last call, and
+        calls itself again until the worker thread is done. """
+        running = self.worker.is_alive()
+        for script_name, test_names in self.finished_tests.get_all().items():
+            self.test_results[script_name].update_results(test_names)
+        if running:
+            self.after(POLL_MS, self.poll_worker)
+            return
+        self.worker = None
+        if self.worker_error is not None:
+            tk.messagebox.showerror("Error", str(self.worker_error))
+        else:
+            print("Finished running tests.")
+        self.update_menustate()
+        self.update_notebook()            
+        self.update_statusbar()
+
+    def cancel(self):
+        """ Stops the tests: the running tests are killed (with the processes
+        they started), and no further tests are run. """
+        if self.worker is not None:
+            print("Cancelling the tests...")
+            self.test_suite.cancel()
 
     def toggleVerbose(self):
         if self.verbose == True:
@@ -563,9 +650,12 @@ class Application(ttk.Frame):
     # -----------------------------------------------------------------                
                 
     def runall_enabled(self):
-        return self.script_source!=None and self.testcase_source!=None and self.test_suite!=None
+        return self.script_source!=None and self.testcase_source!=None and self.test_suite!=None \
+            and self.worker==None
 
     def scripts_changed(self,src_type,src):
+        if self.worker_running():
+            return
         if self.verbose:
             print("scripts_changed: (%s,%s)" % (src_type,src))
         if not src:
@@ -590,11 +680,16 @@ class Application(ttk.Frame):
             self.update_notebook()
             self.files_changed()
     
+    def worker_running(self):
+        """ Returns whether the tests are running (and tells the user so). """
+        if self.worker is not None:
+            tk.messagebox.showerror("Error", "The tests are running. Cancel them first.")
+            return True
+        return False
+
     def reset_results(self):
         if self.test_suite!=None:
-            for test_caselist in self.test_suite.test_cases.values():
-                for test_case in test_caselist.values():
-                    test_case.reset_result()
+            self.test_suite.reset_results()
         
     def reset_test_suite(self):        
         self.test_suite = None
@@ -602,6 +697,8 @@ class Application(ttk.Frame):
         self.update_statusbar()
 
     def testcase_changed(self):
+        if self.worker_running():
+            return
         # reset the contents of the notebook
 #        num_tabs = self.nb.index("end") # do NOT use numeric indeces with forget: they don't work
 #        print(self.nb.tabs()[0])
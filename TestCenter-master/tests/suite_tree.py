@@ -0,0 +1,80 @@
+######################################################################
+#   File: tests/suite_tree.py
+#
+#   Description:
+#       Builds small test suites for the tests of the harness: a
+#       test-case directory of tests of a python script, and the
+#       submissions run against it, in a temporary directory that also
+#       holds the caches and the history of the test center.
+#
+#   Included classes:
+#       - SuiteTestCase() base class of the tests running test suites.
+#
+######################################################################
+
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ResultCache
+import TestSuite
+
+SCRIPT_NAME = "echo.py"
+# the script of a correct submission: copies stdin to stdout
+ECHO = "import sys\nsys.stdout.write(sys.stdin.read())\n"
+
+
+class SuiteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache_root = ResultCache.CACHE_ROOT
+        ResultCache.CACHE_ROOT = os.path.join(self.root, "cache")
+        self.testcase_dir = os.path.join(self.root, "test-cases")
+        self.test_path = os.path.join(self.testcase_dir, "as-1-1-%s-test" % SCRIPT_NAME)
+        for folder in TestSuite.TestSuite.TESTCASE_SUBDIRECTORIES:
+            os.makedirs(os.path.join(self.test_path, folder))
+
+    def tearDown(self):
+        ResultCache.CACHE_ROOT = self.cache_root
+        shutil.rmtree(self.root)
+
+    def make_test(self, name, stdin, expected):
+        '''Adds the test name, whose stdout must be expected on stdin.'''
+        for (folder, kind, data) in (("Inputs", "stdin", stdin), ("Expected", "stdout", expected)):
+            with open(os.path.join(self.test_path, folder, "%s-%s.txt" % (name, kind)), "w") as f:
+                f.write(data)
+
+    def make_submission(self, source=ECHO, name="submission"):
+        '''A submission whose script is source; returns its directory.'''
+        submission = os.path.join(self.root, name)
+        os.makedirs(submission, exist_ok=True)
+        with open(os.path.join(submission, SCRIPT_NAME), "w") as script:
+            script.write(source)
+        return submission
+
+    def collect(self, history_path=None):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            test_suite = TestSuite.TestSuite(self.testcase_dir, False, history_path)
+            test_suite.collect_tests(create_missing_dirs=False)
+        return test_suite
+
+    def run_suite(self, test_suite, submission, **options):
+        '''Runs the tests of test_suite against submission; returns
+           get_summary(): (tests, errors, fails, presentation errors).
+        '''
+        options = dict(dict(timeout=10, gen_res=False, visible_space_diff=False
+                           , verbose=False, stop_early=False), **options)
+        test_suite.reset_results()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            test_suite.run_tests(submission, **options)
+            return test_suite.get_summary()
+
+    def results(self, test_suite):
+        '''test name -> result of the tests of test_suite.'''
+        return {name: test_case.get_result_str()
+                for script_tests in test_suite.test_cases.values()
+                for (name, test_case) in script_tests.items()}
@@ -0,0 +1,78 @@
+######################################################################
+#   File: tests/test_diffs.py
+#
+#   Description:
+#       Checks that the settings of the quick difference report
+#       (diffs.DIFF_LINES and diffs.DIFF_CONTEXT) never change whether
+#       a test passes, and that the report stays small on long lines.
+#
+#   Usage:
+#       python3 -m unittest discover tests (or python3 -m pytest tests)
+#
+######################################################################
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import diffs
+
+
+class DiffReportLimitsTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = (diffs.DIFF_LINES, diffs.DIFF_CONTEXT)
+        self.expected = ["line %d\n" % i for i in range(1000)]
+        self.actual = list(self.expected)
+        self.actual[500] = "changed\n"
+
+    def tearDown(self):
+        (diffs.DIFF_LINES, diffs.DIFF_CONTEXT) = self.settings
+
+    def assert_fails(self):
+        (softtest_diffs, hardtest_diffs) = diffs.diff(self.actual, self.expected, True, False)
+        self.assertTrue(softtest_diffs)
+        self.assertFalse(hardtest_diffs)
+
+    def test_one_line_report_still_fails(self):
+        diffs.DIFF_LINES = 1
+        self.assert_fails()
+
+    def test_large_context_still_fails(self):
+        diffs.DIFF_CONTEXT = 300
+        self.assert_fails()
+        report = diffs.get_hardtest_diff(self.expected, self.actual)
+        self.assertIn("- line 500\n", report)
+        self.assertIn("+ changed\n", report)
+
+    def test_whitespace_difference_still_reported(self):
+        diffs.DIFF_LINES = 1
+        self.actual[500] = "line  500\n"
+        (softtest_diffs, hardtest_diffs) = diffs.diff(self.actual, self.expected, True, False)
+        self.assertEqual(softtest_diffs, [])
+        self.assertTrue(hardtest_diffs)
+
+    def test_equal_outputs_pass(self):
+        diffs.DIFF_LINES = 1
+        self.assertEqual(diffs.diff(self.expected, list(self.expected), True, False), ([], []))
+
+
+class LongLineReportTest(unittest.TestCase):
+    def test_long_lines_are_cut(self):
+        expected = ["a" * 3000000 + "\n", "same\n"]
+        actual = ["a" * 2999999 + "b\n", "same\n"]
+        report = diffs.get_hardtest_diff(expected, actual)
+        self.assertTrue(report)
+        self.assertTrue(all(len(line) <= diffs.CONTEXT_LINE_LIMIT + 8 for line in report))
+        self.assertIn("- " + "a" * diffs.CONTEXT_LINE_LIMIT + "...\n", report)
+
+    def test_fancy_replace_limited_by_characters(self):
+        expected = ["%d %s\n" % (i, "x" * 900) for i in range(40)]
+        actual = ["%d %s\n" % (i, "y" * 900) for i in range(40)]
+        self.assertLessEqual(len(expected) * len(actual), diffs.FANCY_REPLACE_PAIRS)
+        self.assertFalse(diffs.fancy_replace(expected, actual))
+        self.assertTrue(diffs.fancy_replace(expected[:2], actual[:2]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+######################################################################
+#   File: tests/test_reporters.py
+#
+#   Description:
+#       Checks the JSON Lines and JUnit XML files written by the
+#       reporters for a run with passing, failing and crashing tests.
+#
+#   Usage:
+#       python3 -m unittest discover tests (or python3 -m pytest tests)
+#
+######################################################################
+
+import json
+import os
+import sys
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from suite_tree import SCRIPT_NAME, SuiteTestCase
+
+import Reporters
+
+# an echo script that exits with status 3 on the input "crash"
+CRASHING_ECHO = '''import sys
+data = sys.stdin.read()
+if data == "crash\\n":
+    sys.exit(3)
+sys.stdout.write(data)
+'''
+
+
+class ReporterTest(SuiteTestCase):
+    def setUp(self):
+        SuiteTestCase.setUp(self)
+        self.make_test("t1", "one\n", "one\n")
+        self.make_test("t2", "two\n", "deux\n")
+        self.make_test("t3", "crash\n", "")
+        self.submission = self.make_submission(CRASHING_ECHO)
+        self.jsonl_path = os.path.join(self.root, "results.jsonl")
+        self.junit_path = os.path.join(self.root, "results.xml")
+
+    def run_reported(self, **options):
+        reporters = [Reporters.JsonLinesReporter(self.jsonl_path)
+                    , Reporters.JUnitReporter(self.junit_path)]
+        try:
+            return self.run_suite(self.collect(), self.submission, reporters=reporters, **options)
+        finally:
+            for reporter in reporters:
+                reporter.close()
+
+    def test_json_lines(self):
+        self.assertEqual(self.run_reported(), (3, 1, 1, 0))
+        with open(self.jsonl_path) as jsonl:
+            records = [json.loads(line) for line in jsonl]
+        self.assertEqual([(record["script"], record["test"], record["result"]) for record in records]
+                        , [(SCRIPT_NAME, "t1", "Pass"), (SCRIPT_NAME, "t2", "Fail")
+                          , (SCRIPT_NAME, "t3", "Runtime Error")])
+        self.assertEqual([diff["file"] for diff in records[1]["diffs"]], ["stdout.txt"])
+        self.assertEqual(records[1]["diffs"][0]["kind"], "fail")
+        self.assertIn("message", records[2])
+
+    def test_junit(self):
+        self.assertEqual(self.run_reported(jobs=2), (3, 1, 1, 0))
+        root = ElementTree.parse(self.junit_path).getroot()
+        self.assertEqual(root.tag, "testsuites")
+        self.assertEqual([suite.get("name") for suite in root], [SCRIPT_NAME])
+        testcases = {testcase.get("name"): [child.tag for child in testcase]
+                     for testcase in root.iter("testcase")}
+        self.assertEqual(testcases, {"t1": [], "t2": ["failure"], "t3": ["error"]})
+
+    def test_junit_is_valid_after_each_test(self):
+        reporter = Reporters.JUnitReporter(self.junit_path)
+        try:
+            self.assertEqual(len(list(ElementTree.parse(self.junit_path).getroot())), 0)
+            test_suite = self.collect()
+            self.run_suite(test_suite, self.submission)
+            for (count, name) in enumerate(("t1", "t2", "t3"), 1):
+                reporter.report(SCRIPT_NAME, test_suite.test_cases[SCRIPT_NAME][name])
+                root = ElementTree.parse(self.junit_path).getroot()
+                self.assertEqual(len(list(root.iter("testcase"))), count)
+        finally:
+            reporter.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+######################################################################
+#   File: tests/test_result_cache.py
+#
+#   Description:
+#       Checks that the result cache reuses the results of an unchanged
+#       submission on unchanged tests, and that a change to the script,
+#       an input or an expected output runs the tests again.
+#
+#   Usage:
+#       python3 -m unittest discover tests (or python3 -m pytest tests)
+#
+######################################################################
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from suite_tree import ECHO, SuiteTestCase
+
+# an echo script that also appends a line to a log for every run
+LOGGED_ECHO = "open(%r, 'a').write('run\\n')\n" + ECHO
+
+
+class ResultCacheTest(SuiteTestCase):
+    def setUp(self):
+        SuiteTestCase.setUp(self)
+        self.log = os.path.join(self.root, "runs.log")
+        self.make_test("t1", "one\n", "one\n")
+        self.make_test("t2", "two\n", "two\n")
+        self.submission = self.make_submission(LOGGED_ECHO % self.log)
+        self.test_suite = self.collect()
+
+    def runs(self):
+        '''Number of runs of the script since the last call.'''
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as log:
+            runs = len(log.readlines())
+        os.remove(self.log)
+        return runs
+
+    def run_twice(self):
+        '''Runs of the script in two runs of the suite.'''
+        self.run_suite(self.test_suite, self.submission)
+        first = self.runs()
+        self.assertEqual(self.run_suite(self.test_suite, self.submission), (2, 0, 0, 0))
+        return (first, self.runs())
+
+    def test_unchanged_tests_are_reused(self):
+        self.assertEqual(self.run_twice(), (2, 0))
+        self.assertEqual(self.results(self.test_suite), {"t1": "Pass", "t2": "Pass"})
+
+    def test_force_and_no_cache_run_every_test(self):
+        self.run_twice()
+        self.run_suite(self.test_suite, self.submission, force=True)
+        self.assertEqual(self.runs(), 2)
+        self.run_suite(self.test_suite, self.submission, cache=False)
+        self.assertEqual(self.runs(), 2)
+
+    def test_changed_script_runs_again(self):
+        self.run_twice()
+        self.make_submission(LOGGED_ECHO % self.log + "\n")
+        self.assertEqual(self.run_twice(), (2, 0))
+
+    def test_changed_settings_run_again(self):
+        self.run_twice()
+        self.run_suite(self.test_suite, self.submission, timeout=20)
+        self.assertEqual(self.runs(), 2)
+
+    def test_changed_expected_output_runs_again(self):
+        self.run_twice()
+        self.make_test("t2", "two\n", "deux\n")
+        self.test_suite = self.collect()
+        self.assertEqual(self.run_suite(self.test_suite, self.submission), (2, 0, 1, 0))
+        self.assertEqual(self.runs(), 1)
+        self.assertEqual(self.results(self.test_suite), {"t1": "Pass", "t2": "Fail"})
+
+    def test_changed_input_runs_again(self):
+        self.run_twice()
+        self.make_test("t1", "uno\n", "one\n")
+        self.test_suite = self.collect()
+        self.assertEqual(self.run_suite(self.test_suite, self.submission), (2, 0, 1, 0))
+        self.assertEqual(self.runs(), 1)
+
+    def test_cached_failures_are_reported_alike(self):
+        self.make_test("t2", "two\n", "deux\n")
+        self.test_suite = self.collect()
+        for runs in (2, 0):
+            self.assertEqual(self.run_suite(self.test_suite, self.submission), (2, 0, 1, 0))
+            self.assertEqual(self.runs(), runs)
+            self.assertEqual(self.results(self.test_suite), {"t1": "Pass", "t2": "Fail"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+######################################################################
+#   File: tests/test_shards.py
+#
+#   Description:
+#       Checks that the shards of TestSuite.select_shard() split a suite
+#       into disjoint parts covering every test, alike on every machine:
+#       by the names of the tests, and by their durations in a shared
+#       history.
+#
+#   Usage:
+#       python3 -m unittest discover tests (or python3 -m pytest tests)
+#
+######################################################################
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from suite_tree import SCRIPT_NAME, SuiteTestCase
+
+import TestHistory
+
+# the durations of the tests in the shared history
+DURATIONS = {"t1": 8.0, "t2": 4.0, "t3": 4.0, "t4": 3.0, "t5": 1.0}
+
+
+class ShardTest(SuiteTestCase):
+    def setUp(self):
+        SuiteTestCase.setUp(self)
+        for name in sorted(DURATIONS):
+            self.make_test(name, name + "\n", name + "\n")
+
+    def shards(self, count, history_path=None, by_time=False):
+        '''(kept, seconds, test names) of each shard, selected by a new suite.'''
+        shards = []
+        for index in range(1, count + 1):
+            test_suite = self.collect(history_path)
+            (kept, seconds) = test_suite.select_shard(index, count, by_time)
+            names = set(test_suite.test_cases.get(SCRIPT_NAME, {}))
+            self.assertEqual(kept, len(names))
+            shards.append((kept, seconds, names))
+        return shards
+
+    def assert_partition(self, shards):
+        names = [name for (kept, seconds, shard_names) in shards for name in shard_names]
+        self.assertEqual(sorted(names), sorted(DURATIONS))
+
+    def test_by_name(self):
+        shards = self.shards(2)
+        self.assert_partition(shards)
+        self.assertEqual([names for (kept, seconds, names) in shards]
+                        , [{"t1", "t3", "t5"}, {"t2", "t4"}])
+        self.assertEqual(self.shards(2), shards)
+
+    def test_more_shards_than_tests(self):
+        shards = self.shards(7)
+        self.assert_partition(shards)
+        self.assertEqual([kept for (kept, seconds, names) in shards], [1, 1, 1, 1, 1, 0, 0])
+
+    def test_by_time(self):
+        history_path = os.path.join(self.root, "history.json")
+        tests = {"%s/%s" % (SCRIPT_NAME, name): {"duration": duration, "runs": 1}
+                 for (name, duration) in DURATIONS.items()}
+        with open(history_path, "w") as history_file:
+            json.dump({"version": TestHistory.TestHistory.VERSION, "tests": tests
+                      , "submissions": {}}, history_file)
+        shards = self.shards(2, history_path, by_time=True)
+        self.assert_partition(shards)
+        self.assertEqual(shards, [(2, 11.0, {"t1", "t4"}), (3, 9.0, {"t2", "t3", "t5"})])
+
+    def test_by_time_without_history(self):
+        # every test is then expected to take the default duration
+        shards = self.shards(2, by_time=True)
+        self.assert_partition(shards)
+        self.assertEqual([kept for (kept, seconds, names) in shards], [3, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
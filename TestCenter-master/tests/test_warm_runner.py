@@ -0,0 +1,89 @@
+######################################################################
+#   File: tests/test_warm_runner.py
+#
+#   Description:
+#       Checks that a script run by WarmRunner (--warm) leaves the same
+#       outputs and exit status as the same script run by a new
+#       interpreter.
+#
+#   Usage:
+#       python3 -m unittest discover tests (or python3 -m pytest tests)
+#
+######################################################################
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from WarmRunner import WarmRunner
+
+# files left open, atexit functions, and an exit status set by sys.exit()
+SCRIPT = '''import atexit
+import sys
+atexit.register(print, "bye")
+result = open("result.txt", "w")
+result.write("42\\n")
+def cycle():
+    return result
+print("hello")
+print("warning", file=sys.stderr)
+sys.exit(int(sys.argv[1]))
+'''
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "the warm runner needs fork()")
+class WarmParityTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.submission = os.path.join(self.root, "submission")
+        os.mkdir(self.submission)
+        self.script = os.path.join(self.submission, "script.py")
+        with open(self.script, "w") as script:
+            script.write(SCRIPT)
+        self.runner = WarmRunner(self.submission, 1)
+
+    def tearDown(self):
+        self.runner.close()
+        shutil.rmtree(self.root)
+
+    def outputs(self, work_path):
+        outputs = {}
+        for name in sorted(os.listdir(work_path)):
+            with open(os.path.join(work_path, name), "rb") as output:
+                outputs[name] = output.read()
+        return outputs
+
+    def run_cold(self, argv):
+        work_path = tempfile.mkdtemp(dir=self.root)
+        with open(os.path.join(work_path, "stdout.txt"), "wb") as stdout \
+                , open(os.path.join(work_path, "stderr.txt"), "wb") as stderr:
+            status = subprocess.run([sys.executable, self.script] + argv, cwd=work_path
+                                   , stdin=subprocess.DEVNULL, stdout=stdout
+                                   , stderr=stderr).returncode
+        return (status, self.outputs(work_path))
+
+    def run_warm(self, argv):
+        work_path = tempfile.mkdtemp(dir=self.root)
+        for name in ("stdout.txt", "stderr.txt"):
+            open(os.path.join(work_path, name), "wb").close()
+        process = self.runner.start(work_path, self.script, argv, None
+                                   , os.path.join(work_path, "stdout.txt")
+                                   , os.path.join(work_path, "stderr.txt"))
+        status = process.wait(10)
+        self.runner.release(process)
+        return (status, self.outputs(work_path))
+
+    def test_same_outputs(self):
+        for argv in (["0"], ["3"]):
+            cold = self.run_cold(argv)
+            self.assertEqual(cold[1]["stdout.txt"], b"hello\nbye\n")
+            self.assertEqual(cold[1]["result.txt"], b"42\n")
+            self.assertEqual(self.run_warm(argv), cold)
+
+
+if __name__ == "__main__":
+    unittest.main()